@@ -3,8 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
 from config import Config
+from app.replicas import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession}) # Чтения GET-запросов - с реплик (app/replicas.py)
 migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login' # Указываем, куда кидать незалогиненных
@@ -18,6 +19,18 @@ def create_app(config_class=Config):
     migrate.init_app(app, db)
     login_manager.init_app(app)
 
+    # Реплики для чтения: проверка отставания и липкость к основной базе после записи
+    from app import replicas
+    replicas.init_app(app)
+
+    # Хранилище загрузок: локальная папка или S3 (app/storage.py)
+    from app import storage
+    storage.init_app(app)
+
+    # Кэш публичных страниц, сбрасывается событиями моделей (app/models.py)
+    from app import cache
+    cache.init_app(app)
+
     # Регистрация Blueprints
     from app.auth.routes import bp as auth_bp
     app.register_blueprint(auth_bp, url_prefix='/auth')
@@ -28,4 +41,52 @@ def create_app(config_class=Config):
     from app.main.routes import bp as main_bp
     app.register_blueprint(main_bp)
 
+    # Статика с хешем в именах, бандлы и immutable-заголовки (flask assets build)
+    from app import assets
+    assets.init_app(app)
+
+    # ETag/Last-Modified страниц по счетчикам изменений таблиц (после assets: в версии учтен манифест)
+    from app import conditional
+    conditional.init_app(app)
+
+    # Уменьшенные копии загруженных изображений и хелперы шаблонов для srcset
+    from app import images
+    images.init_app(app)
+
+    # Потоковая отдача длинных страниц (stream_page)
+    from app import streaming
+    streaming.init_app(app)
+
+    # flask seed generate/import - массовая загрузка данных
+    from app import seed
+    seed.init_app(app)
+
+    # Сводные таблицы панели управления и flask stats rebuild
+    from app import stats
+    stats.init_app(app)
+
+    # Очередь фоновых заданий и flask worker
+    from app import jobs
+    jobs.init_app(app)
+
+    # Оплата через ЮKassa и flask payments worker
+    from app import payments
+    payments.init_app(app)
+
+    # flask index-advisor - EXPLAIN горячих запросов
+    from app import advisor
+    advisor.init_app(app)
+
+    # Профилировщик SQL по запросам (только при SQL_PROFILER=1)
+    from app import profiler
+    profiler.init_app(app)
+
+    # Сжатие ответов gzip/brotli (WSGI-прослойка поверх всего приложения)
+    from app import compression
+    compression.init_app(app)
+
+    # За фронт-прокси: X-Forwarded-* и отдача загрузок через X-Accel-Redirect/X-Sendfile
+    from app import proxy
+    proxy.init_app(app)
+
     return app
\ No newline at end of file
@@ -5,14 +5,32 @@ from app import db
 from app.models import Category, Service
 from app.forms import CategoryForm, ServiceForm
 from app.models import Order
-import os
-from werkzeug.utils import secure_filename
 from flask import current_app
 from app.models import Portfolio
 from app.forms import PortfolioForm
 from app.models import Review # Добавьте Review в импорты
 from flask import jsonify # Добавьте в импорты в начале файла
-from datetime import timedelta # Убедитесь, что это импортировано
+from datetime import date, datetime, timedelta
+import json
+import os
+from app.models import OrderItem, User
+from app.booking import overlapping, change_status, remove_order, order_service_names
+from app.uploads import save_upload, UploadError, start_upload, upload_status, append_chunk, cancel_upload, finish_uploads
+from flask_wtf.csrf import generate_csrf, validate_csrf
+from wtforms.validators import ValidationError
+from app.pagination import keyset_paginate, keyset_stream
+from app.streaming import stream_page
+from app import profiler, stats
+from app.conditional import conditional
+from sqlalchemy.orm import joinedload
+
+# Максимальный диапазон одного запроса календаря (месяц с захватом соседних недель)
+MAX_EVENTS_RANGE_DAYS = 62
+# Размер страницы списков админки
+ADMIN_PER_PAGE = 50
+# Сколько фото можно добавить в портфолио одной пачкой
+PORTFOLIO_BATCH_LIMIT = 500
+ADMIN_STREAM_PER_PAGE = 200 # Заказы и отзывы выводятся потоком, страница может быть длиннее
 
 bp = Blueprint('admin', __name__)
 
@@ -29,7 +47,19 @@ def admin_required(f):
 @bp.route('/')
 @admin_required
 def dashboard():
-    return render_template('admin/dashboard.html', title='Панель управления')
+    # Виджеты читают сводные таблицы (app/stats.py), а не историю заказов
+    return render_template('admin/dashboard.html', title='Панель управления', stats=stats.dashboard(),
+                           revenue_statuses=stats.REVENUE_STATUSES)
+
+@bp.route('/sql-profiler')
+@admin_required
+def sql_profiler():
+    # Последние запросы этого воркера с числом SQL и найденными N+1
+    if not current_app.config['SQL_PROFILER']:
+        abort(404)
+    return render_template('admin/profiler.html', title='Профилировщик SQL', reports=profiler.history(),
+                           threshold=current_app.config['SQL_PROFILER_NPLUSONE'],
+                           budget=current_app.config['SQL_PROFILER_BUDGET'])
 
 # --- КАТЕГОРИИ ---
 
@@ -52,7 +82,8 @@ def categories():
 def delete_category(id):
     category = Category.query.get_or_404(id)
     # Нельзя удалить категорию, если в ней есть услуги (защита данных)
-    if category.services:
+    # services - dynamic-связь: сам запрос всегда истинен, проверяем первую строку
+    if category.services.limit(1).first() is not None:
         flash('Нельзя удалить категорию, к которой привязаны услуги.', 'danger')
     else:
         db.session.delete(category)
@@ -65,7 +96,8 @@ def delete_category(id):
 @bp.route('/services')
 @admin_required
 def services():
-    all_services = Service.query.all()
+    all_services = keyset_paginate(Service.query, Service.id, cursor=request.args.get('cursor'),
+                                   per_page=ADMIN_PER_PAGE, descending=False)
     return render_template('admin/services.html', title='Услуги', services=all_services)
 
 @bp.route('/services/new', methods=['GET', 'POST'])
@@ -79,8 +111,7 @@ def new_service():
         # Обработка файла
         if form.image.data:
             file = form.image.data
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+            filename = save_upload(file) # Путь по хешу содержимого (app/uploads.py)
 
         service = Service(
             name=form.name.data,
@@ -108,8 +139,7 @@ def edit_service(id):
         # Если загрузили НОВОЕ фото
         if form.image.data:
             file = form.image.data
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+            filename = save_upload(file) # Путь по хешу содержимого (app/uploads.py)
             service.image_path = filename # Обновляем путь
 
         service.name = form.name.data
@@ -136,9 +166,19 @@ def delete_service(id):
 @bp.route('/orders')
 @admin_required
 def orders():
-    # Сортируем: сначала новые
-    all_orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/orders.html', title='Управление заказами', orders=all_orders)
+    # Сортируем: сначала новые. Страница отдается потоком: строки читаются из курсора базы
+    # пачками, названия услуг - на каждую пачку через отдельное соединение
+    service_names = {}
+
+    def load_service_names(batch):
+        with db.engine.connect() as conn:
+            service_names.update(order_service_names(batch, conn))
+
+    all_orders = keyset_stream(Order.query.options(joinedload(Order.client)), Order.id, Order.created_at,
+                               cursor=request.args.get('cursor'), per_page=ADMIN_STREAM_PER_PAGE,
+                               on_batch=load_service_names)
+    return stream_page('admin/orders.html', title='Управление заказами', orders=all_orders,
+                       service_names=service_names)
 
 @bp.route('/orders/<int:id>/status/<string:new_status>')
 @admin_required
@@ -146,8 +186,8 @@ def change_order_status(id, new_status):
     order = Order.query.get_or_404(id)
     # Разрешенные статусы
     if new_status in ['confirmed', 'completed', 'cancelled', 'pending']:
-        order.status = new_status
-        db.session.commit()
+        # Вместе со статусом обновляются карты занятости дней (см. app/booking.py)
+        change_status(order, new_status)
         flash(f'Статус заказа #{order.id} изменен на {new_status}', 'success')
     else:
         flash('Некорректный статус', 'danger')
@@ -165,16 +205,15 @@ def portfolio():
     if form.validate_on_submit():
         file = form.image.data
         if file:
-            filename = secure_filename(file.filename)
-            # Сохраняем файл физически
-            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
+            # Сохраняем файл физически: по хешу содержимого, дубликаты хранятся один раз
+            filename = save_upload(file)
             
             # Сохраняем запись в БД
             new_work = Portfolio(
                 title=form.title.data,
                 description=form.description.data,
                 category_id=form.category_id.data,
-                image_path=filename # В БД пишем только имя файла
+                image_path=filename # В БД пишем путь относительно папки uploads
             )
             db.session.add(new_work)
             db.session.commit()
@@ -182,19 +221,80 @@ def portfolio():
             return redirect(url_for('admin.portfolio'))
 
     # Список работ
-    works = Portfolio.query.order_by(Portfolio.created_at.desc()).all()
-    return render_template('admin/portfolio.html', title='Управление портфолио', form=form, works=works)
+    works = keyset_paginate(Portfolio.query.options(joinedload(Portfolio.category)), Portfolio.id, Portfolio.uploaded_at,
+                            cursor=request.args.get('cursor'), per_page=ADMIN_PER_PAGE)
+    return render_template('admin/portfolio.html', title='Управление портфолио', form=form, works=works,
+                           csrf_token=generate_csrf(), chunk_size=current_app.config['UPLOAD_CHUNK_SIZE'],
+                           max_file_size=current_app.config['UPLOAD_MAX_FILE_SIZE'])
+
+# Загрузка пачкой: файлы приходят частями (app/uploads.py), записи создаются одним коммитом.
+# Запросы шлет скрипт страницы портфолио, CSRF-токен - в заголовке X-CSRFToken
+
+def check_csrf():
+    if not current_app.config.get('WTF_CSRF_ENABLED', True):
+        return
+    try:
+        validate_csrf(request.headers.get('X-CSRFToken'))
+    except ValidationError:
+        abort(400)
+
+@bp.errorhandler(UploadError)
+def upload_error(e):
+    return jsonify(error=str(e), offset=e.offset), e.status
+
+@bp.route('/portfolio/uploads', methods=['POST'])
+@admin_required
+def start_portfolio_upload():
+    check_csrf()
+    data = request.get_json(silent=True) or {}
+    return jsonify(start_upload(current_user.id, data.get('filename'), data.get('size'))), 201
+
+@bp.route('/portfolio/uploads/<upload_id>', methods=['GET', 'PATCH', 'DELETE'])
+@admin_required
+def portfolio_upload(upload_id):
+    if request.method == 'GET':
+        return jsonify(upload_status(upload_id, current_user.id))
+    check_csrf()
+    if request.method == 'DELETE':
+        cancel_upload(upload_id, current_user.id)
+        return '', 204
+    # Тело - сырые байты части (application/octet-stream), читаются потоком
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        abort(400)
+    return jsonify(append_chunk(upload_id, current_user.id, offset, request.stream, request.content_length))
+
+@bp.route('/portfolio/batch', methods=['POST'])
+@admin_required
+def portfolio_batch():
+    check_csrf()
+    data = request.get_json(silent=True) or {}
+    files = data.get('files') or []
+    category = db.session.get(Category, data.get('category_id') or 0)
+    if (category is None or not files or len(files) > PORTFOLIO_BATCH_LIMIT
+            or not all(isinstance(f, dict) and isinstance(f.get('id'), str) for f in files)):
+        abort(400)
+    titles = {f['id']: str(f.get('title') or '').strip() for f in files}
+    stored = finish_uploads(list(titles), current_user.id)
+    works = []
+    for upload_id, (filename, path) in zip(titles, stored):
+        works.append(Portfolio(
+            title=(titles[upload_id] or os.path.splitext(filename)[0])[:140],
+            description=data.get('description'),
+            category_id=category.id,
+            image_path=path
+        ))
+    db.session.add_all(works)
+    db.session.commit()
+    flash(f'Добавлено фото: {len(works)}', 'success')
+    return jsonify(created=len(works), redirect=url_for('admin.portfolio'))
 
 @bp.route('/portfolio/delete/<int:id>')
 @admin_required
 def delete_portfolio(id):
     work = Portfolio.query.get_or_404(id)
-    # Удаляем файл с диска (желательно, но для MVP можно пропустить try/except)
-    try:
-        os.remove(os.path.join(current_app.config['UPLOAD_FOLDER'], work.image_path))
-    except:
-        pass # Если файла нет, просто удаляем запись из БД
-        
+    # Файл удалится после коммита, если на него больше не ссылаются другие записи
+    # (см. delete_file_on_delete в app/models.py)
     db.session.delete(work)
     db.session.commit()
     flash('Работа удалена.', 'success')
@@ -204,8 +304,9 @@ def delete_portfolio(id):
 @bp.route('/reviews')
 @admin_required
 def reviews():
-    all_reviews = Review.query.order_by(Review.created_at.desc()).all()
-    return render_template('admin/reviews.html', title='Модерация отзывов', reviews=all_reviews)
+    all_reviews = keyset_stream(Review.query.options(joinedload(Review.author)), Review.id, Review.created_at,
+                                cursor=request.args.get('cursor'), per_page=ADMIN_STREAM_PER_PAGE)
+    return stream_page('admin/reviews.html', title='Модерация отзывов', reviews=all_reviews)
 
 @bp.route('/reviews/delete/<int:id>')
 @admin_required
@@ -221,55 +322,73 @@ def delete_review(id):
 def calendar():
     return render_template('admin/calendar.html', title='Календарь бронирований')
 
+def parse_calendar_date(value):
+    """Дата из параметров FullCalendar (ISO 8601, возможно со смещением) в наивное локальное время"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
 @bp.route('/api/events')
 @admin_required
+@conditional('orders', 'order_items', 'services')
 def get_events():
-    # Берем все заказы, кроме отмененных
-    orders = Order.query.filter(Order.status != 'cancelled').all()
-    events = []
-    
-    for order in orders:
-        # Вычисляем дату окончания (нужно для отрисовки блока в календаре)
-        duration = 60 # Дефолт
-        service_name = "Услуга"
-        
-        # Если есть услуги в заказе, берем реальную длительность
-        if order.items:
-            service = order.items[0].service
-            duration = service.duration
-            service_name = service.name
+    # FullCalendar запрашивает только видимый диапазон: ?start=...&end=...
+    start = parse_calendar_date(request.args.get('start'))
+    end = parse_calendar_date(request.args.get('end'))
+    if start is None or end is None:
+        # Без параметров отдаем текущую неделю, а не всю историю студии
+        start = datetime.combine(date.today() - timedelta(days=date.today().weekday()), datetime.min.time())
+        end = start + timedelta(days=7)
+    # Не даем запросить годы истории одним запросом
+    end = min(end, start + timedelta(days=MAX_EVENTS_RANGE_DAYS))
 
-        end_time = order.booking_datetime + timedelta(minutes=duration)
-        
-        # Выбираем цвет в зависимости от статуса
-        color = '#ffc107' # Желтый (pending)
-        if order.status == 'confirmed':
-            color = '#198754' # Зеленый
-        
+    # 1 запрос: заказы диапазона (по индексу) вместе с именами клиентов. Порядок - как в
+    # индексе ix_orders_status_booking, без сортировки: календарь сам раскладывает события
+    orders = db.session.query(
+        Order.id, Order.status, Order.booking_datetime, Order.booking_end, User.full_name
+    ).outerjoin(User, Order.user_id == User.id).filter(
+        *overlapping(start, end)
+    ).order_by(Order.status, Order.booking_datetime).all()
+
+    # 2 запрос: названия услуг сразу для всех заказов диапазона
+    service_names = {}
+    if orders:
+        items = db.session.query(OrderItem.order_id, Service.name).join(
+            Service, OrderItem.service_id == Service.id
+        ).filter(OrderItem.order_id.in_([o.id for o in orders])).order_by(OrderItem.order_id, OrderItem.id)
+        for order_id, name in items:
+            service_names.setdefault(order_id, name)
+
+    orders_url = url_for('admin.orders') # При клике переходим к таблице заказов
+    events = []
+    for order_id, status, booking_start, booking_end, client_name in orders:
+        # Выбираем цвет в зависимости от статуса: желтый (pending) или зеленый
         events.append({
-            'title': f"#{order.id} {service_name} ({order.client.full_name})",
-            'start': order.booking_datetime.isoformat(),
-            'end': end_time.isoformat(),
-            'url': url_for('admin.orders'), # При клике переходим к таблице заказов
-            'color': color,
-            'textColor': '#000' if order.status == 'pending' else '#fff'
+            'title': f"#{order_id} {service_names.get(order_id, 'Услуга')} ({client_name or ''})",
+            'start': booking_start.isoformat(),
+            'end': booking_end.isoformat(),
+            'url': orders_url,
+            'color': '#198754' if status == 'confirmed' else '#ffc107',
+            'textColor': '#000' if status == 'pending' else '#fff'
         })
-        
-    return jsonify(events)
+
+    # Без сортировки ключей и отступов, которые добавляет jsonify
+    return current_app.response_class(
+        json.dumps(events, ensure_ascii=False, separators=(',', ':')),
+        mimetype='application/json'
+    )
+
 # Добавьте этот код в app/admin/routes.py
 
 @bp.route('/orders/delete/<int:id>')
 @admin_required
 def delete_order(id):
     order = Order.query.get_or_404(id)
-    
-    # Сначала удаляем товары, привязанные к заказу (чтобы очистить связи)
-    for item in order.items:
-        db.session.delete(item)
-        
-    # Теперь удаляем сам заказ
-    db.session.delete(order)
-    db.session.commit()
+    # Удаляем позиции и сам заказ, освобождая его время в картах занятости
+    remove_order(order)
     
     flash('Заказ был безвозвратно удален.', 'success')
     return redirect(url_for('admin.orders'))
\ No newline at end of file
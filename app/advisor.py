@@ -0,0 +1,216 @@
+import json
+import re
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.engine import Engine
+from app import db
+from app.booking import find_conflict
+from app.cache import NullBackend
+from app.models import Category, Order, Service, User
+from app.profiler import statement_shape
+
+# Советник по индексам: flask index-advisor.
+# Проходит по горячим страницам приложения тестовым клиентом и вызывает проверку пересечений
+# броней, записывает все SELECT, которые при этом ушли в базу, и для каждой формы запроса
+# выполняет EXPLAIN (EXPLAIN QUERY PLAN в SQLite) на настроенной базе. В отчет попадают
+# полные сканы таблиц и сортировки без индекса.
+
+# Маленькие справочники, полный скан которых нормален
+SMALL_TABLES = ('categories', 'alembic_version')
+
+
+class Capture:
+    """Записывает SELECT с параметрами, сгруппированные по форме запроса"""
+
+    def __init__(self):
+        self.statements = {} # форма -> (текст, параметры, множество источников)
+        self.source = None
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.source is None or executemany or not statement.lstrip().upper().startswith('SELECT'):
+            return
+        shape = statement_shape(statement)
+        if shape not in self.statements:
+            self.statements[shape] = (statement, parameters, set())
+        self.statements[shape][2].add(self.source)
+
+
+def sample_ids():
+    """Существующие id для подстановки в URL: первая категория, услуга, клиент и администратор"""
+    first = lambda column, *where: db.session.execute(select(column).where(*where).limit(1)).scalar()
+    return {
+        'category': first(Category.id),
+        'service': first(Service.id),
+        'client': first(User.id, User.role == 'client'),
+        'admin': first(User.id, User.role == 'admin'),
+        'booking': first(Order.booking_datetime, Order.booking_datetime.isnot(None)),
+    }
+
+
+def hot_paths(ids):
+    """(роль, URL) горячих страниц; страницы без нужных данных пропускаются"""
+    today = date.today()
+    monday = today - timedelta(days=today.weekday())
+    paths = [
+        (None, '/'),
+        (None, '/catalog'),
+        (None, '/portfolio'),
+        (None, '/reviews'),
+        ('client', '/my_orders'),
+        ('admin', '/admin/orders'),
+        ('admin', '/admin/services'),
+        ('admin', '/admin/reviews'),
+        ('admin', '/admin/portfolio'),
+        ('admin', f'/admin/api/events?start={monday.isoformat()}&end={(monday + timedelta(days=7)).isoformat()}'),
+    ]
+    if ids['category']:
+        paths.append((None, f"/catalog?category_id={ids['category']}"))
+    if ids['service']:
+        paths.append((None, f"/services/{ids['service']}"))
+        paths.append((None, f"/api/availability/{ids['service']}?month={today:%Y-%m}"))
+    return paths
+
+
+def capture_statements(capture):
+    """Прогоняет горячие пути и собирает запросы в capture; [(путь, код ответа), ...] не 200"""
+    ids = sample_ids()
+    app = current_app._get_current_object()
+    clients = {}
+    failed = []
+    for role, path in hot_paths(ids):
+        if role and not ids[role]:
+            continue
+        if role not in clients:
+            client = app.test_client()
+            if role:
+                # Входим без пароля: кладем id пользователя в сессию Flask-Login
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(ids[role])
+                    session['_fresh'] = True
+            clients[role] = client
+        capture.source = path
+        # Свой контекст приложения на запрос: иначе g (и с ним current_user) общий для всех.
+        # Тело читается целиком: потоковые страницы (stream_page) выбирают строки при выводе
+        with app.app_context():
+            response = clients[role].get(path)
+            response.get_data()
+            response.close()
+        if response.status_code != 200:
+            click.echo(f'  {path}: ответ {response.status_code}', err=True)
+            failed.append((path, response.status_code))
+
+    # Проверка пересечений при бронировании (book_service) - напрямую, без создания заказа
+    capture.source = 'reserve_slot: find_conflict'
+    start = ids['booking'] or datetime.combine(date.today(), datetime.min.time()).replace(hour=12)
+    find_conflict(start, start + timedelta(hours=1))
+    db.session.rollback()
+    # Удаление категории проверяет, есть ли в ней услуги
+    if ids['category']:
+        capture.source = 'admin.delete_category'
+        db.session.get(Category, ids['category']).services.limit(1).first()
+        db.session.rollback()
+    return failed
+
+
+def explain(conn, statement, parameters):
+    """План запроса в виде списка строк-словарей"""
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    result = conn.exec_driver_sql(prefix + statement, parameters)
+    return [dict(row._mapping) for row in result]
+
+
+def plan_problems(dialect, statement, plan, ignore):
+    """Полные сканы ('scan') и сортировки без индекса ('sort') в плане.
+
+    Возвращает список (вид, описание). Сортировка ограниченной выборки (страница заказов,
+    неделя календаря) обычно дешева, поэтому --fail срабатывает только на сканы. Скан
+    с LIMIT без WHERE останавливается на первых строках (например, выборка страницы по
+    индексу сортировки), поэтому проблемой не считается.
+    """
+    limited = re.search(r'\bLIMIT\b', statement, re.I) is not None
+    early_stop = limited and re.search(r'\bWHERE\b', statement, re.I) is None
+    problems = []
+    for row in plan:
+        if dialect == 'sqlite':
+            detail = row['detail']
+            if detail.startswith('SCAN '):
+                table = detail.split()[1]
+                if table in ignore or early_stop:
+                    continue
+                if 'INDEX' in detail:
+                    if not limited:
+                        problems.append(('scan', f'полный обход индекса: {detail}'))
+                else:
+                    problems.append(('scan', f'полный скан: {detail}'))
+            elif 'TEMP B-TREE' in detail:
+                problems.append(('sort', f'сортировка без индекса: {detail}'))
+        else:
+            table = row.get('table')
+            extra = row.get('Extra') or ''
+            if table in ignore:
+                continue
+            if row.get('type') == 'ALL' and not early_stop:
+                problems.append(('scan', f"полный скан {table} (~{row.get('rows')} строк)"))
+            elif row.get('type') == 'index' and not limited:
+                problems.append(('scan', f'полный обход индекса {row.get("key")} таблицы {table}'))
+            if 'Using filesort' in extra or 'Using temporary' in extra:
+                problems.append(('sort', f'{table}: {extra}'))
+    return problems
+
+
+@click.command('index-advisor')
+@click.option('--json', 'as_json', is_flag=True, help='Отчет в JSON')
+@click.option('--all', 'show_all', is_flag=True, help='Показывать и запросы без проблем')
+@click.option('--ignore', multiple=True, default=SMALL_TABLES, show_default=True, help='Таблицы, скан которых не считается проблемой')
+@click.option('--fail', is_flag=True, help='Код выхода 1, если найдены полные сканы (для CI)')
+def index_advisor_command(as_json, show_all, ignore, fail):
+    """Ищет запросы приложения, которые читают таблицы целиком.
+
+    Прогоняет горячие страницы на настроенной базе (нужны данные, например flask seed
+    generate) и выполняет EXPLAIN для каждой формы SELECT.
+    """
+    capture = Capture()
+    # Кэш страниц на время прогона выключаем, иначе часть запросов не дойдет до базы
+    page_cache = current_app.extensions['page_cache']
+    current_app.extensions['page_cache'] = NullBackend()
+    event.listen(Engine, 'before_cursor_execute', capture)
+    try:
+        capture_statements(capture)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', capture)
+        current_app.extensions['page_cache'] = page_cache
+
+    report = []
+    with db.engine.connect() as conn:
+        dialect = conn.dialect.name
+        for shape, (statement, parameters, sources) in capture.statements.items():
+            plan = explain(conn, statement, parameters)
+            problems = plan_problems(dialect, statement, plan, set(ignore))
+            if problems or show_all:
+                report.append({'statement': shape, 'sources': sorted(sources),
+                               'full_scan': any(kind == 'scan' for kind, _ in problems),
+                               'problems': [text for _, text in problems], 'plan': plan})
+
+    if as_json:
+        click.echo(json.dumps({'database': dialect, 'statements': len(capture.statements), 'report': report},
+                              ensure_ascii=False, indent=2, default=str))
+    else:
+        click.echo(f'{dialect}: проверено форм запросов - {len(capture.statements)}, с полными сканами - '
+                   f"{sum(1 for r in report if r['full_scan'])}, с сортировкой без индекса - "
+                   f"{sum(1 for r in report if r['problems'] and not r['full_scan'])}")
+        for item in report:
+            click.echo('')
+            click.echo(item['statement'])
+            click.echo('  откуда: ' + ', '.join(item['sources']))
+            for problem in item['problems']:
+                click.echo('  ! ' + problem)
+            if not item['problems']:
+                click.echo('  ok')
+    if fail and any(r['full_scan'] for r in report):
+        raise SystemExit(1)
+
+
+def init_app(app):
+    app.cli.add_command(index_advisor_command)
@@ -0,0 +1,360 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+from urllib.parse import urljoin, urlsplit
+import click
+import requests
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import AppGroup
+from app.proxy import offload, offloaded
+from app.uploads import BLOB_PATH
+
+try:
+    import brotli
+except ImportError: # Без модуля brotli пишутся только .gz
+    brotli = None
+
+# Статика без сторонних CDN: flask assets vendor скачивает закрепленные версии библиотек в
+# static/vendor (вместе со шрифтами, на которые ссылается их CSS), flask assets build
+# собирает из них и css/style.css бандлы, дает всем файлам статики имена с хешем
+# содержимого в static/dist и пишет рядом .gz/.br. url_for('static', ...) подставляет
+# имена с хешем из манифеста, а такие файлы отдаются с Cache-Control: immutable на год.
+
+VENDOR_DIR = 'vendor'
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+LOCK = 'lock.json' # Хеши скачанных файлов: повторная загрузка должна дать те же байты
+
+# Локальный путь в static/vendor -> закрепленный URL
+VENDOR = {
+    'fonts/fonts.css': 'https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&family=Montserrat:wght@700;800;900&display=swap',
+    'bootstrap/bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'bootstrap/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+    'bootstrap-icons/bootstrap-icons.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.10.0/font/bootstrap-icons.css',
+    'aos/aos.css': 'https://unpkg.com/aos@2.3.1/dist/aos.css',
+    'aos/aos.js': 'https://unpkg.com/aos@2.3.1/dist/aos.js',
+    'fullcalendar/index.global.min.js': 'https://cdn.jsdelivr.net/npm/fullcalendar@6.1.8/index.global.min.js',
+}
+
+# Бандл -> файлы статики в порядке подключения
+BUNDLES = {
+    'site.css': ('vendor/fonts/fonts.css', 'vendor/bootstrap/bootstrap.min.css',
+                 'vendor/bootstrap-icons/bootstrap-icons.css', 'vendor/aos/aos.css', 'css/style.css'),
+    'site.js': ('vendor/bootstrap/bootstrap.bundle.min.js', 'vendor/aos/aos.js'),
+    'calendar.js': ('vendor/fullcalendar/index.global.min.js',),
+}
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+# Google Fonts отдает woff2 только современным браузерам
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def is_external(url):
+    return url.startswith(('data:', 'http:', 'https:', '//', '#'))
+
+
+def file_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+# --- Загрузка библиотек ---
+
+def download(url):
+    response = requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+def vendor_css(css, base_url, path):
+    """Ссылки url() в скачанном CSS: файлы для загрузки и текст со ссылками на локальные копии.
+
+    Относительные ссылки сохраняют свой путь, внешние (fonts.gstatic.com) кладутся
+    в files/ рядом с CSS. Возвращает (css, {путь в vendor: URL}).
+    """
+    files = {}
+    directory = posixpath.dirname(path)
+
+    def localize(match):
+        ref = match.group(2).strip()
+        if ref.startswith(('data:', '#')):
+            return match.group(0)
+        url = urljoin(base_url, ref)
+        if is_external(ref):
+            local = 'files/' + posixpath.basename(urlsplit(url).path)
+        else:
+            local = posixpath.normpath(urlsplit(ref).path)
+        files[posixpath.normpath(posixpath.join(directory, local))] = url
+        return f'url("{local}")'
+
+    return CSS_URL.sub(localize, css), files
+
+
+def vendor(static_folder, update=False):
+    """Скачивает VENDOR и их зависимости в static/vendor, сверяя хеши с lock.json"""
+    root = os.path.join(static_folder, VENDOR_DIR)
+    lock_path = os.path.join(root, LOCK)
+    lock = {}
+    if os.path.exists(lock_path):
+        with open(lock_path) as f:
+            lock = json.load(f)
+
+    queue = list(VENDOR.items())
+    fetched = 0
+    while queue:
+        path, url = queue.pop(0)
+        target = os.path.join(root, path)
+        pinned = lock.get(path)
+        if pinned and pinned['url'] == url and os.path.exists(target) and not update:
+            continue
+        data = download(url)
+        digest = file_hash(data)
+        if pinned and pinned['url'] == url and pinned['sha256'] != digest and not update:
+            raise click.ClickException(f'{url}: содержимое не совпадает с {LOCK} (обновить: --update)')
+        if path.endswith('.css'):
+            css, files = vendor_css(data.decode('utf-8'), url, path)
+            data = css.encode('utf-8')
+            queue.extend(files.items())
+        write_file(target, data)
+        lock[path] = {'url': url, 'sha256': digest}
+        fetched += 1
+        click.echo(f'  {path}')
+
+    write_file(lock_path, (json.dumps(lock, indent=2, sort_keys=True) + '\n').encode())
+    return fetched
+
+
+# --- Сборка ---
+
+def minify_css(css):
+    """Простая минификация CSS: комментарии и лишние пробелы"""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def rewrite_css(css, source, target, manifest):
+    """Переписывает url() файла source (путь в static) для файла target на имена с хешем"""
+    def fingerprinted(match):
+        ref = match.group(2).strip()
+        if is_external(ref):
+            return match.group(0)
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(source), urlsplit(ref).path))
+        if path not in manifest:
+            return match.group(0)
+        return f'url("{posixpath.relpath(manifest[path], posixpath.dirname(target))}")'
+    return CSS_URL.sub(fingerprinted, css)
+
+
+def static_files(static_folder, skip):
+    for directory, dirs, files in os.walk(static_folder):
+        rel_dir = os.path.relpath(directory, static_folder).replace(os.sep, '/')
+        if rel_dir.split('/')[0] in skip:
+            dirs[:] = []
+            continue
+        for name in sorted(files):
+            if name == LOCK or name.endswith(('.gz', '.br', '.tmp')):
+                continue
+            yield posixpath.normpath(posixpath.join(rel_dir, name))
+
+
+def fingerprint(path, data):
+    """dist/<путь>.<хеш>.<расширение>"""
+    stem, ext = posixpath.splitext(path)
+    return f'{DIST_DIR}/{stem}.{file_hash(data)[:10]}{ext}'
+
+
+def emit(static_folder, path, data):
+    """Пишет файл сборки и его сжатые копии (если они меньше оригинала)"""
+    target = os.path.join(static_folder, path)
+    if os.path.exists(target):
+        return # Имя с хешем: такой файл уже собран
+    write_file(target, data)
+    if not path.endswith(COMPRESSIBLE):
+        return
+    compressed = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressed['.br'] = brotli.compress(data, quality=11)
+    for suffix, packed in compressed.items():
+        if len(packed) < len(data):
+            write_file(target + suffix, packed)
+
+
+def build(static_folder):
+    """Собирает static/dist и возвращает манифест {исходный путь или бандл: путь в dist}"""
+    manifest = {}
+    sources = list(static_files(static_folder, skip=(DIST_DIR, 'uploads')))
+    read = lambda path: open(os.path.join(static_folder, path), 'rb').read()
+
+    # CSS ссылается на шрифты и картинки, поэтому собирается после них
+    for path in sorted(sources, key=lambda p: p.endswith('.css')):
+        data = read(path)
+        if path.endswith('.css'):
+            css = data.decode('utf-8')
+            if not path.endswith('.min.css'):
+                css = minify_css(css)
+            # Копия лежит в dist/<та же папка>, от нее и считаются относительные ссылки
+            data = rewrite_css(css, path, f'{DIST_DIR}/{path}', manifest).encode('utf-8')
+        target = fingerprint(path, data)
+        emit(static_folder, target, data)
+        manifest[path] = target
+
+    for name, parts in BUNDLES.items():
+        missing = [p for p in parts if p not in manifest]
+        if missing:
+            raise click.ClickException(f'{name}: нет файлов {", ".join(missing)} (сначала flask assets vendor)')
+        if name.endswith('.css'):
+            # Бандл лежит прямо в dist: ссылки переписываются от его места
+            chunks = []
+            for part in parts:
+                css = read(part).decode('utf-8')
+                if not part.endswith('.min.css'):
+                    css = minify_css(css)
+                chunks.append(rewrite_css(css, part, f'{DIST_DIR}/{name}', manifest))
+            data = '\n'.join(chunks).encode('utf-8')
+        else:
+            # Все скрипты бандлов уже минифицированы авторами; ';' защищает от склейки выражений
+            data = b'\n;\n'.join(read(part) for part in parts)
+        target = fingerprint(name, data)
+        emit(static_folder, target, data)
+        manifest[name] = target
+
+    write_file(os.path.join(static_folder, DIST_DIR, MANIFEST),
+               (json.dumps(manifest, indent=2, sort_keys=True) + '\n').encode())
+    return manifest
+
+
+def load_manifest(static_folder):
+    path = os.path.join(static_folder, DIST_DIR, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+# --- Отдача и шаблоны ---
+
+def fingerprint_static_url(endpoint, values):
+    """url_for('static', filename=...) -> имя с хешем, если файл есть в манифесте"""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = current_app.extensions['assets'].get(values['filename'], values['filename'])
+
+
+def bundle_urls(name):
+    """URL бандла; без сборки - его части по отдельности (локальные копии или CDN)"""
+    manifest = current_app.extensions['assets']
+    if name in manifest:
+        return [url_for('static', filename=name)]
+    urls = []
+    for part in BUNDLES[name]:
+        vendored = part[len(VENDOR_DIR) + 1:] if part.startswith(VENDOR_DIR + '/') else None
+        if vendored and not os.path.exists(os.path.join(current_app.static_folder, part)):
+            urls.append(VENDOR[vendored])
+        else:
+            urls.append(url_for('static', filename=part))
+    return urls
+
+
+def is_immutable(filename):
+    """Файлы, содержимое которых никогда не меняется под тем же именем"""
+    if filename.startswith(DIST_DIR + '/') and filename != f'{DIST_DIR}/{MANIFEST}':
+        return True
+    # Загрузки в хранилище по содержимому (app/uploads.py) и их уменьшенные копии
+    if filename.startswith('uploads/'):
+        path = filename[len('uploads/'):]
+        if path.startswith('derivatives/'):
+            path = re.sub(r'-\d+(\.\w+)$', r'\1', path[len('derivatives/'):])
+        return bool(BLOB_PATH.match(path))
+    return False
+
+
+def send_static(filename):
+    """Статика с готовыми .br/.gz копиями и immutable-заголовками для имен с хешем.
+
+    У таких файлов хеш содержимого уже в имени, поэтому ETag строится из имени, а не из
+    времени изменения файла: он одинаков на всех серверах, и 304 отдается без чтения файла.
+    """
+    folder = current_app.static_folder
+    if offloaded(filename):
+        # Тело файла отдаст фронт-прокси (app/proxy.py), здесь только заголовки
+        response = offload(folder, filename)
+        if is_immutable(filename):
+            response.headers['Cache-Control'] = IMMUTABLE
+        return response
+    if not is_immutable(filename):
+        return send_from_directory(folder, filename, max_age=current_app.get_send_file_max_age(filename))
+
+    encoding, suffix = None, ''
+    accepted = request.accept_encodings
+    for candidate, candidate_suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[candidate] and os.path.isfile(os.path.join(folder, filename + candidate_suffix)):
+            encoding, suffix = candidate, candidate_suffix
+            break
+    etag = posixpath.basename(filename) + suffix # У каждого представления свой строгий ETag
+
+    if request.if_none_match.contains_weak(etag): # Прослойка сжатия могла сделать ETag слабым
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+    else:
+        response = send_from_directory(folder, filename + suffix, etag=etag)
+        if encoding:
+            response.content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            if response.content_type.startswith('text/') or response.content_type.endswith(('javascript', 'json')):
+                response.content_type += '; charset=utf-8'
+            response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+assets_cli = AppGroup('assets', help='Сборка статики без сторонних CDN')
+
+
+@assets_cli.command('vendor')
+@click.option('--update', is_flag=True, help='Скачать заново и перезаписать хеши в lock.json')
+def vendor_command(update):
+    """Скачивает закрепленные версии Bootstrap, иконок, AOS, FullCalendar и шрифтов"""
+    fetched = vendor(current_app.static_folder, update=update)
+    click.echo(f'Скачано файлов: {fetched}')
+
+
+@assets_cli.command('build')
+@click.option('--clean', is_flag=True, help='Удалить прошлые сборки (старые страницы в кэше браузеров потеряют стили)')
+def build_command(clean):
+    """Собирает бандлы и копии статики с хешем в именах в static/dist"""
+    dist = os.path.join(current_app.static_folder, DIST_DIR)
+    if clean and os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = build(current_app.static_folder)
+    current_app.extensions['assets'] = manifest
+    if brotli is None:
+        click.echo('Модуль brotli не установлен: .br не созданы', err=True)
+    for name in BUNDLES:
+        size = os.path.getsize(os.path.join(current_app.static_folder, manifest[name]))
+        click.echo(f'{manifest[name]}: {size // 1024} КБ')
+    click.echo(f'Файлов в манифесте: {len(manifest)}')
+
+
+def init_app(app):
+    app.extensions['assets'] = load_manifest(app.static_folder)
+    app.url_defaults(fingerprint_static_url)
+    app.view_functions['static'] = send_static
+    app.add_template_global(bundle_urls)
+    app.cli.add_command(assets_cli)
@@ -0,0 +1,60 @@
+import calendar
+from datetime import date, datetime
+from app.booking import booking_duration, month_occupancy
+
+# Рабочее время студии для выдачи слотов (совпадает с сеткой календаря в админке)
+OPEN_MINUTE = 8 * 60
+CLOSE_MINUTE = 23 * 60
+SLOT_STEP = 30 # Шаг предлагаемого времени начала, мин.
+
+
+def format_minute(minute):
+    return f'{minute // 60:02d}:{minute % 60:02d}'
+
+
+def busy_intervals(bits):
+    """Отрезки занятых минут [(начало, конец), ...] по карте занятости дня"""
+    intervals = []
+    while bits:
+        start = (bits & -bits).bit_length() - 1
+        run = bits >> start
+        length = ((run + 1) & ~run).bit_length() - 1 # Число подряд идущих единиц
+        intervals.append((start, start + length))
+        bits &= ~(((1 << length) - 1) << start)
+    return intervals
+
+
+def free_starts(bits, duration, earliest=OPEN_MINUTE):
+    """Время начала (в минутах), с которого съемка длительностью duration помещается в свободное окно"""
+    first = max(earliest, OPEN_MINUTE)
+    first += -first % SLOT_STEP
+    mask = (1 << duration) - 1
+    return [t for t in range(first, CLOSE_MINUTE - duration + 1, SLOT_STEP) if not bits & (mask << t)]
+
+
+def month_availability(service, year, month, now=None):
+    """Занятые интервалы и свободное время начала для услуги на каждый день месяца"""
+    now = now or datetime.now()
+    days = [date(year, month, d) for d in range(1, calendar.monthrange(year, month)[1] + 1)]
+    bitmaps = month_occupancy(days)
+    duration = booking_duration(service)
+
+    result = {}
+    for day in days:
+        bits = bitmaps[day]
+        if day < now.date():
+            free = []
+        elif day == now.date():
+            free = free_starts(bits, duration, earliest=now.hour * 60 + now.minute + 1)
+        else:
+            free = free_starts(bits, duration)
+        result[day.isoformat()] = {
+            'busy': [[format_minute(s), format_minute(e)] for s, e in busy_intervals(bits)],
+            'free': [format_minute(t) for t in free]
+        }
+    return {
+        'service_id': service.id,
+        'duration': duration,
+        'month': f'{year:04d}-{month:02d}',
+        'days': result
+    }
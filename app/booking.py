@@ -0,0 +1,286 @@
+from datetime import date, datetime, time, timedelta
+from flask import current_app
+from sqlalchemy import update, insert, select
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Order, OrderItem, BookingDay, Service
+from app.replicas import force_primary, replica_engine
+
+# Статусы заказов, которые занимают время в студии
+ACTIVE_STATUSES = ('pending', 'confirmed', 'paid', 'completed')
+
+DEFAULT_DURATION = 60 # Длительность по умолчанию (мин.), если у услуги она не задана
+MAX_DURATION = 24 * 60 # Самая длинная съемка (мин.), ограничивает диапазон поиска по индексу
+MINUTES_PER_DAY = 24 * 60 # Размер карты занятости дня в битах (180 байт)
+
+
+class BookingConflict(Exception):
+    """Выбранное время пересекается с другой съемкой"""
+
+
+def in_booking_window(year, month, today=None):
+    """Открыт ли месяц для брони: от текущего до BOOKING_MONTHS_AHEAD месяцев вперед"""
+    today = today or date.today()
+    ahead = year * 12 + month - (today.year * 12 + today.month)
+    return 0 <= ahead <= current_app.config['BOOKING_MONTHS_AHEAD']
+
+
+def booking_duration(service):
+    """Длительность брони в минутах для услуги"""
+    return service.duration or DEFAULT_DURATION
+
+
+def booking_days(start, end):
+    """Календарные дни, которые задевает интервал [start, end)"""
+    day = start.date()
+    last = (end - timedelta(microseconds=1)).date()
+    days = []
+    while day <= last:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def overlapping(start, end):
+    """Условия выборки активных заказов, пересекающихся с интервалом [start, end).
+
+    Пересечение (StartA < EndB) and (EndA > StartB) проверяется по сохраненному booking_end,
+    а нижняя граница по booking_datetime превращает выборку в диапазон по индексу
+    ix_orders_status_booking вместо сканирования всей истории заказов до нужной даты.
+    """
+    return (
+        Order.status.in_(ACTIVE_STATUSES),
+        Order.booking_datetime < end,
+        Order.booking_datetime > start - timedelta(minutes=MAX_DURATION),
+        Order.booking_end > start
+    )
+
+
+def order_interval(order):
+    """Интервал [start, end) заказа; для старых заказов без booking_end - длительность по умолчанию"""
+    end = order.booking_end or order.booking_datetime + timedelta(minutes=DEFAULT_DURATION)
+    return order.booking_datetime, end
+
+
+def order_service_names(orders, connection=None):
+    """Названия услуг заказов страницы одним запросом: {order_id: [название, ...]}.
+
+    order.items - динамическая связь, и обход ее в шаблоне давал по два запроса на заказ.
+    connection - отдельное соединение, если соединение сессии занято (потоковая страница).
+    """
+    names = {order.id: [] for order in orders}
+    if names:
+        rows = (connection or db.session).execute(
+            select(OrderItem.order_id, Service.name)
+            .join(Service, OrderItem.service_id == Service.id)
+            .where(OrderItem.order_id.in_(names))
+            .order_by(OrderItem.order_id, OrderItem.id) # Порядок индекса ix_order_items_order_id
+        )
+        for order_id, name in rows:
+            names[order_id].append(name)
+    return names
+
+
+def find_conflict(start, end):
+    """Возвращает id заказа, который пересекается с интервалом [start, end), или None"""
+    row = db.session.query(Order.id).filter(*overlapping(start, end)).limit(1).first()
+    return row[0] if row else None
+
+
+def _create_days(days):
+    """Создает недостающие строки-замки в отдельных коротких транзакциях.
+
+    Вставка идет мимо основной сессии: тогда гонка двух первых броней нового дня
+    заканчивается ошибкой уникальности у одной из них, а не взаимоблокировкой.
+    """
+    for day in days:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(BookingDay.__table__).values(day=day, version=0))
+        except IntegrityError:
+            pass # Строку уже создал параллельный запрос
+
+
+def lock_days(start, end):
+    """Блокирует строки дней интервала [start, end) до конца текущей транзакции.
+
+    Любые два пересекающихся интервала имеют общий день, поэтому их брони сериализуются
+    на его строке, а брони в разные дни друг друга не ждут. Дни блокируются по возрастанию,
+    чтобы брони через полночь не создавали взаимоблокировок.
+    """
+    days = booking_days(start, end)
+    existing = {d for (d,) in db.session.query(BookingDay.day).filter(BookingDay.day.in_(days))}
+    missing = [d for d in days if d not in existing]
+    if missing:
+        _create_days(missing)
+
+    table = BookingDay.__table__
+    for day in days:
+        # UPDATE берет построчную блокировку (в SQLite - блокировку записи всей базы)
+        db.session.execute(update(table).where(table.c.day == day).values(version=table.c.version + 1))
+
+
+# --- Карты занятости дней ---
+
+def day_mask(day, start, end):
+    """Битовая маска минут дня day, которые занимает интервал [start, end)"""
+    day_start = datetime.combine(day, time.min)
+    first = max(0, int((start - day_start).total_seconds()) // 60)
+    last = min(MINUTES_PER_DAY, -(-int((end - day_start).total_seconds()) // 60))
+    if last <= first:
+        return 0
+    return ((1 << (last - first)) - 1) << first
+
+
+def pack_occupancy(bits):
+    return bits.to_bytes(MINUTES_PER_DAY // 8, 'little')
+
+
+def unpack_occupancy(data):
+    return int.from_bytes(data, 'little') if data else 0
+
+
+def occupancy_from_orders(days):
+    """Считает карты занятости дней по заказам: один запрос по индексу на весь диапазон"""
+    bitmaps = dict.fromkeys(days, 0)
+    if not days:
+        return bitmaps
+    range_start = datetime.combine(min(days), time.min)
+    range_end = datetime.combine(max(days) + timedelta(days=1), time.min)
+    orders = db.session.query(Order.booking_datetime, Order.booking_end).filter(*overlapping(range_start, range_end))
+    for start, end in orders:
+        for day in booking_days(start, end):
+            if day in bitmaps:
+                bitmaps[day] |= day_mask(day, start, end)
+    return bitmaps
+
+
+def _store_occupancy(bitmaps, only_missing=False):
+    table = BookingDay.__table__
+    for day, bits in bitmaps.items():
+        stmt = update(table).where(table.c.day == day).values(occupancy=pack_occupancy(bits))
+        if only_missing:
+            stmt = stmt.where(table.c.occupancy.is_(None))
+        db.session.execute(stmt)
+
+
+def occupy_days(start, end):
+    """Добавляет интервал [start, end) в карты занятости его дней. Дни должны быть заблокированы."""
+    days = booking_days(start, end)
+    table = BookingDay.__table__
+    stored = dict(db.session.execute(select(table.c.day, table.c.occupancy).where(table.c.day.in_(days))).all())
+    # Еще не посчитанные дни считаем по заказам целиком (новый заказ уже сброшен в базу)
+    bitmaps = occupancy_from_orders([d for d in days if stored.get(d) is None])
+    for day in days:
+        if day not in bitmaps:
+            bitmaps[day] = unpack_occupancy(stored[day]) | day_mask(day, start, end)
+    _store_occupancy(bitmaps)
+
+
+def rebuild_days(start, end):
+    """Пересчитывает карты занятости дней интервала по заказам. Дни должны быть заблокированы.
+
+    Используется при освобождении времени: простое снятие битов испортило бы карту,
+    если администратор вручную восстановил пересекающийся заказ.
+    """
+    _store_occupancy(occupancy_from_orders(booking_days(start, end)))
+
+
+def month_occupancy(days):
+    """Карты занятости для списка дней: {day: int}.
+
+    Берет сохраненные карты одним запросом, недостающие считает по заказам. Сохраняются
+    они только в уже существующие строки дней и только туда, где карта все еще NULL, чтобы
+    не затереть результат параллельной брони. Строки новых дней создает только бронь
+    (lock_days): публичный GET не должен наполнять таблицу замков.
+    """
+    table = BookingDay.__table__
+    stored = dict(db.session.execute(select(table.c.day, table.c.occupancy).where(table.c.day.in_(days))).all())
+    bitmaps = {day: unpack_occupancy(stored[day]) for day in days if stored.get(day) is not None}
+    missing = [day for day in days if day not in bitmaps]
+    if any(day in stored for day in missing) and replica_engine() is not None:
+        # Сохраняемые карты считаются только по основной базе: заказы с отстающей реплики
+        # дали бы пустые карты для уже занятых дней (app/replicas.py)
+        force_primary()
+        stored.update(db.session.execute(select(table.c.day, table.c.occupancy).where(table.c.day.in_(missing))).all())
+        bitmaps.update((day, unpack_occupancy(stored[day])) for day in missing if stored.get(day) is not None)
+        missing = [day for day in days if day not in bitmaps]
+    if missing:
+        computed = occupancy_from_orders(missing)
+        unsaved = {day: bits for day, bits in computed.items() if day in stored}
+        if unsaved:
+            _store_occupancy(unsaved, only_missing=True)
+            db.session.commit()
+        bitmaps.update(computed)
+    return bitmaps
+
+
+# --- Операции с заказами ---
+
+def reserve_slot(client, service, start):
+    """Атомарно бронирует время съемки и возвращает созданный заказ.
+
+    Блокирует дни брони, проверяет пересечения и создает заказ в одной транзакции,
+    после чего коммитит ее. При пересечении транзакция откатывается и бросается BookingConflict.
+    Проверка видит заказы, закоммиченные конкурентами до получения блокировки, только при
+    уровне изоляции READ COMMITTED (см. SQLALCHEMY_ENGINE_OPTIONS в config.py).
+    """
+    # Длительность фиксируется в заказе, чтобы последующая правка услуги не сдвигала старые брони
+    duration = booking_duration(service)
+    end = start + timedelta(minutes=duration)
+
+    lock_days(start, end)
+    if find_conflict(start, end) is not None:
+        db.session.rollback()
+        raise BookingConflict()
+
+    order = Order(
+        client=client,
+        total_price=service.price,
+        booking_datetime=start,
+        booking_end=end,
+        status='pending'
+    )
+    db.session.add(order)
+    db.session.add(OrderItem(order=order, service=service, price=service.price, duration=duration))
+    db.session.flush()
+    occupy_days(start, end)
+    db.session.commit()
+    return order
+
+
+def change_status(order, new_status):
+    """Меняет статус заказа и обновляет карты занятости, если заказ занял или освободил время"""
+    was_active = order.status in ACTIVE_STATUSES
+    now_active = new_status in ACTIVE_STATUSES
+    if was_active == now_active or order.booking_datetime is None:
+        order.status = new_status
+        db.session.commit()
+        return
+
+    start, end = order_interval(order)
+    lock_days(start, end)
+    order.status = new_status
+    db.session.flush()
+    if now_active:
+        occupy_days(start, end)
+    else:
+        rebuild_days(start, end)
+    db.session.commit()
+
+
+def remove_order(order):
+    """Удаляет заказ вместе с позициями и освобождает его время в картах занятости"""
+    interval = order_interval(order) if order.booking_datetime and order.status in ACTIVE_STATUSES else None
+    if interval:
+        lock_days(*interval)
+
+    # Сначала удаляем позиции, привязанные к заказу (чтобы очистить связи)
+    for item in order.items:
+        db.session.delete(item)
+    db.session.delete(order)
+    db.session.flush()
+
+    if interval:
+        rebuild_days(*interval)
+    db.session.commit()
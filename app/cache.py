@@ -0,0 +1,297 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, session
+from flask_login import current_user
+from app.replicas import force_primary
+
+# Кэш готовых страниц и фрагментов. Публичные страницы меняются только когда администратор
+# правит услуги, категории, портфолио или отзывы, поэтому запись в кэше живет до изменения
+# ее таблиц (см. события в app/models.py), а TTL лишь страхует от правок мимо ORM.
+#
+# Сброс сделан через поколения: у каждой таблицы есть счетчик, и он входит в ключ записи.
+# Изменение таблицы увеличивает счетчик, и все зависящие от нее записи перестают находиться
+# сразу во всех воркерах (для общих бэкендов), а старые вытесняются сами по LRU/TTL.
+
+GENERATION_PREFIX = 'gen:'
+
+
+class MemoryBackend:
+    """LRU в памяти процесса. Быстрый, но у каждого воркера gunicorn свой кэш и свои поколения."""
+
+    shared = False # Поколения видны только этому процессу
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._data = OrderedDict() # key -> (истекает, значение)
+        self._counters = {} # Поколения хранятся отдельно: их вытеснение вернуло бы старые записи
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires and expires < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def counters(self, keys):
+        return [self._counters.get(key, 0) for key in keys]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.time() + ttl if ttl else 0, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class FileBackend:
+    """Кэш в каталоге на локальном диске (лучше tmpfs, например /dev/shm), общий для всех воркеров.
+
+    Запись идет во временный файл с последующим os.replace, поэтому читатель никогда
+    не видит недописанную запись. Счетчики поколений увеличиваются под flock.
+    """
+
+    shared = True
+
+    CLEANUP_EVERY = 200 # Раз в столько записей удаляем из каталога истекшие файлы
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires and expires < time.time():
+            return None
+        return value
+
+    def _write(self, path, value, ttl):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + ttl if ttl else 0, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        return self._read(self._path(key))
+
+    def counters(self, keys):
+        return [self.get(key) or 0 for key in keys]
+
+    def set(self, key, value, ttl):
+        self._write(self._path(key), value, ttl)
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY == 0:
+            self._cleanup()
+
+    def incr(self, key):
+        import fcntl
+        path = self._path(key)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            value = (self._read(path) or 0) + 1
+            self._write(path, value, 0)
+        return value
+
+    def _cleanup(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    expires, _ = pickle.load(f)
+                if expires and expires < now:
+                    os.remove(path)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class RedisBackend:
+    """Redis или совместимый сервер (Valkey, KeyDB) - общий кэш для всех воркеров и машин.
+
+    Записи ставятся с TTL, а счетчики поколений без него, поэтому при maxmemory-policy
+    volatile-lru сервер вытесняет только записи, но не счетчики.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix='photostudio:'):
+        import redis # Нужен только для этого бэкенда
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def counters(self, keys):
+        # Счетчики INCR хранятся в Redis числом, а не pickle
+        return [int(v or 0) for v in self.client.mget([self.prefix + key for key in keys])]
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), ex=ttl or None)
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class NullBackend:
+    """Кэш выключен"""
+
+    shared = False
+
+    def get(self, key):
+        return None
+
+    def counters(self, keys):
+        return [0] * len(keys)
+
+    def set(self, key, value, ttl):
+        pass
+
+    def incr(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+def create_backend(config):
+    kind = config['PAGE_CACHE_TYPE']
+    if kind == 'memory':
+        return MemoryBackend(config['PAGE_CACHE_SIZE'])
+    if kind == 'file':
+        return FileBackend(config['PAGE_CACHE_DIR'])
+    if kind == 'redis':
+        return RedisBackend(config['PAGE_CACHE_URL'])
+    if kind == 'null':
+        return NullBackend()
+    raise ValueError(f'Неизвестный PAGE_CACHE_TYPE: {kind}')
+
+
+def backend():
+    return current_app.extensions['page_cache']
+
+
+def invalidate(tags):
+    """Сбрасывает все записи, зависящие от таблиц tags (вызывается после коммита)"""
+    cache = backend()
+    for tag in tags:
+        cache.incr(GENERATION_PREFIX + tag)
+
+
+def _versioned_key(key, tags):
+    generations = backend().counters([GENERATION_PREFIX + tag for tag in tags])
+    return key + '|' + ','.join(f'{tag}={gen}' for tag, gen in zip(tags, generations))
+
+
+def auth_state():
+    """Вариант страницы: шапка отличается для гостя, клиента и администратора"""
+    if not current_user.is_authenticated:
+        return 'anon'
+    return current_user.role or 'client'
+
+
+def cached_fragment(name, tags, render):
+    """Возвращает закэшированный фрагмент или строит его вызовом render()"""
+    key = _versioned_key('fragment:' + name, tags)
+    value = backend().get(key)
+    if value is None:
+        force_primary() # Отстающая реплика оставила бы в кэше старые данные под новым поколением
+        value = render()
+        backend().set(key, value, current_app.config['PAGE_CACHE_TTL'])
+    return value
+
+
+def _store_stream(body, cache, key, mimetype, ttl):
+    """Отдает части потокового ответа и кладет тело в кэш, если оно отправлено целиком"""
+    parts = []
+    try:
+        for part in body:
+            parts.append(part if isinstance(part, bytes) else part.encode())
+            yield part
+        cache.set(key, (b''.join(parts), mimetype), ttl)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+
+def cached_page(*tags):
+    """Декоратор: кэширует ответ GET по пути, параметрам и состоянию входа.
+
+    tags - таблицы, от изменения которых зависит страница. Не кэшируются ответы
+    с flash-сообщениями в сессии (они выводятся в шапке) и любые ответы кроме 200.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            query = '&'.join(sorted(request.query_string.decode('latin-1').split('&')))
+            key = _versioned_key(f'page:{auth_state()}:{request.path}?{query}', tags)
+            cache = backend()
+            hit = cache.get(key)
+            if hit is not None:
+                body, mimetype = hit
+                response = current_app.response_class(body, mimetype=mimetype)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            # Страница попадет в кэш до следующего изменения: строим ее по основной базе, а не по реплике
+            force_primary()
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough and '_flashes' not in session:
+                ttl = current_app.config['PAGE_CACHE_TTL']
+                if response.is_streamed:
+                    # Потоковую страницу не собираем заранее: копия тела пишется в кэш по ходу отправки
+                    response.response = _store_stream(response.response, cache, key, response.mimetype, ttl)
+                else:
+                    cache.set(key, (response.get_data(), response.mimetype), ttl)
+                response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    app.extensions['page_cache'] = create_backend(app.config)
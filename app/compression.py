@@ -0,0 +1,198 @@
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError: # Без модуля brotli остается только gzip
+    brotli = None
+
+# WSGI-прослойка сжатия ответов: gunicorn в docker-compose отдает ответы напрямую, без прокси.
+# Тело сжимается по частям по мере того, как приложение его отдает: ни тело целиком, ни его
+# сжатая копия в памяти не собираются. Буферизуется только начало ответа до min_size, чтобы
+# не сжимать маленькие ответы. Картинки, уже сжатые ответы (готовые .br/.gz статики),
+# 206 и 304 пропускаются как есть.
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml',
+                      'application/manifest+json', 'image/svg+xml')
+SKIP_TYPES = ('text/event-stream',)
+FLUSH_SIZE = 16 * 1024 # Сколько байт входа копить перед сбросом сжатого блока клиенту
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliEncoder:
+    name = 'br'
+
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class CompressedBody:
+    """Итератор сжатого тела; close() передается исходному ответу, как требует WSGI"""
+
+    def __init__(self, head, chunks, app_iter, encoder):
+        self._head = head
+        self._chunks = chunks
+        self._app_iter = app_iter
+        self._encoder = encoder
+
+    def __iter__(self):
+        encoder = self._encoder
+        pending = 0
+        out = b''.join(encoder.compress(chunk) for chunk in self._head)
+        if self._head:
+            # Начало ответа (у потоковых страниц - шапка и навигация) уходит сразу, не дожидаясь FLUSH_SIZE
+            out += encoder.flush()
+        if out:
+            yield out
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            pending += len(chunk)
+            out = encoder.compress(chunk)
+            if pending >= FLUSH_SIZE:
+                # Потоковые страницы должны доходить до браузера частями, а не в самом конце
+                out += encoder.flush()
+                pending = 0
+            if out:
+                yield out
+        yield encoder.finish()
+
+    def close(self):
+        if hasattr(self._app_iter, 'close'):
+            self._app_iter.close()
+
+
+class PlainBody(CompressedBody):
+    """Несжатый ответ: уже прочитанное начало и остаток как есть"""
+
+    def __iter__(self):
+        yield from self._head
+        yield from self._chunks
+
+
+class CompressionMiddleware:
+    def __init__(self, app, level=6, brotli_quality=4, min_size=1024):
+        self.app = app
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+
+    def choose_encoder(self, environ):
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and accepted['br']:
+            return BrotliEncoder(self.brotli_quality)
+        if accepted['gzip']:
+            return GzipEncoder(self.level)
+        return None
+
+    def should_compress(self, environ, status, headers):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return False
+        code = int(status.split(' ', 1)[0])
+        if code < 200 or code in (204, 206, 304):
+            return False
+        if 'Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        content_type = headers.get('Content-Type', '')
+        if not content_type.startswith(COMPRESSIBLE_TYPES) or content_type.startswith(SKIP_TYPES):
+            return False
+        length = headers.get('Content-Length')
+        return length is None or int(length) >= self.min_size
+
+    def __call__(self, environ, start_response):
+        encoder = self.choose_encoder(environ)
+        if encoder is None:
+            return self.app(environ, start_response)
+
+        captured = {}
+
+        def capture_start_response(status, headers, exc_info=None):
+            if exc_info is not None and captured.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            captured['status'], captured['headers'] = status, headers
+            return lambda data: captured.setdefault('written', []).append(data)
+
+        app_iter = self.app(environ, capture_start_response)
+        chunks = iter(app_iter)
+        # Заголовки приходят не позже первой части тела
+        head = captured.pop('written', [])
+        if 'status' not in captured:
+            head.extend(self._first_chunk(chunks))
+        status, headers = captured['status'], Headers(captured['headers'])
+
+        if not self.should_compress(environ, status, headers):
+            captured['sent'] = True
+            start_response(status, headers.to_wsgi_list())
+            if not head:
+                return app_iter # Как есть: файлы через wsgi.file_wrapper сервер отдаст sendfile
+            return PlainBody(head, chunks, app_iter, None)
+
+        # Ответ без длины (поток): читаем начало до min_size, чтобы не сжимать мелочь
+        if 'Content-Length' not in headers:
+            size = sum(len(c) for c in head)
+            for chunk in chunks:
+                head.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            else:
+                headers['Content-Length'] = str(size)
+                captured['sent'] = True
+                start_response(status, headers.to_wsgi_list())
+                return PlainBody(head, iter(()), app_iter, None)
+
+        headers.remove('Content-Length')
+        headers['Content-Encoding'] = encoder.name
+        vary = headers.get('Vary')
+        if not vary:
+            headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            headers['Vary'] = vary + ', Accept-Encoding'
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            # Сжатое представление байт в байт отличается от исходного: строгий ETag становится слабым
+            headers['ETag'] = 'W/' + etag
+        captured['sent'] = True
+        start_response(status, headers.to_wsgi_list())
+        return CompressedBody(head, chunks, app_iter, encoder)
+
+    @staticmethod
+    def _first_chunk(chunks):
+        for chunk in chunks:
+            return [chunk]
+        return []
+
+
+def init_app(app):
+    if app.config['COMPRESSION']:
+        app.wsgi_app = CompressionMiddleware(
+            app.wsgi_app,
+            level=app.config['COMPRESSION_LEVEL'],
+            brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY'],
+            min_size=app.config['COMPRESSION_MIN_SIZE'],
+        )
@@ -0,0 +1,162 @@
+import hashlib
+import os
+import time
+from datetime import datetime
+from functools import wraps
+from itertools import chain
+from flask import current_app, request, session
+from flask_login import current_user
+from sqlalchemy import event, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import TableVersion
+from app.storage import storage
+
+# Условные GET: ETag и Last-Modified страниц строятся из счетчиков изменений таблиц
+# (table_versions), а не из тела ответа. Повторный запрос с If-None-Match получает 304
+# после одного запроса по первичному ключу - до основных запросов и рендера шаблона.
+# Счетчики лежат в базе, поэтому одинаковы для всех воркеров и не зависят от бэкенда кэша
+# страниц. Увеличиваются они отдельной короткой транзакцией после коммита изменений: в самой
+# транзакции записи общие строки 'orders' и 'order_items' выстроили бы в очередь все брони.
+# Страница, отрисованная между коммитом и увеличением счетчика, получит старый ETag и
+# обновится при следующей сверке.
+
+# Таблицы, по которым ведутся счетчики
+VERSIONED_TABLES = ('services', 'categories', 'portfolio', 'reviews', 'users', 'orders', 'order_items')
+TOUCHED_TABLES = 'touched_tables' # Ключ в session.info: таблицы, измененные в текущей транзакции
+
+
+def touch(connection, tables):
+    """Увеличивает счетчики таблиц tables в транзакции connection"""
+    table = TableVersion.__table__
+    now = datetime.utcnow()
+    for name in sorted(tables): # В одном порядке, чтобы транзакции не ждали друг друга по кругу
+        increment = update(table).where(table.c.name == name).values(version=table.c.version + 1, changed_at=now)
+        if connection.execute(increment).rowcount:
+            continue
+        try:
+            with connection.begin_nested():
+                connection.execute(insert(table).values(name=name, version=1, changed_at=now))
+        except IntegrityError:
+            connection.execute(increment)
+
+
+def remember_flushed_tables(session, flush_context):
+    """После flush: запоминает таблицы, в которых ORM что-то вставил, изменил или удалил"""
+    tables = {obj.__table__.name for obj in chain(session.new, session.deleted)}
+    tables.update(obj.__table__.name for obj in session.dirty if session.is_modified(obj, include_collections=False))
+    tables.intersection_update(VERSIONED_TABLES)
+    if tables:
+        session.info.setdefault(TOUCHED_TABLES, set()).update(tables)
+
+
+def touch_committed_tables(session):
+    """После коммита: счетчики запомненных таблиц, отдельной транзакцией"""
+    tables = session.info.pop(TOUCHED_TABLES, None)
+    if not tables:
+        return
+    try:
+        with db.engine.begin() as connection:
+            touch(connection, tables)
+    except Exception:
+        # Данные уже закоммичены: ETag отстанет до следующего изменения этих таблиц
+        current_app.logger.exception('Не удалось увеличить счетчики таблиц %s', sorted(tables))
+
+
+def forget_touched_tables(session, previous_transaction):
+    if not session.in_transaction(): # Откат точки сохранения счетчики не отменяет
+        session.info.pop(TOUCHED_TABLES, None)
+
+
+event.listen(db.session, 'after_flush', remember_flushed_tables)
+event.listen(db.session, 'after_commit', touch_committed_tables)
+event.listen(db.session, 'after_soft_rollback', forget_touched_tables)
+
+
+def release_id(app):
+    """Версия кода для ETag: после выкладки новых шаблонов или статики старые ETag не совпадут.
+
+    RELEASE из окружения (например, хеш коммита) или отпечаток шаблонов и манифеста статики -
+    одинаковый у всех воркеров одной выкладки.
+    """
+    if app.config.get('RELEASE'):
+        return app.config['RELEASE']
+    digest = hashlib.sha1()
+    for directory, dirs, files in sorted(os.walk(os.path.join(app.root_path, 'templates'))):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(directory, name))
+            digest.update(f'{directory}/{name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    digest.update(repr(sorted(app.extensions.get('assets', {}).items())).encode())
+    return digest.hexdigest()[:12]
+
+
+def validators(tables, csrf):
+    """(ETag, Last-Modified) текущего запроса"""
+    if current_user.is_authenticated:
+        # Шапка показывает имя и аватар: страница своя у каждого пользователя
+        variant = f'user:{current_user.id}:{current_user.role}'
+        tables = tuple(tables) + ('users',)
+    else:
+        variant = 'anon'
+    rows = db.session.execute(
+        select(TableVersion.name, TableVersion.version, TableVersion.changed_at)
+        .where(TableVersion.name.in_(set(tables)))
+    ).all()
+    versions = ','.join(f'{name}={version}' for name, version, _ in sorted(rows))
+    last_modified = max((changed_at for _, _, changed_at in rows), default=None)
+    parts = [current_app.extensions['release'], request.full_path, variant, versions]
+    if csrf:
+        # Подписанный CSRF-токен в форме истекает: страница из кэша браузера обновляется
+        # не реже чем раз в половину срока его жизни
+        limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+        parts.append(str(int(time.time()) // max(limit // 2, 1)))
+    epoch = storage().url_epoch()
+    if epoch is not None:
+        # Ссылки на фото в S3 подписываются на сутки вперед: страница с ними обновляется ежедневно
+        parts.append(f'urls:{epoch}')
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest(), last_modified
+
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True) # Тело может отличаться в мелочах (CSRF-токен), смысл - нет
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True # Браузер хранит страницу, но каждый раз сверяется
+    if current_user.is_authenticated:
+        response.cache_control.private = True
+    response.vary.add('Cookie')
+    return response
+
+
+def conditional(*tables, csrf=False):
+    """Декоратор: ETag/Last-Modified по счетчикам tables и 304 без выполнения view.
+
+    tables - таблицы, от которых зависит ответ; для вошедших пользователей добавляется users.
+    csrf=True для страниц с формой. Ставится над @cached_page, чтобы 304 не трогал и кэш.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or '_flashes' in session:
+                return view(*args, **kwargs)
+            etag, last_modified = validators(tables, csrf)
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                # Одной даты мало, чтобы отличить вариант страницы: только для гостей и без форм
+                not_modified = (request.if_modified_since is not None and last_modified is not None
+                                and not current_user.is_authenticated and not csrf
+                                and last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None))
+            if not_modified:
+                return set_validators(current_app.response_class(status=304), etag, last_modified)
+
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and '_flashes' not in session:
+                set_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    app.extensions['release'] = release_id(app)
@@ -2,9 +2,11 @@ from flask_login import current_user
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, FloatField, IntegerField, SelectField
-from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
+from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, NumberRange
 from wtforms.fields import DateField, TimeField
 from app.models import User
+from flask import current_app
+from app.booking import MAX_DURATION, in_booking_window
 from datetime import date
 
 class RegistrationForm(FlaskForm):
@@ -35,7 +37,7 @@ class ServiceForm(FlaskForm):
     name = StringField('Название услуги', validators=[DataRequired()])
     description = TextAreaField('Описание')
     price = FloatField('Цена (руб.)', validators=[DataRequired()])
-    duration = IntegerField('Длительность (мин.)', validators=[DataRequired()])
+    duration = IntegerField('Длительность (мин.)', validators=[DataRequired(), NumberRange(min=1, max=MAX_DURATION)])
     # coerce=int заставляет Flask воспринимать выбор как число (ID категории), а не строку
     category_id = SelectField('Категория', coerce=int, validators=[DataRequired()])
     submit = SubmitField('Сохранить')
@@ -54,6 +56,8 @@ class BookingForm(FlaskForm):
     def validate_date(self, field):
         if field.data < date.today():
             raise ValidationError('Нельзя забронировать дату в прошлом!')
+        if not in_booking_window(field.data.year, field.data.month):
+            raise ValidationError(f"Бронирование открыто на {current_app.config['BOOKING_MONTHS_AHEAD']} мес. вперед")
         
 class PortfolioForm(FlaskForm):
     title = StringField('Название', validators=[DataRequired()])
@@ -85,6 +89,10 @@ class ContactForm(FlaskForm):
     message = TextAreaField('Сообщение', validators=[DataRequired(), Length(min=10)])
     submit = SubmitField('Отправить')
 
+class PaymentForm(FlaskForm):
+    # Только CSRF-токен: заказ берется из URL
+    submit = SubmitField('Оплатить')
+
 class EditProfileForm(FlaskForm):
     full_name = StringField('ФИО', validators=[DataRequired()])
     email = StringField('Email', validators=[DataRequired(), Email()])
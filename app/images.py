@@ -0,0 +1,156 @@
+import os
+import logging
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from app.jobs import task
+from app.storage import storage, tmp_folder
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError: # Pillow не установлен - производные не строятся, шаблоны отдают оригинал
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = 'derivatives' # Префикс уменьшенных копий в хранилище
+QUALITY = {'webp': 80, 'avif': 55}
+MISSING_RECHECK = 30 # Через сколько секунд снова искать в хранилище еще не построенные копии
+
+_ready = {} # Кэш найденных в хранилище производных: (путь, формат) -> [(путь копии, ширина), ...]
+_missing = {} # (путь, формат) -> когда производных не оказалось (time.monotonic)
+
+
+def derivative_formats():
+    """Современные форматы, которые умеет кодировать установленный Pillow"""
+    if Image is None:
+        return []
+    return [fmt for fmt in ('avif', 'webp') if features.check(fmt)]
+
+
+def derivative_path(image_path, width, fmt):
+    """Путь производной в хранилище: derivatives/<имя>-<ширина>.<формат>"""
+    stem = os.path.splitext(image_path)[0]
+    return f'{DERIVATIVES_DIR}/{stem}-{width}.{fmt}'
+
+
+def render_derivatives(image_path, widths, formats):
+    """Строит уменьшенные копии оригинала во всех форматах и кладет их в хранилище"""
+    store = storage()
+    with store.local_copy(image_path) as source, Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        # Ширины больше оригинала не нужны, но хотя бы одна копия строится всегда
+        targets = [w for w in widths if w < image.width] or [min(widths)]
+        for width in targets:
+            resized = image.copy()
+            resized.thumbnail((width, width * 10), Image.LANCZOS)
+            for fmt in formats:
+                # Файл собирается во временной папке и попадает в хранилище целиком: недописанный не отдается
+                with tempfile.NamedTemporaryFile(dir=tmp_folder(), suffix='.' + fmt, delete=False) as tmp:
+                    resized.save(tmp, format=fmt.upper(), quality=QUALITY[fmt])
+                store.put_file(tmp.name, derivative_path(image_path, width, fmt))
+
+
+def generate_derivatives(app, image_path, widths, formats):
+    """render_derivatives для пула потоков flask rebuild-images: ошибка одного файла только в лог"""
+    with app.app_context():
+        try:
+            render_derivatives(image_path, widths, formats)
+        except Exception:
+            logger.exception('Не удалось построить производные для %s', image_path)
+
+
+@task(name='images.build_derivatives', max_attempts=3, timeout=600)
+def build_derivatives(image_path):
+    """Фоновое задание: производные только что загруженного файла"""
+    formats = derivative_formats()
+    if formats and storage().exists(image_path): # Файл могли удалить, пока задание ждало в очереди
+        render_derivatives(image_path, current_app.config['IMAGE_WIDTHS'], formats)
+
+
+def is_image(path):
+    """True, если файл открывается как изображение; без Pillow проверка пропускается"""
+    if Image is None:
+        return True
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except Exception:
+        return False
+    return True
+
+
+def schedule_derivatives(image_path):
+    """Ставит построение производных в очередь фоновых заданий (flask worker) и сразу возвращается"""
+    if not image_path or not derivative_formats():
+        return None
+    return build_derivatives.delay(image_path)
+
+
+def remove_derivatives(image_path):
+    """Удаляет все производные оригинала (при удалении файла)"""
+    for width in current_app.config['IMAGE_WIDTHS']:
+        for fmt in QUALITY:
+            storage().delete(derivative_path(image_path, width, fmt))
+    for key in [k for k in _ready if k[0] == image_path]:
+        del _ready[key]
+
+
+def upload_url(image_path):
+    """URL загруженного файла: в static/uploads или прямая ссылка на хранилище"""
+    return storage().url(image_path)
+
+
+def srcset(image_path, fmt):
+    """Значение srcset из уже построенных производных или пустая строка, если их еще нет"""
+    if not image_path:
+        return ''
+    store = storage()
+    key = (image_path, fmt)
+    if key in _ready:
+        # Ссылки строятся при каждом выводе: подписанные ссылки S3 со временем истекают
+        return ', '.join(f'{store.url(path)} {width}w' for path, width in _ready[key])
+    # В S3 каждая проверка - запрос к хранилищу: пока копии строятся, ищем их не чаще MISSING_RECHECK
+    if time.monotonic() - _missing.get(key, -MISSING_RECHECK) < MISSING_RECHECK:
+        return ''
+    found = []
+    for width in current_app.config['IMAGE_WIDTHS']:
+        path = derivative_path(image_path, width, fmt)
+        if store.exists(path):
+            found.append((path, width))
+    if not found:
+        _missing[key] = time.monotonic()
+        return ''
+    # Запоминаем только найденные: отсутствующие могут появиться, когда воркер достроит их
+    _ready[key] = found
+    _missing.pop(key, None)
+    return ', '.join(f'{store.url(path)} {width}w' for path, width in found)
+
+
+@click.command('rebuild-images')
+@click.option('--workers', default=4, help='Число потоков')
+def rebuild_images_command(workers):
+    """Строит производные для всех уже загруженных изображений."""
+    from app.models import Portfolio, Service, User
+    formats = derivative_formats()
+    if not formats:
+        raise click.ClickException('Pillow не установлен или не поддерживает WebP/AVIF')
+    paths = set()
+    for column in (Portfolio.image_path, Service.image_path, User.avatar_path):
+        paths.update(p for (p,) in column.class_.query.with_entities(column).filter(column.isnot(None)))
+    app = current_app._get_current_object()
+    widths = current_app.config['IMAGE_WIDTHS']
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path in paths:
+            pool.submit(generate_derivatives, app, path, widths, formats)
+    click.echo(f'Обработано изображений: {len(paths)}')
+
+
+def init_app(app):
+    app.add_template_global(upload_url)
+    app.add_template_global(srcset)
+    app.cli.add_command(rebuild_images_command)
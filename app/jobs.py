@@ -0,0 +1,265 @@
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, or_, select, update
+from app import db
+
+# Фоновые задания: очередь в таблице jobs и воркер flask worker.
+#
+# Функция с декоратором @task выполняется как обычно при прямом вызове, а task.delay(...)
+# ставит вызов в очередь и сразу возвращается. Воркер (отдельный процесс или контейнер,
+# масштабируется независимо от gunicorn) берет задания в аренду на timeout секунд: если он
+# упадет посреди задания, по истечении аренды задание возьмет другой. Ошибка - повтор с
+# растущей задержкой, после max_attempts попыток задание остается в таблице со статусом
+# failed (flask jobs stats, flask jobs retry). Задание может выполниться больше одного
+# раза, поэтому задачи должны быть идемпотентными.
+#
+# Аргументы задач хранятся в JSON: передавайте id и пути, а не объекты моделей.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_TIMEOUT = 300 # Аренда задания, с: дольше самого долгого выполнения задачи
+RETRY_DELAY = 10 # Задержка первого повтора, с; дальше удваивается
+MAX_RETRY_DELAY = 3600
+BATCH_SIZE = 10 # Сколько готовых заданий воркер просматривает за раз
+PURGE_EVERY = 3600 # Как часто воркер удаляет старые выполненные задания, с
+
+_tasks = {} # имя -> Task
+
+
+class Task:
+    """Функция, которую может выполнить воркер"""
+
+    def __init__(self, func, name, max_attempts, timeout):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        """Ставит вызов в очередь и возвращает id задания.
+
+        Задание записывается отдельной короткой транзакцией и сразу видно воркерам, независимо
+        от того, закоммитит ли вызывающий свою. При JOBS_EAGER вызов выполняется на месте.
+        """
+        if current_app.config['JOBS_EAGER']:
+            self.func(*args, **kwargs)
+            return None
+        return enqueue(self.name, args, kwargs, self.max_attempts)
+
+
+def task(name=None, max_attempts=DEFAULT_MAX_ATTEMPTS, timeout=DEFAULT_TIMEOUT):
+    """Декоратор: регистрирует функцию как задачу. name по умолчанию - модуль.функция"""
+    def decorator(func):
+        registered = Task(func, name or f'{func.__module__}.{func.__name__}', max_attempts, timeout)
+        _tasks[registered.name] = registered
+        return registered
+    return decorator
+
+
+def enqueue(name, args=(), kwargs=None, max_attempts=DEFAULT_MAX_ATTEMPTS, run_at=None):
+    from app.models import Job
+    now = datetime.utcnow()
+    payload = json.dumps({'args': list(args), 'kwargs': kwargs or {}}, ensure_ascii=False)
+    with db.engine.begin() as conn:
+        result = conn.execute(insert(Job.__table__).values(
+            name=name, payload=payload, status='queued', attempts=0, max_attempts=max_attempts,
+            run_at=run_at or now, created_at=now
+        ))
+    return result.inserted_primary_key[0]
+
+
+# --- Воркер ---
+
+def claim_next(worker_id, now):
+    """Берет в аренду одно готовое задание; его id или None, если брать нечего"""
+    from app.models import Job
+    table = Job.__table__
+    free = or_(table.c.locked_until.is_(None), table.c.locked_until < now)
+    # running с истекшей арендой - задание упавшего воркера
+    waiting = table.c.status.in_(('queued', 'running'))
+    candidates = db.session.execute(
+        select(table.c.id, table.c.name).where(waiting, table.c.run_at <= now, free)
+        .order_by(table.c.run_at, table.c.id).limit(BATCH_SIZE)
+    ).all()
+    db.session.commit()
+    for job_id, name in candidates:
+        timeout = _tasks[name].timeout if name in _tasks else DEFAULT_TIMEOUT
+        taken = db.session.execute(
+            update(table).where(table.c.id == job_id, waiting, free)
+            .values(status='running', locked_by=worker_id, locked_until=now + timedelta(seconds=timeout),
+                    attempts=table.c.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if taken:
+            return job_id
+    return None
+
+
+def run_job(job_id, worker_id):
+    """Выполняет взятое задание и записывает результат"""
+    from app.models import Job
+    table = Job.__table__
+    job = db.session.get(Job, job_id)
+    name, attempts, max_attempts = job.name, job.attempts, job.max_attempts
+    payload = json.loads(job.payload)
+    db.session.commit() # Транзакция не держится открытой, пока выполняется задача
+
+    started = time.perf_counter()
+    values = {'locked_until': None}
+    try:
+        if name not in _tasks:
+            raise LookupError(f'неизвестная задача {name}')
+        if attempts > max_attempts:
+            raise RuntimeError('исчерпаны попытки: воркер не успевал завершить задание за время аренды')
+        _tasks[name].func(*payload['args'], **payload['kwargs'])
+    except Exception as e:
+        db.session.rollback()
+        retry = attempts < max_attempts and not isinstance(e, LookupError)
+        logger.exception('Задание %s (%s), попытка %s из %s', job_id, name, attempts, max_attempts)
+        values['error'] = f'{type(e).__name__}: {e}'[:255]
+        if retry:
+            delay = min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+            values.update(status='queued', run_at=datetime.utcnow() + timedelta(seconds=delay))
+        else:
+            values.update(status='failed', finished_at=datetime.utcnow())
+    else:
+        values.update(status='done', finished_at=datetime.utcnow(), error=None)
+        logger.info('Задание %s (%s) выполнено за %.2f с', job_id, name, time.perf_counter() - started)
+    # Если аренда истекла и задание уже взял другой воркер, его запись не трогаем
+    db.session.execute(update(table).where(table.c.id == job_id, table.c.locked_by == worker_id).values(**values))
+    db.session.commit()
+
+
+def purge(keep_days):
+    """Удаляет выполненные задания старше keep_days дней; failed остаются для разбора"""
+    from app.models import Job
+    table = Job.__table__
+    border = datetime.utcnow() - timedelta(days=keep_days)
+    deleted = db.session.execute(delete(table).where(table.c.status == 'done', table.c.finished_at < border)).rowcount
+    db.session.commit()
+    return deleted
+
+
+def work(app, stop, worker_id, interval, purges):
+    """Цикл одного потока воркера"""
+    next_purge = time.monotonic()
+    while not stop.is_set():
+        job_id = None
+        with app.app_context():
+            try:
+                job_id = claim_next(worker_id, datetime.utcnow())
+                if job_id is not None:
+                    run_job(job_id, worker_id)
+                if purges and time.monotonic() >= next_purge:
+                    purge(app.config['JOBS_KEEP_DAYS'])
+                    next_purge = time.monotonic() + PURGE_EVERY
+            except Exception: # База недоступна: пишем в лог и пробуем на следующем проходе
+                db.session.rollback()
+                logger.exception('Ошибка в воркере заданий')
+        if job_id is None:
+            stop.wait(interval)
+
+
+def run_threads(app, threads, interval, purges):
+    """Потоки воркера в текущем процессе; SIGTERM или Ctrl+C - завершить после текущих заданий"""
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop.set())
+    prefix = f'{socket.gethostname()}:{os.getpid()}'
+    workers = [threading.Thread(target=work, name=f'jobs-{n}', daemon=True,
+                                args=(app, stop, f'{prefix}:{n}', interval, purges and n == 0))
+               for n in range(max(threads, 1))]
+    for thread in workers:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in workers):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in workers:
+            thread.join()
+
+
+def run_process(app, threads, interval, purges):
+    # Соединения пула, унаследованные от родителя, в дочернем процессе использовать нельзя
+    with app.app_context():
+        db.engine.dispose(close=False)
+    run_threads(app, threads, interval, purges)
+
+
+@click.command('worker')
+@click.option('--threads', default=4, show_default=True, help='Потоков в процессе')
+@click.option('--processes', default=1, show_default=True, help='Процессов (для задач, которые грузят CPU)')
+@click.option('--interval', default=1.0, show_default=True, help='Пауза (с), когда заданий нет')
+def worker_command(threads, processes, interval):
+    """Выполняет фоновые задания из очереди"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(threadName)s %(levelname)s %(message)s')
+    app = current_app._get_current_object()
+    click.echo(f"Задачи: {', '.join(sorted(_tasks))}")
+    if processes <= 1:
+        run_threads(app, threads, interval, purges=True)
+        return
+    context = multiprocessing.get_context('fork')
+    children = [context.Process(target=run_process, name=f'worker-{n}', args=(app, threads, interval, n == 0))
+                for n in range(processes)]
+    for child in children:
+        child.start()
+    signal.signal(signal.SIGTERM, lambda *args: [child.terminate() for child in children])
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        for child in children:
+            child.join()
+
+
+jobs_cli = AppGroup('jobs', help='Очередь фоновых заданий')
+
+
+@jobs_cli.command('stats')
+def stats_command():
+    """Число заданий по задачам и статусам"""
+    from app.models import Job
+    rows = db.session.execute(
+        select(Job.name, Job.status, func.count()).group_by(Job.name, Job.status).order_by(Job.name, Job.status)
+    ).all()
+    for name, status, count in rows:
+        click.echo(f'{name:40} {status:8} {count}')
+    if not rows:
+        click.echo('Очередь пуста')
+
+
+@jobs_cli.command('retry')
+@click.argument('job_ids', nargs=-1, type=int)
+def retry_command(job_ids):
+    """Возвращает в очередь задания со статусом failed (все или перечисленные)"""
+    from app.models import Job
+    table = Job.__table__
+    where = [table.c.status == 'failed']
+    if job_ids:
+        where.append(table.c.id.in_(job_ids))
+    count = db.session.execute(update(table).where(*where).values(
+        status='queued', attempts=0, run_at=datetime.utcnow(), locked_until=None, finished_at=None
+    )).rowcount
+    db.session.commit()
+    click.echo(f'Возвращено в очередь: {count}')
+
+
+def init_app(app):
+    app.cli.add_command(worker_command)
+    app.cli.add_command(jobs_cli)
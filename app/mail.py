@@ -0,0 +1,34 @@
+import logging
+import smtplib
+from email.message import EmailMessage
+from flask import current_app
+from app.jobs import task
+
+# Отправка писем через SMTP из воркера (flask worker), а не из запроса: медленный или
+# недоступный почтовый сервер не задерживает ответ, а неудачная отправка повторяется.
+
+logger = logging.getLogger(__name__)
+
+SMTP_TIMEOUT = 30
+
+
+@task(name='mail.send')
+def send_mail(to, subject, body, reply_to=None):
+    """Фоновое задание: письмо через MAIL_SERVER; без него или без адресата - только в лог"""
+    config = current_app.config
+    if not config['MAIL_SERVER'] or not to:
+        logger.info('Письмо не отправлено (нет MAIL_SERVER или адресата): %s\n%s', subject, body)
+        return
+    message = EmailMessage()
+    message['From'] = config['MAIL_FROM']
+    message['To'] = to
+    message['Subject'] = subject
+    if reply_to:
+        message['Reply-To'] = reply_to
+    message.set_content(body)
+    with smtplib.SMTP(config['MAIL_SERVER'], config['MAIL_PORT'], timeout=SMTP_TIMEOUT) as smtp:
+        if config['MAIL_USE_TLS']:
+            smtp.starttls()
+        if config['MAIL_USERNAME']:
+            smtp.login(config['MAIL_USERNAME'], config['MAIL_PASSWORD'])
+        smtp.send_message(message)
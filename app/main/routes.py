@@ -1,16 +1,29 @@
-from datetime import datetime, timedelta
-from flask import render_template, flash, redirect, url_for, request, current_app
+from datetime import date, datetime, timedelta
+from flask import render_template, flash, redirect, url_for, request, current_app, jsonify, abort
 from flask_login import current_user, login_required
 from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
 from app import db
+from app.booking import BookingConflict, in_booking_window, reserve_slot, order_service_names
+from app import payments
+from app.mail import send_mail
+from app.availability import month_availability
+from app.uploads import save_upload
+from app.pagination import keyset_paginate, keyset_stream
+from app.streaming import stream_page
+from app.cache import cached_page, cached_fragment
+from app.conditional import conditional
+from app.replicas import use_primary
 from flask import Blueprint
-from app.forms import ReviewForm, BookingForm
-from app.models import Service, Portfolio, Review, Order, OrderItem, User
+from app.forms import ReviewForm, BookingForm, PaymentForm
+from app.models import Service, Portfolio, Review, Order, OrderItem, User, Category
 
 bp = Blueprint('main', __name__)
 
 @bp.route('/')
 @bp.route('/index')
+@conditional('services', 'portfolio', 'reviews', 'users')
+@cached_page('services', 'portfolio', 'reviews', 'users')
 def index():
     services = Service.query.limit(3).all()
     portfolio = Portfolio.query.order_by(Portfolio.uploaded_at.desc()).limit(6).all()
@@ -19,125 +32,184 @@ def index():
 
 @bp.route('/services')
 @bp.route('/catalog')  # Also accept /catalog as an alias
+@conditional('services', 'categories')
+@cached_page('services', 'categories')
 def catalog():
-    services = Service.query.all()
-    return render_template('main/catalog.html', title='Услуги', services=services)
+    query = Service.query
+    active_category = None
+    category_id = request.args.get('category_id', type=int)
+    if category_id:
+        active_category = Category.query.get_or_404(category_id)
+        query = query.filter(Service.category_id == category_id)
+    services = keyset_paginate(query, Service.id, cursor=request.args.get('cursor'), descending=False)
+    categories = Category.query.all()
+    return render_template('main/catalog.html', title='Услуги', services=services,
+                           categories=categories, active_category=active_category)
+
+@bp.route('/services/<int:id>')
+@conditional('services', 'categories')
+@cached_page('services', 'categories')
+def service_detail(id):
+    service = Service.query.get_or_404(id)
+    return render_template('main/service_detail.html', title=service.name, service=service)
+
+def portfolio_page():
+    """Страница работ по курсору из ?cursor= (новые сверху, по индексу uploaded_at)"""
+    query = Portfolio.query.options(joinedload(Portfolio.category))
+    return keyset_paginate(query, Portfolio.id, Portfolio.uploaded_at, cursor=request.args.get('cursor'))
 
 @bp.route('/portfolio')
+@conditional('portfolio', 'categories')
+@cached_page('portfolio', 'categories')
 def portfolio():
-    items = Portfolio.query.order_by(Portfolio.uploaded_at.desc()).all()
-    return render_template('main/portfolio.html', title='Портфолио', items=items)
+    # Потоком: шапка уходит сразу, плитки - по мере чтения из курсора базы
+    works = keyset_stream(Portfolio.query.options(joinedload(Portfolio.category)), Portfolio.id,
+                          Portfolio.uploaded_at, cursor=request.args.get('cursor'))
+    categories = Category.query.all()
+    return stream_page('main/portfolio.html', title='Портфолио', works=works, categories=categories)
+
+@bp.route('/api/portfolio')
+@conditional('portfolio', 'categories')
+def portfolio_feed():
+    # Следующая страница для бесконечной прокрутки: готовые плитки и курсор дальше.
+    # Плитки не зависят от входа, поэтому фрагмент общий для всех посетителей.
+    def render():
+        works = portfolio_page()
+        return render_template('main/_portfolio_items.html', works=works), works.next_cursor
+    cursor = request.args.get('cursor', '')
+    html, next_cursor = cached_fragment('portfolio-feed:' + cursor, ('portfolio', 'categories'), render)
+    return jsonify(html=html, next=next_cursor)
 
 @bp.route('/reviews', methods=['GET', 'POST'])
+@conditional('reviews', 'users', csrf=True)
 def reviews():
     form = ReviewForm()
     if form.validate_on_submit():
         if not current_user.is_authenticated:
             flash('Войдите, чтобы оставить отзыв', 'warning')
             return redirect(url_for('auth.login'))
-        review = Review(body=form.body.data, rating=form.rating.data, author=current_user)
+        review = Review(body=form.comment.data, rating=form.rating.data, author=current_user.record)
         db.session.add(review)
         db.session.commit()
         flash('Ваш отзыв опубликован!', 'success')
         return redirect(url_for('main.reviews'))
-    page = request.args.get('page', 1, type=int)
-    reviews = Review.query.order_by(Review.created_at.desc()).paginate(page=page, per_page=10, error_out=False)
+    reviews = keyset_paginate(Review.query.options(joinedload(Review.author)), Review.id, Review.created_at,
+                              cursor=request.args.get('cursor'), per_page=10)
     return render_template('main/reviews.html', title='Отзывы', reviews=reviews, form=form)
 
 @bp.route('/book/<int:service_id>', methods=['GET', 'POST'])
 @login_required
+@use_primary # Бронь проверяется по основной базе; свободные слоты отдает /api/availability
 def book_service(service_id):
     service = Service.query.get_or_404(service_id)
     form = BookingForm()
     
     if form.validate_on_submit():
         # Получаем дату и время из формы
-        booking_dt = form.booking_datetime.data
-        
-        # Рассчитываем время окончания желаемой брони
-        desired_end = booking_dt + timedelta(minutes=service.duration)
-        
-        # ОПТИМИЗАЦИЯ: Проверка пересечений на уровне SQL запроса
-        # Мы ищем заказы, которые НЕ отменены И у которых интервал времени пересекается с желаемым
-        # Логика пересечения: (StartA < EndB) and (EndA > StartB)
-        
-        # Поскольку у нас в Order нет поля end_time, нам нужно сделать join с Service,
-        # чтобы узнать длительность существующих заказов.
-        
-        # Вариант 1 (Сложный SQL): Join таблиц.
-        # Вариант 2 (Оптимальный для текущей структуры): 
-        # Фильтруем заказы за этот день и проверяем Python-ом, НО только за этот день (не всю базу).
-        # Ниже реализован Вариант 1 (более надежный), но с упрощением: 
-        # мы предполагаем, что длительность старых заказов берется из текущего состояния сервиса.
-        
-        existing_orders_on_date = Order.query.filter(
-            Order.status != 'cancelled',
-            # Оптимизация: берем заказы только в радиусе +/- 4 часа от желаемого времени,
-            # чтобы не тянуть лишнее
-            Order.booking_datetime >= booking_dt - timedelta(hours=5),
-            Order.booking_datetime <= booking_dt + timedelta(hours=5)
-        ).all()
-        
-        conflict = False
-        for order in existing_orders_on_date:
-            # Получаем длительность заказанного сервиса
-            # (используем lazy loading или joinedload в идеале, но пока так)
-            ordered_service_duration = 0
-            # Ищем сервис через items (немного костыльно из-за структуры OrderItem, но работает)
-            if order.items.count() > 0:
-                item = order.items.first()
-                if item.service:
-                    ordered_service_duration = item.service.duration
-            
-            # Если длительность не нашли, берем стандартную 60 мин
-            if ordered_service_duration == 0: 
-                ordered_service_duration = 60
-                
-            order_start = order.booking_datetime
-            order_end = order_start + timedelta(minutes=ordered_service_duration)
-            
-            # Проверка пересечения интервалов
-            if booking_dt < order_end and desired_end > order_start:
-                conflict = True
-                break
+        booking_dt = datetime.combine(form.date.data, form.time.data)
         
-        if conflict:
+        # Проверка пересечений и создание заказа выполняются атомарно под блокировкой дня,
+        # поэтому два параллельных запроса не могут занять одно и то же время
+        try:
+            order = reserve_slot(current_user.record, service, booking_dt)
+        except BookingConflict:
             flash('К сожалению, это время уже занято или пересекается с другой съемкой. Пожалуйста, выберите другое время.', 'danger')
         else:
-            # Создаем заказ
-            order = Order(
-                client=current_user,
-                total_price=service.price,
-                booking_datetime=booking_dt,
-                status='pending'
-            )
-            db.session.add(order)
-            db.session.flush() # Чтобы получить order.id
-            
-            item = OrderItem(order=order, service=service, price=service.price)
-            db.session.add(item)
-            
-            db.session.commit()
-            
-            # Здесь можно добавить логику перенаправления на оплату (ЮKassa)
             flash(f'Заказ создан! Пожалуйста, оплатите его. Номер заказа: {order.id}', 'success')
+            if current_app.config['YOOKASSA_SHOP_ID']:
+                # Сразу к оплате: платеж в ЮKassa создаст воркер, страница оплаты его дождется
+                payments.start_payment(order, url_for('main.check_payment', order_id=order.id, returned=1, _external=True))
+                return redirect(url_for('main.check_payment', order_id=order.id))
             return redirect(url_for('main.user_orders')) # Предполагаем наличие страницы заказов пользователя
 
     return render_template('main/booking.html', title=f'Бронирование: {service.name}', service=service, form=form)
 
+@bp.route('/api/availability/<int:service_id>')
+def availability(service_id):
+    # Свободное время для услуги на месяц: ?month=YYYY-MM (по умолчанию текущий).
+    # Только месяцы, открытые для брони: остальные - 400
+    service = Service.query.get_or_404(service_id)
+    today = date.today()
+    try:
+        year, month = (int(part) for part in request.args.get('month', f'{today:%Y-%m}').split('-'))
+        date(year, month, 1)
+    except ValueError:
+        abort(400)
+    if not in_booking_window(year, month, today):
+        abort(400)
+    return jsonify(month_availability(service, year, month))
+
 @bp.route('/my_orders')
 @login_required
 def user_orders():
-    orders = current_user.orders.order_by(Order.booking_datetime.desc()).all()
-    return render_template('main/user_orders.html', title='Мои заказы', orders=orders)
+    orders = keyset_paginate(current_user.record.orders, Order.id, Order.booking_datetime, cursor=request.args.get('cursor'))
+    return render_template('main/user_orders.html', title='Мои заказы', orders=orders,
+                           service_names=order_service_names(orders), pay_form=PaymentForm(),
+                           payable_statuses=payments.PAYABLE_STATUSES)
+
+def own_order_or_404(order_id):
+    return Order.query.filter_by(id=order_id, user_id=current_user.id).first_or_404()
+
+@bp.route('/orders/<int:order_id>/pay', methods=['POST'])
+@login_required
+def pay_order(order_id):
+    order = own_order_or_404(order_id)
+    if not PaymentForm().validate_on_submit():
+        abort(400)
+    if order.status not in payments.PAYABLE_STATUSES:
+        flash(f'Заказ #{order.id} не ожидает оплаты', 'warning')
+        return redirect(url_for('main.user_orders'))
+    # Только запись о попытке оплаты: к ЮKassa обращается воркер, а не этот запрос
+    payments.start_payment(order, url_for('main.check_payment', order_id=order.id, returned=1, _external=True))
+    return redirect(url_for('main.check_payment', order_id=order.id))
+
+@bp.route('/orders/<int:order_id>/payment')
+@login_required
+@use_primary # Статус платежа меняет воркер, а не этот клиент: липкость после записи не поможет
+def check_payment(order_id):
+    # Страница ожидания: перезагружается, пока воркер создает платеж или обрабатывает уведомление.
+    # ?returned=1 - клиент вернулся со страницы ЮKassa, и обратно туда его не отправляем
+    order = own_order_or_404(order_id)
+    payment = payments.latest_payment(order.id)
+    if order.status == payments.PAID_STATUS:
+        flash(f'Заказ #{order.id} оплачен. Спасибо!', 'success')
+        return redirect(url_for('main.user_orders'))
+    if payment and payment.status == 'succeeded':
+        # Деньги списаны, но заказ уже не ждал оплаты (например, отменен): воркер его не менял
+        flash(f'Оплата заказа #{order.id} получена, но заказ уже не ожидал оплаты. '
+              'Мы проверим платеж вручную и свяжемся с вами.', 'warning')
+        return redirect(url_for('main.user_orders'))
+    if payment is None:
+        return redirect(url_for('main.user_orders'))
+    if payment.status in ('canceled', 'failed'):
+        flash(f'Оплата заказа #{order.id} не прошла. Попробуйте еще раз.', 'danger')
+        return redirect(url_for('main.user_orders'))
+    returned = request.args.get('returned') == '1'
+    if payment.confirmation_url and payment.status == 'pending' and not returned:
+        return redirect(payment.confirmation_url)
+    return render_template('main/payment.html', title='Оплата', order=order, payment=payment, returned=returned)
+
+@bp.route('/payments/webhook', methods=['POST'])
+@use_primary # Платеж уведомления ищется среди только что созданных воркером
+def payment_webhook():
+    # Уведомление только сохраняется: статус применит воркер, сверившись с API ЮKassa.
+    # Повторная доставка того же уведомления тоже получает 200, иначе ЮKassa будет повторять ее
+    if (request.content_length or 0) > payments.MAX_WEBHOOK_SIZE:
+        abort(413)
+    try:
+        payments.record_event(request.get_json(silent=True))
+    except ValueError:
+        abort(400)
+    return '', 200
 
 @bp.route('/contact', methods=['GET', 'POST'])
 def contact():
     from app.forms import ContactForm
     form = ContactForm()
     if form.validate_on_submit():
-        # Here you would typically send an email or store the message
-        # For now, just show a success message
+        # Письмо студии отправит фоновый воркер (app/mail.py), запрос его не ждет
+        send_mail.delay(current_app.config['CONTACT_EMAIL'], f'Сообщение с сайта от {form.name.data}',
+                        f'{form.name.data} <{form.email.data}>:\n\n{form.message.data}', reply_to=form.email.data)
         flash('Спасибо за сообщение! Мы свяжемся с вами в ближайшее время.', 'success')
         return redirect(url_for('main.contact'))
     return render_template('main/contact.html', title='Контакты', form=form)
@@ -148,21 +220,16 @@ def profile():
     from app.forms import EditProfileForm
     form = EditProfileForm()
     if form.validate_on_submit():
-        current_user.full_name = form.full_name.data
-        current_user.email = form.email.data
-        current_user.phone = form.phone.data
+        user = current_user.record # Модель, а не снимок из кэша (app/principal.py)
+        user.full_name = form.full_name.data
+        user.email = form.email.data
+        user.phone = form.phone.data
 
         # Handle avatar upload if provided
         if form.avatar.data:
-            import os
-            from werkzeug.utils import secure_filename
-            from flask import current_app
-
-            file = form.avatar.data
-            filename = secure_filename(file.filename)
-            # Save the file to the uploads folder
-            file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-            current_user.avatar_path = filename
+            # Save the file to the content-addressed upload store;
+            # the previous avatar is released by the model events
+            user.avatar_path = save_upload(form.avatar.data)
 
         db.session.commit()
         flash('Профиль обновлен!', 'success')
@@ -1,14 +1,18 @@
-import os
 from datetime import datetime
-from flask import current_app
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import event
+from sqlalchemy import event, inspect, update, insert, delete, select
+from sqlalchemy.exc import IntegrityError
 from app import db, login_manager
+from app.uploads import STORED_UPLOADS, is_blob_path, remove_unreferenced
+from app.images import schedule_derivatives
+from app.cache import invalidate
+from app.principal import load_principal, forget_principals
 
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # Снимок полей из кэша воркера вместо запроса к базе на каждый запрос (app/principal.py)
+    return load_principal(int(id))
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -24,6 +28,11 @@ class User(UserMixin, db.Model):
     orders = db.relationship('Order', backref='client', lazy='dynamic')
     reviews = db.relationship('Review', backref='author', lazy='dynamic')
 
+    @property
+    def record(self):
+        # current_user бывает и моделью, и снимком UserPrincipal (app/principal.py)
+        return self
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -38,7 +47,7 @@ class Service(db.Model):
     price = db.Column(db.Integer)
     duration = db.Column(db.Integer)  # Длительность в минутах
     image_path = db.Column(db.String(140)) # Путь к файлу
-    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), index=True)
     order_items = db.relationship('OrderItem', backref='service', lazy='dynamic')
 
 class Portfolio(db.Model):
@@ -56,7 +65,7 @@ class Review(db.Model):
     body = db.Column(db.Text)
     rating = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
 
 class Order(db.Model):
     __tablename__ = 'orders'
@@ -65,16 +74,39 @@ class Order(db.Model):
     status = db.Column(db.String(20), default='pending') # pending, paid, completed, cancelled
     total_price = db.Column(db.Integer)
     booking_datetime = db.Column(db.DateTime)
+    booking_end = db.Column(db.DateTime) # Окончание съемки (начало + длительность на момент брони)
     created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     payment_id = db.Column(db.String(100)) # ID платежа в ЮKassa
     items = db.relationship('OrderItem', backref='order', lazy='dynamic')
 
+    # Индексы под проверку пересечений (status IN (...) AND booking_datetime в диапазоне)
+    # и под список заказов клиента, отсортированный по дате съемки
+    __table_args__ = (
+        db.Index('ix_orders_status_booking', 'status', 'booking_datetime', 'booking_end'),
+        db.Index('ix_orders_user_booking', 'user_id', 'booking_datetime'),
+    )
+
 class OrderItem(db.Model):
     __tablename__ = 'order_items'
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('orders.id'))
-    service_id = db.Column(db.Integer, db.ForeignKey('services.id'))
+    service_id = db.Column(db.Integer, db.ForeignKey('services.id'), index=True)
     price = db.Column(db.Integer) # Фиксируем цену на момент заказа
+    duration = db.Column(db.Integer) # И длительность (мин.) на момент заказа
+
+    # Позиции заказов и названия услуг одним проходом по индексу; позиции нескольких
+    # заказов по порядку добавления - без сортировки (order_service_names)
+    __table_args__ = (
+        db.Index('ix_order_items_order_service', 'order_id', 'service_id'),
+        db.Index('ix_order_items_order_id', 'order_id', 'id'),
+    )
+
+class BookingDay(db.Model):
+    """Строка-замок календарного дня: брони, задевающие один день, выполняются по очереди"""
+    __tablename__ = 'booking_days'
+    day = db.Column(db.Date, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0) # Увеличивается при каждой брони этого дня
+    occupancy = db.Column(db.LargeBinary(180)) # Карта занятости: бит на минуту дня, NULL - еще не посчитана
 
 class Category(db.Model):
     __tablename__ = 'categories'
@@ -83,22 +115,255 @@ class Category(db.Model):
     services = db.relationship('Service', backref='category', lazy='dynamic')
     portfolio_items = db.relationship('Portfolio', backref='category', lazy='dynamic')
 
-# --- Event Listeners для очистки файлов ---
+class UploadBlob(db.Model):
+    """Файл в хранилище по содержимому (app/uploads.py) и число записей, которые на него ссылаются"""
+    __tablename__ = 'upload_blobs'
+    path = db.Column(db.String(140), primary_key=True)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+
+class TableVersion(db.Model):
+    """Счетчик изменений таблицы для ETag/Last-Modified страниц (app/conditional.py)"""
+    __tablename__ = 'table_versions'
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# --- Сводные таблицы для панели управления (app/stats.py) ---
+
+class StatsDay(db.Model):
+    """Заказы и выручка за день съемки (для заказов без даты - день создания) по статусу"""
+    __tablename__ = 'stats_days'
+    day = db.Column(db.Date, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+
+class StatsStatus(db.Model):
+    """Заказы и сумма по статусу за всю историю"""
+    __tablename__ = 'stats_statuses'
+    status = db.Column(db.String(20), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+
+class StatsService(db.Model):
+    """Позиции заказов и выручка по услуге и статусу заказа"""
+    __tablename__ = 'stats_services'
+    service_id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    items = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+
+class StatsRating(db.Model):
+    """Число отзывов с каждой оценкой"""
+    __tablename__ = 'stats_ratings'
+    rating = db.Column(db.Integer, primary_key=True)
+    reviews = db.Column(db.Integer, nullable=False, default=0)
+
+# --- Платежи ЮKassa (app/payments.py) ---
+
+class Payment(db.Model):
+    """Попытка оплаты заказа. Создается в запросе со статусом new, платеж в ЮKassa создает воркер"""
+    __tablename__ = 'payments'
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False, index=True)
+    provider_id = db.Column(db.String(100), unique=True) # ID платежа в ЮKassa
+    status = db.Column(db.String(30), nullable=False, default='new') # new, pending, waiting_for_capture, succeeded, canceled, failed
+    amount = db.Column(db.Integer, nullable=False)
+    idempotence_key = db.Column(db.String(64), nullable=False, unique=True) # Повтор создания не создаст второй платеж
+    confirmation_url = db.Column(db.String(500))
+    return_url = db.Column(db.String(500))
+    error = db.Column(db.String(255))
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    locked_until = db.Column(db.DateTime) # Аренда строки воркером; после нее строку может взять другой
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_payments_status_updated', 'status', 'updated_at'), # Очередь сверки (app/payments.py)
+    )
+
+class PaymentEvent(db.Model):
+    """Уведомление ЮKassa (webhook), сохраненное как есть до обработки воркером"""
+    __tablename__ = 'payment_events'
+    id = db.Column(db.Integer, primary_key=True)
+    event = db.Column(db.String(50), nullable=False) # payment.succeeded, payment.canceled ...
+    provider_id = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text)
+    received_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    locked_until = db.Column(db.DateTime)
+    error = db.Column(db.String(255))
+
+    # Повторная доставка того же уведомления не создает вторую запись
+    __table_args__ = (
+        db.UniqueConstraint('event', 'provider_id', name='uq_payment_events_event_provider'),
+        db.Index('ix_payment_events_processed', 'processed_at', 'id'),
+    )
+
+# --- Очередь фоновых заданий (app/jobs.py) ---
+
+class Job(db.Model):
+    """Вызов задачи, который выполнит flask worker"""
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False) # Имя задачи (@task)
+    payload = db.Column(db.Text, nullable=False) # Аргументы в JSON
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow) # Не раньше этого времени (повторы)
+    locked_by = db.Column(db.String(100)) # Воркер, взявший задание
+    locked_until = db.Column(db.DateTime) # Конец аренды; после него задание снова доступно
+    error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    # Выбор готовых заданий и очистка выполненных
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_status_finished', 'status', 'finished_at'),
+    )
+
+# --- Event Listeners для учета ссылок на файлы и их очистки ---
+
+RELEASED_UPLOADS = 'released_uploads' # Ключ в session.info: файлы, которые можно удалить после коммита
+
+def upload_attr(target):
+    """Имя колонки с путем к файлу у модели"""
+    return 'avatar_path' if isinstance(target, User) else 'image_path'
+
+def acquire_upload(connection, path):
+    """Увеличивает счетчик ссылок на файл (создает запись при первой ссылке)"""
+    table = UploadBlob.__table__
+    increment = update(table).where(table.c.path == path).values(refcount=table.c.refcount + 1)
+    if connection.execute(increment).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(insert(table).values(path=path, refcount=1))
+    except IntegrityError:
+        connection.execute(increment) # Запись успела создать параллельная загрузка
+
+def release_upload(connection, path):
+    """Уменьшает счетчик ссылок; на последней ссылке файл удаляется после коммита"""
+    table = UploadBlob.__table__
+    connection.execute(update(table).where(table.c.path == path).values(refcount=table.c.refcount - 1))
+    refcount = connection.execute(select(table.c.refcount).where(table.c.path == path)).scalar()
+    if refcount is not None and refcount <= 0:
+        connection.execute(delete(table).where(table.c.path == path, table.c.refcount <= 0))
+        db.session.info.setdefault(RELEASED_UPLOADS, set()).add(path)
+
+def acquire_file_on_insert(mapper, connection, target):
+    path = getattr(target, upload_attr(target))
+    if is_blob_path(path):
+        acquire_upload(connection, path)
+
+def swap_file_on_update(mapper, connection, target):
+    """Замена фото: ссылка переходит со старого файла на новый"""
+    history = inspect(target).attrs[upload_attr(target)].history
+    for path in history.added:
+        if is_blob_path(path):
+            acquire_upload(connection, path)
+    for path in history.deleted:
+        if is_blob_path(path):
+            release_upload(connection, path)
 
 def delete_file_on_delete(mapper, connection, target):
     """Функция для удаления файла при удалении записи из БД"""
-    if target.image_path:
-        # Получаем полный путь. Предполагается, что image_path хранится относительно папки uploads
-        # Или просто имя файла. Подстройте путь под вашу структуру (app/static/uploads)
+    path = getattr(target, upload_attr(target))
+    if is_blob_path(path):
+        # Файл удаляется, только если на него больше никто не ссылается
+        release_upload(connection, path)
+    elif path:
+        # Старые файлы под исходными именами учета ссылок не имеют - удаляем как раньше
+        db.session.info.setdefault(RELEASED_UPLOADS, set()).add(path)
+
+def remove_released_files(session):
+    """После коммита ставит в очередь удаление файлов, на которые не осталось ссылок"""
+    paths = session.info.pop(RELEASED_UPLOADS, None)
+    if paths:
+        # Удаление с диска (с уменьшенными копиями) выполняет flask worker, ссылки он проверит еще раз
+        try:
+            remove_unreferenced.delay(sorted(paths))
+        except Exception as e:
+            # Логируем ошибку, но не ломаем обработку запроса: файл останется лишним на диске
+            print(f"Error scheduling removal of {sorted(paths)}: {e}")
+
+def schedule_stored_derivatives(session):
+    """После коммита ставит в очередь уменьшенные копии новых файлов"""
+    for path in sorted(session.info.pop(STORED_UPLOADS, ())):
         try:
-            # Используем абсолютный путь или путь относительно корня приложения
-            file_path = os.path.join(current_app.root_path, 'static/uploads', target.image_path)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            schedule_derivatives(path)
         except Exception as e:
-            # Логируем ошибку, но не ломаем процесс удаления из БД
-            print(f"Error deleting file {target.image_path}: {e}")
+            # Страницы покажут оригинал без srcset, пока копии не построят заново
+            print(f"Error scheduling derivatives of {path}: {e}")
+
+def forget_released_files(session, previous_transaction):
+    if session.in_transaction():
+        return # Откат точки сохранения (begin_nested): внешняя транзакция еще может закоммититься
+    session.info.pop(RELEASED_UPLOADS, None)
+    session.info.pop(STORED_UPLOADS, None)
 
 # Регистрируем слушатели событий для моделей с файлами
-event.listen(Service, 'after_delete', delete_file_on_delete)
-event.listen(Portfolio, 'after_delete', delete_file_on_delete)
\ No newline at end of file
+for model in (Service, Portfolio, User):
+    event.listen(model, 'after_insert', acquire_file_on_insert)
+    event.listen(model, 'after_update', swap_file_on_update)
+    event.listen(model, 'after_delete', delete_file_on_delete)
+event.listen(db.session, 'after_commit', remove_released_files)
+event.listen(db.session, 'after_commit', schedule_stored_derivatives)
+event.listen(db.session, 'after_soft_rollback', forget_released_files)
+
+
+# --- Event Listeners для сброса кэша страниц (app/cache.py) ---
+
+CHANGED_TABLES = 'changed_tables' # Ключ в session.info: таблицы, измененные в текущей транзакции
+
+def mark_table_changed(mapper, connection, target):
+    """Запоминает таблицу измененной записи; кэш сбрасывается только после коммита"""
+    db.session.info.setdefault(CHANGED_TABLES, set()).add(mapper.local_table.name)
+
+def mark_table_updated(mapper, connection, target):
+    # after_update вызывается и для записей без реальных изменений колонок
+    state = inspect(target)
+    if any(state.attrs[attr.key].history.has_changes() for attr in mapper.column_attrs):
+        mark_table_changed(mapper, connection, target)
+
+def invalidate_changed_tables(session):
+    tables = session.info.pop(CHANGED_TABLES, None)
+    if tables:
+        invalidate(tables)
+
+def forget_changed_tables(session, previous_transaction):
+    if session.in_transaction():
+        return # Откат точки сохранения: изменения внешней транзакции еще будут закоммичены
+    session.info.pop(CHANGED_TABLES, None)
+
+CHANGED_USERS = 'changed_users' # Ключ в session.info: id пользователей, чьи снимки устарели
+
+def mark_user_changed(mapper, connection, target):
+    db.session.info.setdefault(CHANGED_USERS, set()).add(target.id)
+
+def forget_changed_users(session):
+    user_ids = session.info.pop(CHANGED_USERS, None)
+    if user_ids:
+        forget_principals(user_ids)
+
+def forget_changed_users_on_rollback(session, previous_transaction):
+    if session.in_transaction():
+        return # Откат точки сохранения: изменения пользователей еще будут закоммичены
+    session.info.pop(CHANGED_USERS, None)
+
+# Данные публичных страниц: услуги, категории, портфолио, отзывы и их авторы
+for model in (Service, Portfolio, Review, Category, User):
+    event.listen(model, 'after_insert', mark_table_changed)
+    event.listen(model, 'after_update', mark_table_updated)
+    event.listen(model, 'after_delete', mark_table_changed)
+event.listen(db.session, 'after_commit', invalidate_changed_tables)
+event.listen(db.session, 'after_soft_rollback', forget_changed_tables)
+
+# Снимки пользователей для current_user (app/principal.py): профиль, роль, удаление
+event.listen(User, 'after_update', mark_user_changed)
+event.listen(User, 'after_delete', mark_user_changed)
+event.listen(db.session, 'after_commit', forget_changed_users)
+event.listen(db.session, 'after_soft_rollback', forget_changed_users_on_rollback)
@@ -0,0 +1,183 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from itertools import islice
+from sqlalchemy import and_, or_
+
+DEFAULT_PER_PAGE = 24
+STREAM_BATCH_SIZE = 100 # Сколько строк потоковой страницы держать в памяти одновременно
+
+
+class KeysetPage:
+    """Страница выборки с курсорной (keyset) пагинацией.
+
+    В отличие от OFFSET, следующая страница начинается с условия "после последней строки"
+    по индексу, поэтому ее стоимость не растет с номером страницы и размером таблицы.
+    """
+
+    def __init__(self, items, cursor, next_cursor):
+        self.items = items
+        self.cursor = cursor # Курсор текущей страницы (None - первая страница)
+        self.next_cursor = next_cursor # Курсор следующей страницы (None - страниц больше нет)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Значения ключа последней строки -> непрозрачная строка для URL"""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Строка курсора -> значения ключа; None, если курсор испорчен"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != len(columns):
+        return None
+    decoded = []
+    for column, value in zip(columns, values):
+        if value is not None and column.type.python_type is datetime:
+            try:
+                value = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                return None
+        decoded.append(value)
+    return decoded
+
+
+def _after(sort_column, id_column, value, last_id, descending):
+    """Условие "строго после (value, last_id)" в порядке сортировки"""
+    if sort_column is None:
+        return id_column < last_id if descending else id_column > last_id
+    if descending:
+        # NULL меньше любого значения и при сортировке по убыванию идет в конце
+        if value is None:
+            return and_(sort_column.is_(None), id_column < last_id)
+        return or_(
+            sort_column < value,
+            and_(sort_column == value, id_column < last_id),
+            sort_column.is_(None)
+        )
+    if value is None:
+        return or_(and_(sort_column.is_(None), id_column > last_id), sort_column.isnot(None))
+    return or_(sort_column > value, and_(sort_column == value, id_column > last_id))
+
+
+def _keyset_query(query, columns, cursor, descending):
+    """Запрос, упорядоченный по columns и начинающийся после курсора; (запрос, курсор или None)"""
+    position = decode_cursor(cursor, columns) if cursor else None
+    if position is not None:
+        sort_column, id_column = (None, columns[0]) if len(columns) == 1 else columns
+        value, last_id = (None, position[0]) if sort_column is None else position
+        query = query.filter(_after(sort_column, id_column, value, last_id, descending))
+    else:
+        cursor = None
+    order = [c.desc() if descending else c.asc() for c in columns]
+    return query.order_by(None).order_by(*order), cursor
+
+
+def keyset_paginate(query, id_column, sort_column=None, cursor=None, per_page=DEFAULT_PER_PAGE, descending=True):
+    """Возвращает KeysetPage запроса, упорядоченного по (sort_column, id_column).
+
+    sort_column - индексированная колонка сортировки (created_at, uploaded_at ...),
+    id_column - первичный ключ, разрешающий одинаковые значения sort_column.
+    Без sort_column страница упорядочена только по первичному ключу.
+    """
+    columns = [id_column] if sort_column is None else [sort_column, id_column]
+    query, cursor = _keyset_query(query, columns, cursor, descending)
+    rows = query.limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+    return KeysetPage(rows, cursor, next_cursor)
+
+
+class KeysetStream:
+    """Страница keyset-пагинации, строки которой читаются из базы по мере вывода.
+
+    Запрос выполняется при первом обращении (в потоковом шаблоне - уже после отправки шапки)
+    с yield_per: строки идут из курсора на стороне сервера пачками по batch_size, и в памяти
+    одновременно только одна пачка. Обойти строки можно один раз; next_cursor известен
+    после обхода, поэтому кнопки пагинации выводятся под списком.
+
+    on_batch(пачка) вызывается перед выводом каждой пачки, например чтобы одним запросом
+    подгрузить связанные данные. Пока курсор открыт, соединение сессии в MySQL занято
+    потоком строк, поэтому такие запросы идут через отдельное соединение.
+    """
+
+    def __init__(self, query, columns, cursor, per_page, batch_size=STREAM_BATCH_SIZE, on_batch=None):
+        self.cursor = cursor
+        self.next_cursor = None
+        self.count = 0 # Сколько строк уже прочитано
+        self._query = query
+        self._columns = columns
+        self._per_page = per_page
+        self._batch_size = batch_size
+        self._on_batch = on_batch
+        self._batches = None
+        self._peeked = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def _read(self):
+        rows = iter(self._query.limit(self._per_page + 1).yield_per(self._batch_size))
+        left = self._per_page
+        while left:
+            batch = list(islice(rows, min(self._batch_size, left)))
+            if not batch:
+                return
+            left -= len(batch)
+            self.count += len(batch)
+            if self._on_batch is not None:
+                self._on_batch(batch)
+            yield batch
+        # Лишняя строка за пределами страницы значит, что есть следующая
+        if next(rows, None) is not None:
+            self.next_cursor = encode_cursor([getattr(batch[-1], c.key) for c in self._columns])
+
+    def _next_batch(self):
+        if self._peeked is not None:
+            batch, self._peeked = self._peeked, None
+            return batch
+        if self._batches is None:
+            self._batches = self._read()
+        return next(self._batches, None)
+
+    def __iter__(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            yield from batch
+
+    def __bool__(self):
+        # Проверка "есть ли строки" до обхода читает первую пачку заранее
+        if self._batches is None:
+            self._peeked = self._next_batch() or []
+        return self.count > 0
+
+
+def keyset_stream(query, id_column, sort_column=None, cursor=None, per_page=DEFAULT_PER_PAGE, descending=True,
+                  batch_size=STREAM_BATCH_SIZE, on_batch=None):
+    """Как keyset_paginate, но возвращает KeysetStream для потокового шаблона (app/streaming.py)"""
+    columns = [id_column] if sort_column is None else [sort_column, id_column]
+    query, cursor = _keyset_query(query, columns, cursor, descending)
+    return KeysetStream(query, columns, cursor, per_page, batch_size, on_batch)
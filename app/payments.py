@@ -0,0 +1,417 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+import click
+import requests
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.booking import change_status
+from app.models import Order, Payment, PaymentEvent
+
+# Оплата через ЮKassa без обращений к ЮKassa из запросов gunicorn.
+#
+# Запрос "Оплатить" только записывает попытку оплаты (payments, статус new) и показывает
+# страницу ожидания; платеж в ЮKassa создает воркер (flask payments worker) и сохраняет
+# ссылку на страницу оплаты. Webhook только сохраняет уведомление о платеже, созданном
+# приложением, в payment_events и сразу отвечает 200. Воркер берет уведомления по очереди, запрашивает актуальное состояние
+# платежа у ЮKassa (телу уведомления не доверяем) и применяет переходы статусов условным
+# UPDATE, поэтому повторные и переставленные уведомления ничего не ломают. Раз в
+# PAYMENT_RECONCILE_INTERVAL воркер сверяет зависшие платежи списком из API - на случай
+# потерянных уведомлений.
+#
+# Воркеров и потоков может быть несколько: строки берутся в аренду (locked_until),
+# а после ошибки возвращаются в очередь с растущей задержкой.
+
+logger = logging.getLogger(__name__)
+
+EVENTS = ('payment.waiting_for_capture', 'payment.succeeded', 'payment.canceled')
+ACTIVE_STATUSES = ('new', 'pending', 'waiting_for_capture') # Платеж еще может завершиться
+# Статус платежа -> из каких статусов в него можно перейти. Завершенные платежи не меняются
+TRANSITIONS = {
+    'pending': ('new',),
+    'waiting_for_capture': ('new', 'pending'),
+    'succeeded': ('new', 'pending', 'waiting_for_capture'),
+    'canceled': ('new', 'pending', 'waiting_for_capture'),
+}
+PAYABLE_STATUSES = ('pending', 'confirmed') # Заказы, которые можно оплатить
+PAID_STATUS = 'paid'
+
+BATCH_SIZE = 20 # Сколько строк воркер выбирает за проход
+LEASE_SECONDS = 120 # Аренда строки: дольше самого медленного обращения к ЮKassa
+MAX_ATTEMPTS = 8 # После стольких неудачных попыток создать платеж попытка оплаты помечается failed
+MAX_RETRY_DELAY = 600
+LIST_LIMIT = 100 # Максимальный размер страницы списка платежей в API ЮKassa
+MAX_WEBHOOK_SIZE = 64 * 1024
+
+
+class PaymentError(Exception):
+    """Ошибка обращения к ЮKassa. retry=False - повтор не поможет (неверный запрос, ключи)"""
+
+    def __init__(self, message, retry=True):
+        super().__init__(message)
+        self.retry = retry
+
+
+class YooKassaClient:
+    """Минимальный клиент API ЮKassa v3 с таймаутами.
+
+    Официальный SDK (пакет yookassa) отправляет запросы без таймаута, и зависший ответ
+    держал бы поток воркера бесконечно; нужные три вызова проще сделать через requests.
+    """
+
+    def __init__(self, api_url, shop_id, secret_key, timeout):
+        self.api_url = api_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (shop_id or '', secret_key or '')
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['YOOKASSA_API_URL'], config['YOOKASSA_SHOP_ID'], config['YOOKASSA_SECRET_KEY'],
+                   (config['YOOKASSA_CONNECT_TIMEOUT'], config['YOOKASSA_TIMEOUT']))
+
+    def request(self, method, path, **kwargs):
+        try:
+            response = self.session.request(method, self.api_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise PaymentError(f'{method} {path}: {e}') from e
+        if response.status_code != 200:
+            # 202 - ЮKassa еще обрабатывает запрос и просит повторить его позже
+            retry = response.status_code in (202, 429) or response.status_code >= 500
+            raise PaymentError(f'{method} {path}: HTTP {response.status_code} {response.text[:200]}', retry=retry)
+        try:
+            return response.json()
+        except ValueError as e:
+            raise PaymentError(f'{method} {path}: ответ не JSON') from e
+
+    def create_payment(self, amount, description, return_url, metadata, idempotence_key):
+        return self.request('POST', '/payments', headers={'Idempotence-Key': idempotence_key}, json={
+            'amount': {'value': f'{amount:.2f}', 'currency': 'RUB'},
+            'capture': True,
+            'confirmation': {'type': 'redirect', 'return_url': return_url},
+            'description': description[:128],
+            'metadata': metadata,
+        })
+
+    def get_payment(self, provider_id):
+        return self.request('GET', f'/payments/{provider_id}')
+
+    def list_payments(self, **params):
+        return self.request('GET', '/payments', params=params)
+
+
+def client():
+    app = current_app._get_current_object()
+    if 'yookassa' not in app.extensions:
+        app.extensions['yookassa'] = YooKassaClient.from_config(app.config)
+    return app.extensions['yookassa']
+
+
+# --- В запросе: без обращений к ЮKassa ---
+
+def latest_payment(order_id):
+    return Payment.query.filter_by(order_id=order_id).order_by(Payment.id.desc()).first()
+
+
+def start_payment(order, return_url):
+    """Незавершенная попытка оплаты заказа или новая (платеж в ЮKassa создаст воркер)"""
+    payment = latest_payment(order.id)
+    if payment is None or payment.status not in ACTIVE_STATUSES:
+        payment = Payment(order_id=order.id, amount=order.total_price, idempotence_key=uuid.uuid4().hex,
+                          return_url=return_url)
+        db.session.add(payment)
+        db.session.commit()
+    return payment
+
+
+def record_event(data):
+    """Сохраняет уведомление ЮKassa; True - новое, False - повторная доставка или чужой платеж.
+
+    ValueError, если это не уведомление о платеже. Webhook открыт всем, поэтому уведомления
+    о платежах, которых приложение не создавало, не сохраняются: иначе каждое из них
+    стоило бы воркеру запроса к API ЮKassa.
+    """
+    if not isinstance(data, dict) or data.get('type') != 'notification' or data.get('event') not in EVENTS:
+        raise ValueError('не уведомление о платеже')
+    provider_id = (data.get('object') or {}).get('id')
+    if not isinstance(provider_id, str) or not 0 < len(provider_id) <= 100:
+        raise ValueError('нет id платежа')
+    if db.session.execute(select(Payment.id).where(Payment.provider_id == provider_id)).first() is None:
+        return False
+    try:
+        db.session.execute(insert(PaymentEvent).values(
+            event=data['event'], provider_id=provider_id, payload=json.dumps(data, ensure_ascii=False),
+            received_at=datetime.utcnow(), attempts=0
+        ))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+# --- В воркере ---
+
+def claim(model, row_id, now):
+    """Берет строку в аренду; False, если ее уже взял другой воркер"""
+    table = model.__table__
+    taken = db.session.execute(
+        update(table)
+        .where(table.c.id == row_id, or_(table.c.locked_until.is_(None), table.c.locked_until < now))
+        .values(locked_until=now + timedelta(seconds=LEASE_SECONDS), attempts=table.c.attempts + 1)
+    ).rowcount
+    db.session.commit()
+    return taken == 1
+
+
+def retry_later(model, row_id, attempts, error, now):
+    """Возвращает строку в очередь после ошибки: 2, 4, 8 ... секунд, не больше MAX_RETRY_DELAY"""
+    table = model.__table__
+    delay = min(2 ** attempts, MAX_RETRY_DELAY)
+    db.session.execute(update(table).where(table.c.id == row_id)
+                       .values(locked_until=now + timedelta(seconds=delay), error=str(error)[:255]))
+    db.session.commit()
+
+
+def ready(model, *where, now, limit=BATCH_SIZE):
+    """id строк, которые можно взять: не в аренде и без отложенного повтора"""
+    return db.session.execute(
+        select(model.id)
+        .where(*where, or_(model.locked_until.is_(None), model.locked_until < now))
+        .order_by(model.id)
+        .limit(limit)
+    ).scalars().all()
+
+
+def same_amount(data, amount):
+    try:
+        return Decimal(data['amount']['value']) == Decimal(amount)
+    except (KeyError, TypeError, InvalidOperation):
+        return False
+
+
+def apply_payment(data, payment_id=None):
+    """Применяет состояние платежа из API ЮKassa; True, если статус изменился.
+
+    Переход делается условным UPDATE из допустимых статусов (TRANSITIONS), поэтому
+    повторное применение того же состояния или устаревшего ничего не меняет, в том
+    числе в параллельных воркерах. payment_id - попытка оплаты, для которой платеж
+    только что создан: к ней привязываются id платежа и ссылка на оплату.
+    """
+    table = Payment.__table__
+    provider_id = data['id']
+    if payment_id is not None:
+        db.session.execute(update(table).where(table.c.id == payment_id, table.c.provider_id.is_(None)).values(
+            provider_id=provider_id, error=None, locked_until=None,
+            confirmation_url=(data.get('confirmation') or {}).get('confirmation_url')
+        ))
+    payment = db.session.execute(select(Payment).where(Payment.provider_id == provider_id)).scalar()
+    status = data.get('status')
+    if payment is None or status not in TRANSITIONS:
+        db.session.commit()
+        if payment is None:
+            logger.warning('Платеж %s не найден среди попыток оплаты', provider_id)
+        return False
+    if status == 'succeeded' and not same_amount(data, payment.amount):
+        db.session.rollback()
+        logger.error('Платеж %s: сумма %s не совпадает с заказом (%s)', provider_id, data.get('amount'), payment.amount)
+        return False
+
+    moved = db.session.execute(
+        update(table).where(table.c.id == payment.id, table.c.status.in_(TRANSITIONS[status]))
+        .values(status=status, locked_until=None)
+    ).rowcount
+    order_query = select(Order).where(Order.id == payment.order_id).execution_options(populate_existing=True)
+    if moved and status == 'succeeded':
+        # Статус заказа читается под блокировкой его строки: отмена администратором
+        # (change_status) либо уже закоммичена и видна здесь, либо дождется этой транзакции
+        order_query = order_query.with_for_update()
+    order = db.session.execute(order_query).scalar()
+    if order is not None and payment_id is not None:
+        order.payment_id = provider_id
+    if moved and status == 'succeeded' and order is not None:
+        if order.status in PAYABLE_STATUSES:
+            change_status(order, PAID_STATUS) # Коммитит и изменение платежа
+            return True
+        logger.warning('Заказ #%s оплачен в статусе %s: нужен возврат или ручная проверка', order.id, order.status)
+    db.session.commit()
+    return bool(moved)
+
+
+def create_payments(api, now=None):
+    """Создает в ЮKassa платежи для новых попыток оплаты; возвращает число обработанных"""
+    now = now or datetime.utcnow()
+    done = 0
+    for payment_id in ready(Payment, Payment.status == 'new', Payment.provider_id.is_(None), now=now):
+        if not claim(Payment, payment_id, now):
+            continue
+        payment = db.session.get(Payment, payment_id)
+        order = db.session.get(Order, payment.order_id)
+        if order is None or order.status not in PAYABLE_STATUSES:
+            payment.status, payment.error, payment.locked_until = 'canceled', 'заказ не ожидает оплаты', None
+            db.session.commit()
+            continue
+        amount, key, return_url, attempts = payment.amount, payment.idempotence_key, payment.return_url, payment.attempts
+        description = f'Заказ #{order.id}'
+        db.session.commit() # Транзакция не держится открытой, пока идет запрос к ЮKassa
+        try:
+            # Повтор с тем же ключом идемпотентности после таймаута вернет уже созданный платеж
+            data = api.create_payment(amount, description, return_url, {'order_id': str(order.id)}, key)
+        except PaymentError as e:
+            if e.retry and attempts < MAX_ATTEMPTS:
+                retry_later(Payment, payment_id, attempts, e, now)
+            else:
+                db.session.execute(update(Payment.__table__).where(Payment.__table__.c.id == payment_id)
+                                   .values(status='failed', error=str(e)[:255], locked_until=None))
+                db.session.commit()
+            logger.warning('Попытка оплаты %s: %s', payment_id, e)
+            continue
+        apply_payment(data, payment_id=payment_id)
+        done += 1
+    return done
+
+
+def process_events(api, now=None):
+    """Применяет сохраненные уведомления; возвращает число обработанных"""
+    now = now or datetime.utcnow()
+    table = PaymentEvent.__table__
+    done = 0
+    for event_id in ready(PaymentEvent, PaymentEvent.processed_at.is_(None), now=now):
+        if not claim(PaymentEvent, event_id, now):
+            continue
+        event = db.session.get(PaymentEvent, event_id)
+        provider_id, attempts = event.provider_id, event.attempts
+        db.session.commit()
+        try:
+            data = api.get_payment(provider_id)
+        except PaymentError as e:
+            if e.retry:
+                retry_later(PaymentEvent, event_id, attempts, e, now)
+            else:
+                db.session.execute(update(table).where(table.c.id == event_id)
+                                   .values(processed_at=datetime.utcnow(), error=str(e)[:255], locked_until=None))
+                db.session.commit()
+            logger.warning('Уведомление %s: %s', event_id, e)
+            continue
+        apply_payment(data)
+        # Если воркер упадет до этой строки, уведомление обработается еще раз - без последствий
+        db.session.execute(update(table).where(table.c.id == event_id)
+                           .values(processed_at=datetime.utcnow(), error=None, locked_until=None))
+        db.session.commit()
+        done += 1
+    return done
+
+
+def reconcile(api, now=None, older_than=None, limit=BATCH_SIZE * 5):
+    """Сверяет с ЮKassa платежи, которые давно не менялись; возвращает число изменившихся.
+
+    Состояния берутся списком платежей API (по LIST_LIMIT за запрос), а не по одному;
+    платежи, которых в списке не оказалось, запрашиваются отдельно.
+    """
+    now = now or datetime.utcnow()
+    if older_than is None:
+        older_than = current_app.config['PAYMENT_RECONCILE_AFTER']
+    rows = db.session.execute(
+        select(Payment.id, Payment.provider_id, Payment.created_at)
+        .where(Payment.status.in_(('pending', 'waiting_for_capture')), Payment.provider_id.isnot(None),
+               Payment.updated_at < now - timedelta(seconds=older_than))
+        .order_by(Payment.updated_at)
+        .limit(limit)
+    ).all()
+    db.session.commit()
+    if not rows:
+        return 0
+    wanted = {provider_id for _, provider_id, _ in rows}
+    since = min(created_at for _, _, created_at in rows) - timedelta(minutes=10) # Запас на расхождение часов
+    params = {'created_at.gte': since.isoformat(timespec='milliseconds') + 'Z', 'limit': LIST_LIMIT}
+    changed = 0
+    while wanted:
+        page = api.list_payments(**params)
+        for item in page.get('items', []):
+            if item.get('id') in wanted:
+                wanted.discard(item['id'])
+                changed += apply_payment(item)
+        if not page.get('next_cursor'):
+            break
+        params['cursor'] = page['next_cursor']
+    for provider_id in wanted:
+        try:
+            changed += apply_payment(api.get_payment(provider_id))
+        except PaymentError as e:
+            logger.warning('Сверка платежа %s: %s', provider_id, e)
+
+    # Проверенные, но не изменившиеся платежи уходят в конец очереди сверки
+    table = Payment.__table__
+    db.session.execute(update(table).where(table.c.id.in_([payment_id for payment_id, _, _ in rows]),
+                                           table.c.status.in_(('pending', 'waiting_for_capture')))
+                       .values(updated_at=now))
+    db.session.commit()
+    return changed
+
+
+def work(app, stop, interval, reconcile_every, once):
+    """Цикл одного потока воркера. reconcile_every=None - поток не занимается сверкой"""
+    next_reconcile = 0
+    while not stop.is_set():
+        with app.app_context():
+            api = client()
+            try:
+                busy = create_payments(api) + process_events(api)
+                if reconcile_every is not None and time.monotonic() >= next_reconcile:
+                    busy += reconcile(api)
+                    next_reconcile = time.monotonic() + reconcile_every
+            except Exception: # База или сеть недоступны: пишем в лог и пробуем на следующем проходе
+                db.session.rollback()
+                logger.exception('Ошибка в воркере платежей')
+                busy = 0
+        if once:
+            return
+        if not busy:
+            stop.wait(interval)
+
+
+payments_cli = AppGroup('payments', help='Платежи ЮKassa')
+
+
+@payments_cli.command('worker')
+@click.option('--threads', default=4, show_default=True, help='Потоков: столько обращений к ЮKassa идут параллельно')
+@click.option('--interval', default=1.0, show_default=True, help='Пауза (с), когда работы нет')
+@click.option('--once', is_flag=True, help='Один проход и выход (для cron и проверок)')
+def worker_command(threads, interval, once):
+    """Создает платежи, обрабатывает уведомления и сверяет зависшие платежи"""
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+    app = current_app._get_current_object()
+    stop = threading.Event()
+    reconcile_every = app.config['PAYMENT_RECONCILE_INTERVAL']
+    workers = [threading.Thread(target=work, name=f'payments-{n}', daemon=True,
+                                args=(app, stop, interval, reconcile_every if n == 0 else None, once))
+               for n in range(max(threads, 1))]
+    for thread in workers:
+        thread.start()
+    try:
+        for thread in workers:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in workers:
+            thread.join()
+
+
+@payments_cli.command('reconcile')
+@click.option('--older-than', default=0, show_default=True, help='Сверять платежи, не менявшиеся столько секунд')
+def reconcile_command(older_than):
+    """Однократная сверка незавершенных платежей с ЮKassa"""
+    changed = reconcile(client(), older_than=older_than)
+    click.echo(f'Изменилось платежей: {changed}')
+
+
+def init_app(app):
+    app.cli.add_command(payments_cli)
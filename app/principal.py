@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from flask_login import UserMixin
+from app import db
+from app.cache import GENERATION_PREFIX, backend
+
+# Кэш текущего пользователя для login_manager.user_loader. На каждый запрос шапке и
+# admin_required нужны только имя, аватар и роль, поэтому вместо запроса к users по
+# первичному ключу берется снимок этих полей из LRU воркера. Снимок помнит поколение
+# таблицы users из кэша страниц (app/cache.py): любое изменение пользователя после коммита
+# увеличивает его, и снимки устаревают сразу во всех воркерах. Поэтому кэш работает только
+# с общим бэкендом (file/redis): с memory другие воркеры не узнали бы, например, что
+# администратора понизили, и пускали бы его в админку до конца TTL.
+
+FIELDS = ('id', 'username', 'email', 'full_name', 'phone', 'avatar_path', 'role', 'is_admin')
+USERS_GENERATION = GENERATION_PREFIX + 'users'
+
+_principals = OrderedDict() # id -> (истекает, поколение users, поля)
+_lock = threading.Lock()
+
+
+class UserPrincipal(UserMixin):
+    """Снимок полей пользователя вместо модели User.
+
+    Для записи и связей (заказы, отзывы, изменение профиля) нужна сама модель: она
+    загружается по требованию через record. Остальные атрибуты тоже берутся из нее.
+    """
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+        self._record = None
+
+    @property
+    def record(self):
+        if self._record is None:
+            from app.models import User
+            self._record = db.session.get(User, self.id)
+        return self._record
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+
+def load_principal(user_id):
+    """Пользователь для current_user: снимок из кэша или один запрос к базе"""
+    cache = backend()
+    ttl = current_app.config['PRINCIPAL_CACHE_TTL'] if cache.shared else 0
+    generation = cache.counters([USERS_GENERATION])[0] if ttl else None
+    if ttl:
+        with _lock:
+            entry = _principals.get(user_id)
+            if entry is not None:
+                expires, cached_generation, fields = entry
+                if expires > time.time() and cached_generation == generation:
+                    _principals.move_to_end(user_id)
+                    return UserPrincipal(fields)
+                del _principals[user_id]
+
+    from app.models import User
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    if ttl:
+        fields = {name: getattr(user, name) for name in FIELDS}
+        with _lock:
+            _principals[user_id] = (time.time() + ttl, generation, fields)
+            while len(_principals) > current_app.config['PRINCIPAL_CACHE_SIZE']:
+                _principals.popitem(last=False)
+    # В этом запросе модель уже загружена - отдаем ее саму
+    return user
+
+
+def forget_principals(user_ids):
+    """Сбрасывает снимки пользователей в этом воркере (вызывается после коммита)"""
+    with _lock:
+        for user_id in user_ids:
+            _principals.pop(user_id, None)
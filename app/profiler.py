@@ -0,0 +1,160 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Профилировщик SQL по запросам (включается SQL_PROFILER=1).
+# Слушатели висят на классе Engine, поэтому видят запросы всех движков приложения.
+# Одинаковые по форме запросы, повторенные в одном HTTP-запросе SQL_PROFILER_NPLUSONE
+# раз и больше, помечаются как N+1 вместе с местом в коде или шаблоне, откуда они пришли.
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILER_FILE = os.path.abspath(__file__)
+
+_history = deque(maxlen=200) # Последние отчеты этого воркера для страницы в админке
+_history_lock = threading.Lock()
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,?)+\)')
+_SPACES = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Форма запроса без значений: литералы и списки IN (?, ?, ...) сворачиваются"""
+    shape = _STRING.sub('?', statement)
+    shape = _NUMBER.sub('?', shape)
+    shape = _PLACEHOLDERS.sub('(?)', shape)
+    return _SPACES.sub(' ', shape).strip()
+
+
+def query_origin():
+    """Первая строка кода приложения или шаблона в стеке, откуда ушел запрос"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(APP_DIR) and filename != PROFILER_FILE:
+            lineno = frame.f_lineno
+            template = frame.f_globals.get('__jinja_template__')
+            if template is not None:
+                # Строка скомпилированного шаблона -> строка в .html
+                lineno = template.get_corresponding_lineno(lineno)
+            return f'{os.path.relpath(filename, APP_DIR)}:{lineno}'
+        frame = frame.f_back
+    return None
+
+
+class RequestProfile:
+    """Счетчики SQL одного HTTP-запроса"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.origins = {} # Форма -> место первого повтора
+        self.started = time.perf_counter()
+
+    def record(self, statement, duration):
+        shape = statement_shape(statement)
+        self.count += 1
+        self.duration += duration
+        self.shapes[shape] += 1
+        if self.shapes[shape] == 2:
+            # Место ищем только для повторившихся форм: обход стека не бесплатный
+            self.origins[shape] = query_origin()
+
+    def repeated(self, threshold):
+        return [
+            {'statement': shape, 'count': count, 'origin': self.origins.get(shape)}
+            for shape, count in self.shapes.most_common() if count >= threshold
+        ]
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_profile' in g:
+        conn.info.setdefault('profiler_started', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.get('profiler_started')
+    if not started or not has_request_context() or 'sql_profile' not in g:
+        return
+    g.sql_profile.record(statement, time.perf_counter() - started.pop())
+
+
+def handle_error(exception_context):
+    started = exception_context.connection.info.get('profiler_started') if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def start_profile():
+    if request.endpoint != 'static':
+        g.sql_profile = RequestProfile()
+
+
+def finish_profile(app):
+    def finish(response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+        threshold = app.config['SQL_PROFILER_NPLUSONE']
+        budget = app.config['SQL_PROFILER_BUDGET']
+        repeated = profile.repeated(threshold)
+        over_budget = budget and profile.count > budget
+
+        response.headers['X-SQL-Queries'] = str(profile.count)
+        response.headers['X-SQL-Time'] = f'{profile.duration * 1000:.1f}ms'
+        if repeated:
+            response.headers['X-SQL-NPlusOne'] = '; '.join(
+                f"{r['count']}x {r['origin'] or '?'}" for r in repeated
+            )
+
+        level = logging.WARNING if repeated or over_budget else logging.INFO
+        app.logger.getChild('sql').log(
+            level, 'SQL %s %s -> %s: %d запросов, %.1f мс SQL, %.1f мс всего%s%s',
+            request.method, request.full_path.rstrip('?'), response.status_code,
+            profile.count, profile.duration * 1000, (time.perf_counter() - profile.started) * 1000,
+            f', превышен бюджет {budget}' if over_budget else '',
+            ''.join(f"\n  N+1 {r['count']}x {r['origin'] or '?'}: {r['statement']}" for r in repeated)
+        )
+
+        with _history_lock:
+            _history.appendleft({
+                'time': datetime.now(),
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'endpoint': request.endpoint,
+                'status': response.status_code,
+                'count': profile.count,
+                'duration': profile.duration * 1000,
+                'over_budget': bool(over_budget),
+                'repeated': repeated
+            })
+        return response
+    return finish
+
+
+def history():
+    with _history_lock:
+        return list(_history)
+
+
+def init_app(app):
+    if not app.config['SQL_PROFILER']:
+        return
+    if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        event.listen(Engine, 'handle_error', handle_error)
+    app.before_request(start_profile)
+    app.after_request(finish_profile(app))
+    # Строка лога на каждый запрос идет через обработчики app.logger
+    app.logger.getChild('sql').setLevel(logging.INFO)
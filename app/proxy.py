@@ -0,0 +1,49 @@
+import mimetypes
+import os
+from urllib.parse import quote
+from flask import abort, current_app
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+
+# Работа за фронт-прокси (nginx/nginx.conf в docker-compose).
+#
+# Загрузки (static/uploads) - самые тяжелые ответы сайта: оригинал фото весит мегабайты, и
+# пока он уходит медленному клиенту, воркер gunicorn не принимает запросы бронирования.
+# SENDFILE_MODE выбирает, кто копирует тело файла в сокет:
+#   app        - сам gunicorn: werkzeug передает открытый файл через wsgi.file_wrapper, и
+#                gunicorn отдает его os.sendfile без чтения в Python (Range - через werkzeug);
+#   x-accel    - nginx: приложение отвечает пустым телом с заголовком X-Accel-Redirect на
+#                internal location SENDFILE_ACCEL_PREFIX, файл, Range и 304 обслуживает nginx;
+#   x-sendfile - то же для Apache (mod_xsendfile) и lighttpd: заголовок X-Sendfile с путем на диске.
+# Заголовки кэширования (immutable для файлов с хешем) по-прежнему ставит приложение.
+
+MODES = ('app', 'x-accel', 'x-sendfile')
+UPLOADS_PREFIX = 'uploads/' # Загрузки внутри static
+
+
+def offloaded(filename):
+    """True, если файл статики отдает прокси, а не приложение"""
+    return current_app.config['SENDFILE_MODE'] != 'app' and filename.startswith(UPLOADS_PREFIX)
+
+
+def offload(folder, filename):
+    """Ответ без тела, по которому прокси сам отдаст файл folder/filename"""
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    response = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if current_app.config['SENDFILE_MODE'] == 'x-accel':
+        location = current_app.config['SENDFILE_ACCEL_PREFIX'].rstrip('/') + '/' + filename[len(UPLOADS_PREFIX):]
+        response.headers['X-Accel-Redirect'] = quote(location)
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    return response
+
+
+def init_app(app):
+    if app.config['SENDFILE_MODE'] not in MODES:
+        raise ValueError(f"SENDFILE_MODE: одно из {', '.join(MODES)}")
+    if app.config['PROXY_COUNT']:
+        # Адрес клиента, схема и хост из X-Forwarded-* (нужны для ссылок _external, например return_url оплаты)
+        count = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count, x_host=count, x_port=count)
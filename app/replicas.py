@@ -0,0 +1,171 @@
+import logging
+import random
+import threading
+import time
+from functools import wraps
+import click
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+# Чтение с реплик MySQL. Публичные страницы почти только читают, поэтому SELECT в GET-запросах
+# уходит на одну из реплик (SQLALCHEMY_BINDS с ключами replica_*, см. DB_REPLICA_HOSTS), а все
+# остальное - на основную базу:
+#   - запросы кроме GET/HEAD, админка и представления с @use_primary;
+#   - INSERT/UPDATE/DELETE, SELECT ... FOR UPDATE, сырой SQL и все после первой записи в запросе;
+#   - REPLICA_STICKY_SECONDS после любого запроса, который писал (кука STICKY_COOKIE):
+#     клиент сразу видит свой заказ или отзыв, даже если реплика еще не догнала основную базу;
+#   - если все реплики отстают больше REPLICA_MAX_LAG секунд или недоступны.
+# Отставание проверяется не чаще раза в REPLICA_CHECK_INTERVAL секунд в каждом процессе.
+# Фоновые воркеры и команды flask работают только с основной базой.
+
+logger = logging.getLogger(__name__)
+
+REPLICA_PREFIX = 'replica'
+STICKY_COOKIE = 'db_primary_until'
+PRIMARY_BLUEPRINTS = ('admin', 'auth')
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(Session):
+    """Сессия Flask-SQLAlchemy, которая отправляет чтения GET-запросов на реплику"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or self._flushing or engine is not self._db.engines.get(None):
+            return engine
+        if clause is not None and not _is_plain_select(clause):
+            if getattr(clause, 'is_dml', False) and has_request_context():
+                g.db_wrote = True
+            return engine
+        if self.new or self.dirty or self.deleted:
+            return engine # Несохраненные изменения: читаем там, куда они запишутся
+        return replica_engine() or engine
+
+
+def _is_plain_select(clause):
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+def use_primary(view):
+    """Декоратор представления: все запросы к основной базе (статус, который только что
+    поменял кто-то другой, например воркер платежей)"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_primary = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def force_primary():
+    """Оставшиеся запросы текущего HTTP-запроса - к основной базе"""
+    if has_request_context():
+        g.db_primary = True
+
+
+def replica_engine():
+    """Движок реплики для чтения в текущем запросе или None - читать с основной базы"""
+    if not has_request_context() or g.get('db_primary') or g.get('db_wrote'):
+        return None
+    if 'db_replica' not in g:
+        # Реплика выбирается один раз на запрос: все чтения видят одно и то же состояние
+        g.db_replica = _choose_replica()
+    return g.db_replica
+
+
+def _choose_replica():
+    replicas = current_app.extensions.get('replicas')
+    if not replicas or request.method not in READ_METHODS or request.blueprint in PRIMARY_BLUEPRINTS:
+        return None
+    try:
+        if float(request.cookies.get(STICKY_COOKIE, 0)) > time.time():
+            return None
+    except ValueError:
+        pass
+    healthy = replicas.healthy()
+    return current_app.extensions['sqlalchemy'].engines[random.choice(healthy)] if healthy else None
+
+
+class ReplicaSet:
+    """Реплики приложения и их последнее известное отставание"""
+
+    def __init__(self, app, keys):
+        self.app = app
+        self.keys = keys
+        self.status = {key: None for key in keys} # ключ -> отставание, с (None - недоступна)
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        """Ключи реплик, которые отстают не больше REPLICA_MAX_LAG"""
+        if time.monotonic() - self.checked_at >= self.app.config['REPLICA_CHECK_INTERVAL']:
+            # Проверяет один поток, остальные пока пользуются прошлым результатом
+            if self._lock.acquire(blocking=False):
+                try:
+                    self.check()
+                finally:
+                    self._lock.release()
+        max_lag = self.app.config['REPLICA_MAX_LAG']
+        return [key for key, lag in self.status.items() if lag is not None and lag <= max_lag]
+
+    def check(self):
+        engines = self.app.extensions['sqlalchemy'].engines
+        for key in self.keys:
+            previous, self.status[key] = self.status[key], replica_lag(engines[key])
+            if self.checked_at and (previous is None) != (self.status[key] is None):
+                logger.warning('Реплика %s: %s', key, 'недоступна' if self.status[key] is None else 'снова в работе')
+        self.checked_at = time.monotonic()
+        return dict(self.status)
+
+
+def replica_lag(engine):
+    """Отставание реплики в секундах или None, если она недоступна или репликация стоит"""
+    try:
+        with engine.connect() as conn:
+            if engine.dialect.name != 'mysql':
+                return 0 # Локальная разработка на SQLite: "реплика" - просто вторая база
+            row = conn.exec_driver_sql('SHOW REPLICA STATUS').mappings().first()
+    except Exception:
+        logger.exception('Не удалось проверить реплику %s', engine.url.host)
+        return None
+    if row is None or row['Replica_IO_Running'] != 'Yes' or row['Replica_SQL_Running'] != 'Yes':
+        return None
+    return row['Seconds_Behind_Source']
+
+
+def mark_write(session, flush_context):
+    if has_request_context():
+        g.db_wrote = True
+
+
+def set_sticky_cookie(response):
+    """После записи клиент несколько секунд читает с основной базы"""
+    if request.method not in READ_METHODS or g.get('db_wrote'):
+        seconds = current_app.config['REPLICA_STICKY_SECONDS']
+        response.set_cookie(STICKY_COOKIE, f'{time.time() + seconds:.0f}', max_age=seconds, httponly=True, samesite='Lax')
+    return response
+
+
+@click.command('replicas')
+def replicas_command():
+    """Отставание реплик для чтения"""
+    replicas = current_app.extensions.get('replicas')
+    if not replicas:
+        raise click.ClickException('Реплики не настроены (DB_REPLICA_HOSTS)')
+    max_lag = current_app.config['REPLICA_MAX_LAG']
+    for key, lag in replicas.check().items():
+        url = current_app.extensions['sqlalchemy'].engines[key].url
+        state = 'недоступна' if lag is None else f'отставание {lag} с' + (' (не используется)' if lag > max_lag else '')
+        click.echo(f'{key} {url.host}:{url.port or 3306}: {state}')
+
+
+def init_app(app):
+    from app import db
+    app.cli.add_command(replicas_command)
+    keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key and key.startswith(REPLICA_PREFIX))
+    if not keys:
+        return
+    app.extensions['replicas'] = ReplicaSet(app, keys)
+    if not event.contains(db.session, 'after_flush', mark_write):
+        event.listen(db.session, 'after_flush', mark_write)
+    app.after_request(set_sticky_cookie)
@@ -0,0 +1,422 @@
+import csv
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Boolean, Date, DateTime, Integer, delete, func, insert, select, update
+from werkzeug.security import generate_password_hash
+from app import db
+from app.booking import DEFAULT_DURATION
+from app.cache import invalidate
+from app.models import BookingDay, Category, Order, OrderItem, Portfolio, Review, Service, UploadBlob, User
+from app.stats import rebuild as rebuild_stats
+from app.conditional import touch
+from app.uploads import is_blob_path
+
+# Массовая загрузка данных: flask seed generate (синтетика) и flask seed import (CSV/JSONL).
+# Строки идут потоком пачками по --batch: каждая пачка - один INSERT ... VALUES на много
+# строк (executemany) и свой коммит, поэтому память не растет с объемом, а миллионы
+# строк грузятся минутами. Загрузка идет мимо ORM, поэтому события моделей не срабатывают:
+# кэш страниц, карты занятости дней, сводные таблицы и счетчики ссылок на файлы
+# пересчитываются в конце явно (finish_load).
+
+BATCH_SIZE = 5000
+# Колонки с путями загрузок: на файлы в хранилище по содержимому ведется счетчик ссылок
+UPLOAD_COLUMNS = (Service.__table__.c.image_path, Portfolio.__table__.c.image_path, User.__table__.c.avatar_path)
+
+seed_cli = AppGroup('seed', help='Массовая загрузка данных.')
+
+# Что можно импортировать: вид -> модель. Заказы могут содержать вложенные позиции (items).
+IMPORT_KINDS = {
+    'users': User,
+    'categories': Category,
+    'services': Service,
+    'orders': Order,
+    'order_items': OrderItem,
+    'portfolio': Portfolio,
+    'reviews': Review,
+}
+
+# Статусы синтетических заказов с весами: прошлые заказы в основном завершены
+ORDER_STATUSES = (('completed', 60), ('paid', 10), ('confirmed', 10), ('pending', 5), ('cancelled', 15))
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def coerce_row(table, row):
+    """Приводит строковые значения из CSV/JSON к типам колонок таблицы"""
+    result = {}
+    for key, value in row.items():
+        if key not in table.c:
+            raise click.ClickException(f'В таблице {table.name} нет колонки {key}')
+        if value == '' or value is None:
+            result[key] = None
+            continue
+        column_type = table.c[key].type
+        if isinstance(value, str):
+            if isinstance(column_type, Boolean):
+                value = value.lower() in ('1', 'true', 'yes')
+            elif isinstance(column_type, Integer):
+                value = int(value)
+            elif isinstance(column_type, DateTime):
+                value = datetime.fromisoformat(value)
+            elif isinstance(column_type, Date):
+                value = datetime.fromisoformat(value).date()
+        result[key] = value
+    return result
+
+
+def next_id(conn, table):
+    return (conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+
+def execute_many(conn, table, rows):
+    """Один executemany на набор колонок: все строки пачки должны иметь одинаковые ключи"""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        conn.execute(insert(table), group)
+
+
+def insert_rows(conn, table, rows, batch=BATCH_SIZE):
+    """Вставляет строки пачками с коммитом после каждой. Возвращает число строк."""
+    total = 0
+    for chunk in chunked(rows, batch):
+        execute_many(conn, table, chunk)
+        conn.commit()
+        total += len(chunk)
+    return total
+
+
+def prepare_users(rows):
+    """Пароль из файла хешируется (медленно, scrypt); быстрее передавать готовый password_hash"""
+    for row in rows:
+        password = row.pop('password', None)
+        if password:
+            row['password_hash'] = generate_password_hash(password)
+        row.setdefault('role', 'client')
+        yield row
+
+
+def insert_orders(conn, orders, batch=BATCH_SIZE):
+    """Вставляет заказы вместе с вложенными позициями (ключ items).
+
+    Позициям без цены и длительности они берутся из услуги, заказу без booking_end
+    окончание считается по длительности позиций, без total_price - сумма позиций.
+    Возвращает (заказов, позиций).
+    """
+    orders_table, items_table = Order.__table__, OrderItem.__table__
+    services = {row.id: row for row in conn.execute(select(Service.id, Service.price, Service.duration))}
+    order_id = next_id(conn, orders_table)
+    total_orders = total_items = 0
+    for chunk in chunked(orders, batch):
+        order_rows, item_rows = [], []
+        for raw in chunk:
+            items = raw.pop('items', None) or []
+            order = coerce_row(orders_table, raw)
+            if order.get('id') is None:
+                order['id'] = order_id
+            order_id = max(order_id, order['id'] + 1)
+
+            order_items = [coerce_row(items_table, item) for item in items]
+            for item in order_items:
+                service = services.get(item.get('service_id'))
+                if service is not None:
+                    if item.get('price') is None:
+                        item['price'] = service.price
+                    if item.get('duration') is None:
+                        item['duration'] = service.duration or DEFAULT_DURATION
+                item['order_id'] = order['id']
+            item_rows.extend(order_items)
+            if order.get('total_price') is None:
+                order['total_price'] = sum(item.get('price') or 0 for item in order_items)
+            if order.get('booking_datetime') and order.get('booking_end') is None:
+                duration = sum(item.get('duration') or DEFAULT_DURATION for item in order_items)
+                order['booking_end'] = order['booking_datetime'] + timedelta(minutes=duration or DEFAULT_DURATION)
+            if order.get('status') is None:
+                order['status'] = 'pending'
+            order_rows.append(order)
+
+        execute_many(conn, orders_table, order_rows)
+        execute_many(conn, items_table, item_rows)
+        conn.commit()
+        total_orders += len(order_rows)
+        total_items += len(item_rows)
+    return total_orders, total_items
+
+
+def rebuild_upload_blobs(conn):
+    """Пересчитывает счетчики ссылок upload_blobs по всем колонкам с путями загрузок.
+
+    Без этого первое удаление или замена загруженного пути удалили бы файл, на который
+    ссылаются и другие записи.
+    """
+    refcounts = {}
+    for column in UPLOAD_COLUMNS:
+        rows = conn.execute(select(column, func.count()).where(column.like('__/__/%')).group_by(column))
+        for path, count in rows:
+            if is_blob_path(path):
+                refcounts[path] = refcounts.get(path, 0) + count
+    conn.execute(delete(UploadBlob.__table__))
+    insert_rows(conn, UploadBlob.__table__, ({'path': path, 'refcount': count} for path, count in refcounts.items()))
+    conn.commit()
+
+
+def finish_load(conn, tables):
+    """Сбрасывает то, что обычно поддерживают события ORM: карты занятости, сводные таблицы,
+    счетчики ссылок на файлы, счетчики изменений таблиц и кэш страниц"""
+    if 'orders' in tables or 'order_items' in tables:
+        # Карты дней пересчитаются по заказам при первом обращении (app/booking.py)
+        conn.execute(update(BookingDay.__table__).values(occupancy=None))
+        conn.commit()
+    if {'orders', 'order_items', 'reviews'} & set(tables):
+        rebuild_stats(conn)
+        conn.commit()
+    if {'users', 'services', 'portfolio'} & set(tables):
+        rebuild_upload_blobs(conn)
+    # Счетчики изменений для ETag страниц (app/conditional.py)
+    touch(conn, tables)
+    conn.commit()
+    invalidate(tables)
+
+
+# --- Генератор синтетических данных ---
+
+def user_email(user_id):
+    return f'user{user_id}@seed.example.com'
+
+
+def generate_users(count, first_id, rng, password_hash):
+    for user_id in range(first_id, first_id + count):
+        yield {
+            'id': user_id,
+            'full_name': f'Клиент {user_id}',
+            'email': user_email(user_id),
+            'phone': f'+7{rng.randrange(9000000000, 9999999999)}',
+            'password_hash': password_hash,
+            'role': 'client'
+        }
+
+
+def generate_categories(count, first_id):
+    for category_id in range(first_id, first_id + count):
+        yield {'id': category_id, 'name': f'Категория {category_id}'}
+
+
+def generate_services(count, first_id, category_ids, rng):
+    for service_id in range(first_id, first_id + count):
+        yield {
+            'id': service_id,
+            'name': f'Услуга {service_id}',
+            'description': f'Описание услуги {service_id}. ' * 4,
+            'price': rng.randrange(2000, 30000, 500),
+            'duration': rng.choice((30, 60, 90, 120, 180)),
+            'category_id': rng.choice(category_ids)
+        }
+
+
+def generate_orders(count, user_ids, services, rng, until):
+    """Заказы идут назад во времени от until без пересечений, как в реальной студии"""
+    statuses = [status for status, _ in ORDER_STATUSES]
+    weights = [weight for _, weight in ORDER_STATUSES]
+    end = until
+    for _ in range(count):
+        service = rng.choice(services)
+        duration = service['duration'] or DEFAULT_DURATION
+        start = end - timedelta(minutes=duration)
+        yield {
+            'user_id': rng.choice(user_ids),
+            'status': rng.choices(statuses, weights)[0],
+            'total_price': service['price'],
+            'booking_datetime': start,
+            'booking_end': start + timedelta(minutes=duration),
+            'created_at': start - timedelta(days=rng.randint(1, 30)),
+            'items': [{'service_id': service['id'], 'price': service['price'], 'duration': duration}]
+        }
+        end = start - timedelta(minutes=rng.choice((0, 30, 60, 120, 720)))
+
+
+def generate_portfolio(count, category_ids, rng, until):
+    for i in range(count):
+        yield {
+            'title': f'Работа {i + 1}',
+            'description': 'Синтетическая работа',
+            'image_path': f'seed/work-{i % 50}.jpg',
+            'category_id': rng.choice(category_ids),
+            'uploaded_at': until - timedelta(minutes=rng.randint(0, 60 * 24 * 730))
+        }
+
+
+def generate_reviews(count, user_ids, rng, until):
+    for i in range(count):
+        yield {
+            'body': f'Синтетический отзыв номер {i + 1}, все понравилось.',
+            'rating': rng.choices((1, 2, 3, 4, 5), (2, 3, 10, 30, 55))[0],
+            'user_id': rng.choice(user_ids),
+            'created_at': until - timedelta(minutes=rng.randint(0, 60 * 24 * 730))
+        }
+
+
+def generate_dataset(conn, users=0, categories=0, services=0, orders=0, portfolio=0, reviews=0,
+                     rng=None, password='password', until=None, batch=BATCH_SIZE, echo=None):
+    """Дописывает синтетические данные к существующим. Возвращает {таблица: число строк}."""
+    rng = rng or random.Random()
+    until = until or datetime.now().replace(second=0, microsecond=0)
+    echo = echo or (lambda message: None)
+    loaded = {}
+
+    def load(name, table, rows):
+        started = time.perf_counter()
+        loaded[name] = insert_rows(conn, table, rows, batch)
+        echo(f'{name}: {loaded[name]} за {time.perf_counter() - started:.1f} с')
+
+    # Один хеш на всех: scrypt на каждого из миллиона пользователей занял бы часы
+    password_hash = generate_password_hash(password)
+    first_user = next_id(conn, User.__table__)
+    load('users', User.__table__, generate_users(users, first_user, rng, password_hash))
+    first_category = next_id(conn, Category.__table__)
+    load('categories', Category.__table__, generate_categories(categories, first_category))
+
+    category_ids = list(conn.execute(select(Category.id)).scalars())
+    if (services or portfolio) and not category_ids:
+        raise click.ClickException('Нет категорий: добавьте --categories')
+    service_rows = list(generate_services(services, next_id(conn, Service.__table__), category_ids, rng))
+    load('services', Service.__table__, service_rows)
+
+    user_ids = list(conn.execute(select(User.id).where(User.role == 'client')).scalars())
+    if orders or reviews:
+        if not user_ids:
+            raise click.ClickException('Нет клиентов: добавьте --users')
+        service_rows = service_rows or [dict(row._mapping) for row in conn.execute(select(Service.id, Service.price, Service.duration))]
+        if orders and not service_rows:
+            raise click.ClickException('Нет услуг: добавьте --services')
+    if orders:
+        # Новые заказы - до самого раннего существующего, чтобы не пересечься с ним
+        earliest = conn.execute(select(func.min(Order.booking_datetime))).scalar()
+        started = time.perf_counter()
+        loaded['orders'], loaded['order_items'] = insert_orders(
+            conn, generate_orders(orders, user_ids, service_rows, rng, min(until, earliest or until)), batch
+        )
+        echo(f"orders: {loaded['orders']} (позиций {loaded['order_items']}) за {time.perf_counter() - started:.1f} с")
+    load('portfolio', Portfolio.__table__, generate_portfolio(portfolio, category_ids, rng, until))
+    load('reviews', Review.__table__, generate_reviews(reviews, user_ids, rng, until))
+
+    finish_load(conn, [name for name, count in loaded.items() if count])
+    return loaded
+
+
+# --- Чтение файлов ---
+
+def read_rows(path, fmt):
+    """Строки файла как словари. '-' - stdin; формат по расширению, если не задан."""
+    if fmt is None:
+        fmt = 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+    stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+    try:
+        if fmt == 'csv':
+            yield from csv.DictReader(stream)
+        else:
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def group_order_items(rows):
+    """CSV заказов с колонками item_service_id/item_price/item_duration: строка на позицию,
+    строки одного заказа (одинаковый id) идут подряд"""
+    current = None
+    for row in rows:
+        item = {key[5:]: row.pop(key) for key in list(row) if key.startswith('item_')}
+        if current is not None and row.get('id') and row.get('id') == current.get('id'):
+            current['items'].append(item)
+            continue
+        if current is not None:
+            yield current
+        current = dict(row, items=[item] if any(item.values()) else [])
+    if current is not None:
+        yield current
+
+
+@seed_cli.command('generate')
+@click.option('--users', default=100, help='Клиентов')
+@click.option('--categories', default=6)
+@click.option('--services', default=20)
+@click.option('--orders', default=1000, help='Заказов (по одной позиции)')
+@click.option('--portfolio', default=100, help='Работ в портфолио')
+@click.option('--reviews', default=200)
+@click.option('--password', default='password', help='Пароль всех созданных клиентов')
+@click.option('--admin-email', default=None, help='Создать администратора с этим email')
+@click.option('--seed', 'random_seed', type=int, default=None, help='Зерно генератора (для повторяемости)')
+@click.option('--batch', default=BATCH_SIZE, help='Строк в одной пачке INSERT')
+def generate_command(users, categories, services, orders, portfolio, reviews, password, admin_email, random_seed, batch):
+    """Заполняет базу синтетическими данными (дописывает к существующим)."""
+    started = time.perf_counter()
+    with db.engine.connect() as conn:
+        if admin_email:
+            conn.execute(insert(User.__table__).values(
+                full_name='Администратор', email=admin_email, role='admin', is_admin=True,
+                password_hash=generate_password_hash(password)
+            ))
+            conn.commit()
+            click.echo(f'Администратор {admin_email} создан')
+        generate_dataset(conn, users, categories, services, orders, portfolio, reviews,
+                         rng=random.Random(random_seed), password=password, batch=batch, echo=click.echo)
+    click.echo(f'Готово за {time.perf_counter() - started:.1f} с')
+
+
+@seed_cli.command('import')
+@click.argument('kind', type=click.Choice(sorted(IMPORT_KINDS)))
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None, help='По умолчанию - по расширению файла')
+@click.option('--batch', default=BATCH_SIZE, help='Строк в одной пачке INSERT')
+@click.option('--no-checks', is_flag=True, help='MySQL: отключить проверки внешних ключей и уникальности на время загрузки')
+def import_command(kind, path, fmt, batch, no_checks):
+    """Загружает строки таблицы KIND из CSV или JSONL (PATH, '-' - stdin).
+
+    Колонки совпадают с колонками таблицы. Заказы в JSONL могут содержать список items
+    с позициями, в CSV - колонки item_service_id, item_price, item_duration (строка на
+    позицию, у позиций одного заказа одинаковый id).
+    """
+    started = time.perf_counter()
+    rows = read_rows(path, fmt)
+    with db.engine.connect() as conn:
+        if no_checks and conn.dialect.name == 'mysql':
+            conn.exec_driver_sql('SET FOREIGN_KEY_CHECKS=0, UNIQUE_CHECKS=0')
+        try:
+            if kind == 'orders':
+                if (fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')) == 'csv':
+                    rows = group_order_items(rows)
+                count, items = insert_orders(conn, rows, batch)
+                click.echo(f'Заказов: {count}, позиций: {items}')
+                tables = ['orders', 'order_items']
+            else:
+                table = IMPORT_KINDS[kind].__table__
+                if kind == 'users':
+                    rows = prepare_users(rows)
+                count = insert_rows(conn, table, (coerce_row(table, row) for row in rows), batch)
+                click.echo(f'{kind}: {count}')
+                tables = [table.name]
+        finally:
+            if no_checks and conn.dialect.name == 'mysql':
+                conn.exec_driver_sql('SET FOREIGN_KEY_CHECKS=1, UNIQUE_CHECKS=1')
+        finish_load(conn, tables)
+    click.echo(f'Готово за {time.perf_counter() - started:.1f} с')
+
+
+def init_app(app):
+    app.cli.add_command(seed_cli)
@@ -0,0 +1,328 @@
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, event, func, insert, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.booking import ACTIVE_STATUSES
+from app.models import Order, OrderItem, Review, Service, StatsDay, StatsRating, StatsService, StatsStatus
+
+# Сводные таблицы для панели управления. Вместо агрегатов по orders, order_items и reviews
+# на каждый показ панели счетчики в stats_* меняются на разницу при изменении самих записей
+# (события моделей ниже), поэтому виджеты читают несколько десятков строк при любой длине
+# истории. Загрузка мимо ORM (flask seed) и ручные правки базы событий не вызывают - для них
+# есть полный пересчет: flask stats rebuild.
+#
+# Счетчики заказов по дню брони (stats_days) меняются в той же транзакции: их строку
+# блокируют только брони того же дня, которые и так идут по очереди (блокировка дня в
+# app/booking.py). Строки по статусу (stats_statuses) и по услуге (stats_services) общие
+# для броней разных дней, поэтому разница для них копится в сессии и записывается отдельной
+# короткой транзакцией после коммита, как счетчики таблиц в app/conditional.py. Строки одной
+# транзакции блокируются в порядке ключей, поэтому встречные смены статуса не
+# взаимоблокируются. Если процесс упадет между коммитом и записью разницы, общие счетчики
+# отстанут до flask stats rebuild.
+
+# Статусы, которые считаются выручкой студии
+REVENUE_STATUSES = ('confirmed', 'paid', 'completed')
+DEFAULT_STATUS = 'pending' # Статус заказа без статуса (значение по умолчанию колонки)
+CHART_DAYS = 30
+CHART_MONTHS = 12
+TOP_SERVICES = 5
+PENDING_DELTAS = 'stats_deltas' # Ключ в session.info: разница общих счетчиков до коммита
+
+
+def bump(connection, table, key, **deltas):
+    """Прибавляет deltas к счетчикам строки key, создавая строку при первом обращении"""
+    where = [table.c[name] == value for name, value in key.items()]
+    increment = update(table).where(*where).values({name: table.c[name] + delta for name, delta in deltas.items()})
+    if connection.execute(increment).rowcount:
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(insert(table).values(**key, **deltas))
+    except IntegrityError:
+        connection.execute(increment) # Строку успела создать параллельная транзакция
+
+
+def defer(table, key, **deltas):
+    """Запоминает разницу счетчиков общей строки key; в базу она попадет после коммита"""
+    session = db.session()
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    session.info.setdefault(PENDING_DELTAS, []).append((transaction, table, key, deltas))
+
+
+def order_day(booking_datetime, created_at):
+    moment = booking_datetime or created_at or datetime.utcnow()
+    return moment.date()
+
+
+def old_and_new(state, name):
+    """Значение атрибута до и после текущего flush"""
+    history = state.attrs[name].history
+    new = getattr(state.object, name)
+    old = history.deleted[0] if history.deleted else new
+    return old, new
+
+
+# --- Инкрементальное обновление ---
+
+def count_order(connection, day, status, price, sign):
+    bump(connection, StatsDay.__table__, {'day': day, 'status': status or DEFAULT_STATUS},
+         orders=sign, revenue=sign * (price or 0))
+    defer(StatsStatus.__table__, {'status': status or DEFAULT_STATUS}, orders=sign, revenue=sign * (price or 0))
+
+
+def count_items(connection, order_id, status, sign):
+    """Переносит позиции заказа в счетчики услуг со статусом status (sign = 1) или из них (-1)"""
+    table = OrderItem.__table__
+    rows = connection.execute(
+        select(table.c.service_id, func.count(), func.coalesce(func.sum(table.c.price), 0))
+        .where(table.c.order_id == order_id, table.c.service_id.isnot(None))
+        .group_by(table.c.service_id)
+    )
+    for service_id, items, revenue in rows.all():
+        defer(StatsService.__table__, {'service_id': service_id, 'status': status or DEFAULT_STATUS},
+              items=sign * items, revenue=sign * revenue)
+
+
+def count_item(connection, order_id, service_id, price, sign):
+    if order_id is None or service_id is None:
+        return
+    status = connection.execute(select(Order.status).where(Order.id == order_id)).scalar()
+    defer(StatsService.__table__, {'service_id': service_id, 'status': status or DEFAULT_STATUS},
+          items=sign, revenue=sign * (price or 0))
+
+
+def order_inserted(mapper, connection, target):
+    count_order(connection, order_day(target.booking_datetime, target.created_at), target.status, target.total_price, 1)
+
+
+def order_updated(mapper, connection, target):
+    state = inspect(target)
+    old_status, new_status = old_and_new(state, 'status')
+    old_price, new_price = old_and_new(state, 'total_price')
+    old_booking, new_booking = old_and_new(state, 'booking_datetime')
+    old_day = order_day(old_booking, target.created_at)
+    new_day = order_day(new_booking, target.created_at)
+    old_status, new_status = old_status or DEFAULT_STATUS, new_status or DEFAULT_STATUS
+    if (old_status, old_price, old_day) != (new_status, new_price, new_day):
+        # Строки дня в порядке ключей, а не "старая, затем новая": иначе встречные переходы
+        # (pending -> confirmed и confirmed -> pending) в MySQL могут взаимоблокироваться
+        changes = sorted([(old_day, old_status, old_price, -1), (new_day, new_status, new_price, 1)],
+                         key=lambda change: change[:2])
+        for day, status, price, sign in changes:
+            count_order(connection, day, status, price, sign)
+    if old_status != new_status:
+        count_items(connection, target.id, old_status, -1)
+        count_items(connection, target.id, new_status, 1)
+
+
+def order_deleted(mapper, connection, target):
+    count_order(connection, order_day(target.booking_datetime, target.created_at), target.status, target.total_price, -1)
+
+
+def item_inserted(mapper, connection, target):
+    count_item(connection, target.order_id, target.service_id, target.price, 1)
+
+
+def item_updated(mapper, connection, target):
+    state = inspect(target)
+    old = [old_and_new(state, name)[0] for name in ('order_id', 'service_id', 'price')]
+    new = [target.order_id, target.service_id, target.price]
+    if old != new:
+        count_item(connection, *old, -1)
+        count_item(connection, *new, 1)
+
+
+def item_deleted(mapper, connection, target):
+    # Позиции удаляются раньше заказа (remove_order), поэтому его статус еще можно прочитать
+    count_item(connection, target.order_id, target.service_id, target.price, -1)
+
+
+def count_rating(connection, rating, sign):
+    if rating is not None:
+        bump(connection, StatsRating.__table__, {'rating': rating}, reviews=sign)
+
+
+def review_inserted(mapper, connection, target):
+    count_rating(connection, target.rating, 1)
+
+
+def review_updated(mapper, connection, target):
+    old, new = old_and_new(inspect(target), 'rating')
+    if old != new:
+        count_rating(connection, old, -1)
+        count_rating(connection, new, 1)
+
+
+def review_deleted(mapper, connection, target):
+    count_rating(connection, target.rating, -1)
+
+
+event.listen(Order, 'after_insert', order_inserted)
+event.listen(Order, 'after_update', order_updated)
+event.listen(Order, 'after_delete', order_deleted)
+event.listen(OrderItem, 'after_insert', item_inserted)
+event.listen(OrderItem, 'after_update', item_updated)
+event.listen(OrderItem, 'after_delete', item_deleted)
+event.listen(Review, 'after_insert', review_inserted)
+event.listen(Review, 'after_update', review_updated)
+event.listen(Review, 'after_delete', review_deleted)
+
+
+def within(transaction, ancestor):
+    while transaction is not None:
+        if transaction is ancestor:
+            return True
+        transaction = transaction.parent
+    return False
+
+
+def apply_committed_deltas(session):
+    """После коммита: разница общих счетчиков, одной транзакцией в порядке ключей"""
+    pending = session.info.pop(PENDING_DELTAS, None)
+    if not pending:
+        return
+    totals = {}
+    for _, table, key, deltas in pending:
+        _, _, counters = totals.setdefault((table.name, tuple(sorted(key.items()))), (table, key, {}))
+        for name, delta in deltas.items():
+            counters[name] = counters.get(name, 0) + delta
+    try:
+        with db.engine.begin() as connection:
+            for row in sorted(totals):
+                table, key, counters = totals[row]
+                if any(counters.values()):
+                    bump(connection, table, key, **counters)
+    except Exception:
+        # Заказы уже закоммичены: общие счетчики отстанут до flask stats rebuild
+        current_app.logger.exception('Не удалось обновить сводные счетчики')
+
+
+def forget_rolled_back_deltas(session, previous_transaction):
+    pending = session.info.get(PENDING_DELTAS)
+    if not pending:
+        return
+    if not session.in_transaction():
+        session.info.pop(PENDING_DELTAS, None)
+        return
+    # Откат точки сохранения отменяет только разницу, накопленную внутри нее
+    pending[:] = [entry for entry in pending if not within(entry[0], previous_transaction)]
+
+
+event.listen(db.session, 'after_commit', apply_committed_deltas)
+event.listen(db.session, 'after_soft_rollback', forget_rolled_back_deltas)
+
+
+# --- Полный пересчет ---
+
+def rebuild(conn):
+    """Пересчитывает все сводные таблицы по заказам и отзывам (коммит - на вызывающем).
+
+    Брони, закоммиченные во время пересчета, могут учесться дважды или потеряться,
+    поэтому запускать его стоит в спокойное время.
+    """
+    orders, items, reviews = Order.__table__, OrderItem.__table__, Review.__table__
+    status = func.coalesce(orders.c.status, DEFAULT_STATUS)
+    revenue = func.coalesce(func.sum(orders.c.total_price), 0)
+    day = func.date(func.coalesce(orders.c.booking_datetime, orders.c.created_at))
+
+    for model in (StatsDay, StatsStatus, StatsService, StatsRating):
+        conn.execute(delete(model.__table__))
+    conn.execute(insert(StatsDay.__table__).from_select(
+        ['day', 'status', 'orders', 'revenue'],
+        select(day, status, func.count(), revenue).where(day.isnot(None)).group_by(day, status)
+    ))
+    conn.execute(insert(StatsStatus.__table__).from_select(
+        ['status', 'orders', 'revenue'],
+        select(status, func.count(), revenue).group_by(status)
+    ))
+    conn.execute(insert(StatsService.__table__).from_select(
+        ['service_id', 'status', 'items', 'revenue'],
+        select(items.c.service_id, status, func.count(), func.coalesce(func.sum(items.c.price), 0))
+        .select_from(items.join(orders, items.c.order_id == orders.c.id))
+        .where(items.c.service_id.isnot(None))
+        .group_by(items.c.service_id, status)
+    ))
+    conn.execute(insert(StatsRating.__table__).from_select(
+        ['rating', 'reviews'],
+        select(reviews.c.rating, func.count()).where(reviews.c.rating.isnot(None)).group_by(reviews.c.rating)
+    ))
+
+
+# --- Данные для панели управления ---
+
+def month_start(day, months_back=0):
+    month = day.year * 12 + day.month - 1 - months_back
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def dashboard(today=None):
+    """Виджеты панели: четыре запроса к сводным таблицам, без обхода истории заказов"""
+    today = today or date.today()
+    first_day = min(today - timedelta(days=CHART_DAYS - 1), month_start(today, CHART_MONTHS - 1))
+    is_revenue = StatsDay.status.in_(REVENUE_STATUSES)
+    is_active = StatsDay.status.in_(ACTIVE_STATUSES)
+    rows = (db.session.query(StatsDay.day,
+                             func.sum(db.case((is_revenue, StatsDay.revenue), else_=0)),
+                             func.sum(db.case((is_active, StatsDay.orders), else_=0)))
+            .filter(StatsDay.day >= first_day, StatsDay.day <= today)
+            .group_by(StatsDay.day))
+    per_day = {day: (int(revenue or 0), int(orders or 0)) for day, revenue, orders in rows}
+
+    days = [today - timedelta(days=n) for n in range(CHART_DAYS - 1, -1, -1)]
+    daily = [{'label': day.strftime('%d.%m'), 'revenue': per_day.get(day, (0, 0))[0],
+              'orders': per_day.get(day, (0, 0))[1]} for day in days]
+    monthly = []
+    for n in range(CHART_MONTHS - 1, -1, -1):
+        start = month_start(today, n)
+        values = [v for day, v in per_day.items() if month_start(day) == start]
+        monthly.append({'label': start.strftime('%m.%Y'), 'revenue': sum(v[0] for v in values),
+                        'orders': sum(v[1] for v in values)})
+
+    statuses = {status: (orders, revenue) for status, orders, revenue in
+                db.session.query(StatsStatus.status, StatsStatus.orders, StatsStatus.revenue)
+                .filter(StatsStatus.orders != 0)}
+
+    top_revenue = func.sum(StatsService.revenue)
+    top_services = (db.session.query(Service.name, func.sum(StatsService.items), top_revenue)
+                    .join(Service, Service.id == StatsService.service_id)
+                    .filter(StatsService.status.in_(REVENUE_STATUSES))
+                    .group_by(Service.id, Service.name)
+                    .having(func.sum(StatsService.items) > 0)
+                    .order_by(top_revenue.desc())
+                    .limit(TOP_SERVICES)
+                    .all())
+
+    ratings = dict(db.session.query(StatsRating.rating, StatsRating.reviews).filter(StatsRating.reviews > 0))
+    reviews_total = sum(ratings.values())
+    return {
+        'revenue_today': per_day.get(today, (0, 0))[0],
+        'revenue_month': monthly[-1]['revenue'],
+        'orders_month': monthly[-1]['orders'],
+        'daily': daily,
+        'monthly': monthly,
+        'statuses': statuses,
+        'top_services': [{'name': name, 'items': int(items), 'revenue': int(revenue)}
+                         for name, items, revenue in top_services],
+        'ratings': ratings,
+        'reviews_total': reviews_total,
+        'average_rating': sum(r * n for r, n in ratings.items()) / reviews_total if reviews_total else None,
+    }
+
+
+stats_cli = AppGroup('stats', help='Сводные таблицы панели управления')
+
+
+@stats_cli.command('rebuild')
+def rebuild_command():
+    """Пересчитывает сводные таблицы по заказам и отзывам"""
+    with db.engine.begin() as conn:
+        rebuild(conn)
+        days = conn.execute(select(func.count()).select_from(StatsDay.__table__)).scalar()
+    click.echo(f'Сводные таблицы пересчитаны: дней с заказами - {days}')
+
+
+def init_app(app):
+    app.cli.add_command(stats_cli)
@@ -0,0 +1,263 @@
+import contextlib
+import hashlib
+import hmac
+import mimetypes
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+import click
+import requests
+from flask import current_app, url_for
+from flask.cli import AppGroup
+
+# Хранилище загруженных файлов. Код приложения не работает с UPLOAD_FOLDER напрямую:
+# файлы кладутся, удаляются и получают URL через storage().
+#
+#   local - папка UPLOAD_FOLDER (static/uploads), файлы отдает приложение или nginx (app/proxy.py);
+#   s3    - бакет в S3-совместимом хранилище (MinIO в docker-compose, Yandex Object Storage,
+#           AWS S3). Браузер получает подписанные ссылки прямо на хранилище, байты фото через
+#           Flask не идут, а web-контейнеры не держат файлов и масштабируются независимо.
+#
+# Временные файлы (загрузка по частям, сборка уменьшенных копий) лежат в UPLOAD_TMP_FOLDER.
+# Для нескольких web-контейнеров он должен быть общим томом: части одной загрузки могут
+# прийти в разные контейнеры.
+
+S3_SERVICE = 's3'
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+URL_MAX_EXPIRES = 7 * 24 * 3600 # Предел срока подписанной ссылки в S3
+# Ссылка подписывается на начало суток (S3Storage.url) и должна пережить их конец вместе
+# со страницами из кэша, которые на нее ссылаются
+URL_MIN_EXPIRES = 2 * 24 * 3600
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def tmp_folder():
+    """Папка для временных файлов (по умолчанию UPLOAD_FOLDER/.tmp)"""
+    folder = current_app.config['UPLOAD_TMP_FOLDER'] or os.path.join(current_app.config['UPLOAD_FOLDER'], '.tmp')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def content_type(path):
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+class StorageError(Exception):
+    """Хранилище недоступно или ответило ошибкой"""
+
+
+class LocalStorage:
+    """Файлы в локальной папке"""
+
+    name = 'local'
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, path):
+        return os.path.join(self.folder, path)
+
+    def exists(self, path):
+        return os.path.isfile(self._path(path))
+
+    def put_file(self, local_path, path):
+        """Переносит готовый локальный файл в хранилище под именем path (исходный файл исчезает)"""
+        target = self._path(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.replace(local_path, target)
+        except OSError: # Временная папка на другом томе: копируем рядом и переименовываем
+            shutil.copyfile(local_path, target + '.tmp')
+            os.replace(target + '.tmp', target)
+            os.remove(local_path)
+
+    def delete(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(path))
+
+    @contextlib.contextmanager
+    def local_copy(self, path):
+        """Путь к файлу на диске на время блока"""
+        if not self.exists(path):
+            raise FileNotFoundError(path)
+        yield self._path(path)
+
+    def url(self, path):
+        return url_for('static', filename='uploads/' + path)
+
+    def url_epoch(self):
+        return None # Ссылки постоянные
+
+    def list(self):
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                yield os.path.relpath(os.path.join(root, name), self.folder).replace(os.sep, '/')
+
+
+class S3Storage:
+    """Бакет S3-совместимого хранилища: REST API с подписью AWS Signature V4 через requests"""
+
+    name = 's3'
+
+    def __init__(self, endpoint, bucket, access_key, secret_key, region='us-east-1', public_endpoint=None,
+                 public_url=None, url_expires=URL_MAX_EXPIRES, timeout=30):
+        self.endpoint = endpoint.rstrip('/')
+        # Адрес хранилища для браузера (в docker-compose контейнеры ходят на minio:9000, браузер - на localhost)
+        self.public_endpoint = (public_endpoint or endpoint).rstrip('/')
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.url_expires = min(url_expires, URL_MAX_EXPIRES)
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    # --- Подпись запросов (AWS Signature V4) ---
+
+    def _key(self, path):
+        return f'/{self.bucket}/{quote(path, safe="/~")}'
+
+    def _signing_key(self, day):
+        key = ('AWS4' + self.secret_key).encode()
+        for part in (day, self.region, S3_SERVICE, 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        return key
+
+    def signature(self, method, host, uri, query, headers, amz_date, payload_hash=UNSIGNED_PAYLOAD):
+        """Подпись запроса; headers - подписываемые заголовки в нижнем регистре (вместе с host)"""
+        canonical_query = '&'.join(f'{quote(k, safe="-_.~")}={quote(str(v), safe="-_.~")}' for k, v in sorted(query.items()))
+        headers = dict(headers, host=host)
+        signed = ';'.join(sorted(headers))
+        canonical_headers = ''.join(f'{name}:{str(headers[name]).strip()}\n' for name in sorted(headers))
+        request = '\n'.join((method, uri, canonical_query, canonical_headers, signed, payload_hash))
+        scope = f'{amz_date[:8]}/{self.region}/{S3_SERVICE}/aws4_request'
+        string_to_sign = '\n'.join(('AWS4-HMAC-SHA256', amz_date, scope, hashlib.sha256(request.encode()).hexdigest()))
+        signature = hmac.new(self._signing_key(amz_date[:8]), string_to_sign.encode(), hashlib.sha256).hexdigest()
+        return signature, signed, scope
+
+    def _request(self, method, path, body=None, headers=None, stream=False):
+        amz_date = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        uri = self._key(path)
+        signed_headers = {'x-amz-date': amz_date, 'x-amz-content-sha256': UNSIGNED_PAYLOAD}
+        signed_headers.update({k.lower(): v for k, v in (headers or {}).items()})
+        signature, signed, scope = self.signature(method, urlsplit(self.endpoint).netloc, uri, {}, signed_headers, amz_date)
+        signed_headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                           f'SignedHeaders={signed}, Signature={signature}')
+        try:
+            response = self.session.request(method, self.endpoint + uri, data=body, headers=signed_headers,
+                                            stream=stream, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise StorageError(f'{method} {path}: {e}') from e
+        if response.status_code >= 300 and response.status_code != 404:
+            raise StorageError(f'{method} {path}: HTTP {response.status_code} {response.text[:200]}')
+        return response
+
+    # --- Операции ---
+
+    def exists(self, path):
+        return self._request('HEAD', path).status_code == 200
+
+    def put_file(self, local_path, path):
+        headers = {'content-type': content_type(path)}
+        from app.uploads import is_blob_path
+        if is_blob_path(path) or path.startswith('derivatives/'):
+            headers['cache-control'] = IMMUTABLE # Имя по хешу содержимого: файл под ним не меняется
+        with open(local_path, 'rb') as f:
+            headers['content-length'] = str(os.fstat(f.fileno()).st_size)
+            self._request('PUT', path, body=f, headers=headers)
+        os.remove(local_path)
+
+    def delete(self, path):
+        self._request('DELETE', path) # Удаление отсутствующего объекта - не ошибка
+
+    @contextlib.contextmanager
+    def local_copy(self, path):
+        """Скачивает объект во временный файл на время блока"""
+        with self._request('GET', path, stream=True) as response, \
+                tempfile.NamedTemporaryFile(dir=tmp_folder(), suffix=os.path.splitext(path)[1]) as tmp:
+            if response.status_code == 404:
+                raise FileNotFoundError(path)
+            for chunk in response.iter_content(64 * 1024):
+                tmp.write(chunk)
+            tmp.flush()
+            yield tmp.name
+
+    def url(self, path):
+        """Прямая ссылка на объект: публичная (CDN, открытый бакет) или подписанная.
+
+        Подпись ставится на начало текущих суток и действует url_expires, поэтому в течение
+        дня у файла одна и та же ссылка: браузер берет фото из своего кэша, а страницы из
+        кэша страниц не ссылаются на просроченные ссылки.
+        """
+        if self.public_url:
+            return f'{self.public_url}/{quote(path, safe="/~")}'
+        amz_date = datetime.fromtimestamp(self.url_epoch() * 86400, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        uri = self._key(path)
+        query = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{amz_date[:8]}/{self.region}/{S3_SERVICE}/aws4_request',
+            'X-Amz-Date': amz_date,
+            'X-Amz-Expires': self.url_expires,
+            'X-Amz-SignedHeaders': 'host',
+        }
+        signature, _, _ = self.signature('GET', urlsplit(self.public_endpoint).netloc, uri, query, {}, amz_date)
+        query_string = '&'.join(f'{k}={quote(str(v), safe="-_.~")}' for k, v in query.items())
+        return f'{self.public_endpoint}{uri}?{query_string}&X-Amz-Signature={signature}'
+
+    def url_epoch(self):
+        """Номер суток, которыми подписаны ссылки, или None, если ссылки не подписываются"""
+        return None if self.public_url else int(time.time()) // 86400
+
+
+def create_storage(config):
+    if config['STORAGE_BACKEND'] == 'local':
+        return LocalStorage(config['UPLOAD_FOLDER'])
+    if config['STORAGE_BACKEND'] == 's3':
+        if not config['STORAGE_S3_PUBLIC_URL'] and config['STORAGE_URL_EXPIRES'] < URL_MIN_EXPIRES:
+            raise ValueError(f'STORAGE_URL_EXPIRES: не меньше {URL_MIN_EXPIRES} с (ссылки подписываются на сутки)')
+        return S3Storage(
+            config['STORAGE_S3_ENDPOINT'], config['STORAGE_S3_BUCKET'],
+            config['STORAGE_S3_ACCESS_KEY'], config['STORAGE_S3_SECRET_KEY'],
+            region=config['STORAGE_S3_REGION'], public_endpoint=config['STORAGE_S3_PUBLIC_ENDPOINT'],
+            public_url=config['STORAGE_S3_PUBLIC_URL'], url_expires=config['STORAGE_URL_EXPIRES'],
+        )
+    raise ValueError('STORAGE_BACKEND: local или s3')
+
+
+def storage():
+    """Хранилище загрузок текущего приложения"""
+    return current_app.extensions['storage']
+
+
+storage_cli = AppGroup('storage', help='Хранилище загруженных файлов')
+
+
+@storage_cli.command('migrate')
+def migrate_command():
+    """Копирует файлы из UPLOAD_FOLDER в настроенное хранилище (при переходе на s3)"""
+    target = storage()
+    if target.name == 'local':
+        raise click.ClickException('STORAGE_BACKEND=local: файлы уже в UPLOAD_FOLDER')
+    source = LocalStorage(current_app.config['UPLOAD_FOLDER'])
+    copied = skipped = 0
+    for path in source.list():
+        if target.exists(path):
+            skipped += 1
+            continue
+        # put_file забирает файл, поэтому загружаем копию, а оригинал остается на месте
+        with tempfile.NamedTemporaryFile(dir=tmp_folder(), delete=False) as tmp:
+            with open(source._path(path), 'rb') as f:
+                shutil.copyfileobj(f, tmp)
+        target.put_file(tmp.name, path)
+        copied += 1
+    click.echo(f'Скопировано: {copied}, уже были: {skipped}')
+
+
+def init_app(app):
+    app.extensions['storage'] = create_storage(app.config)
+    app.cli.add_command(storage_cli)
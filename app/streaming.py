@@ -0,0 +1,54 @@
+from flask import current_app, g, get_flashed_messages, stream_with_context
+from markupsafe import Markup
+
+# Потоковые страницы: шаблон отдается клиенту частями по мере рендера, а не собирается
+# целиком в памяти. Шапка и навигация из base.html уходят сразу (до запросов за строками
+# страницы), дальше строки выводятся пачками из курсора базы (KeysetStream в
+# app/pagination.py). Память воркера на запрос ограничена пачкой строк и буфером вывода.
+
+CHUNK_SIZE = 8 * 1024 # Сколько символов HTML копить перед отправкой очередной части
+FLUSH = '\x00stream-flush\x00' # Метка в выводе шаблона: отправить накопленное немедленно
+
+
+def stream_flush():
+    """Для шаблонов: в потоковом ответе отправляет накопленный HTML, в обычном ничего не выводит"""
+    return Markup(FLUSH) if g.get('streaming') else ''
+
+
+def chunks(pieces, size=CHUNK_SIZE):
+    """Склеивает мелкие куски вывода Jinja в части по size символов и режет по меткам FLUSH"""
+    buffer, buffered = [], 0
+    for piece in pieces:
+        parts = piece.split(FLUSH)
+        for n, part in enumerate(parts):
+            if n and buffer:
+                yield ''.join(buffer).encode()
+                buffer, buffered = [], 0
+            if part:
+                buffer.append(part)
+                buffered += len(part)
+        if buffered >= size:
+            yield ''.join(buffer).encode()
+            buffer, buffered = [], 0
+    if buffer:
+        yield ''.join(buffer).encode()
+
+
+def stream_page(template_name, **context):
+    """Как render_template, но возвращает потоковый ответ.
+
+    Сессия сохраняется до тела ответа, поэтому все, что меняет ее (flash-сообщения в шапке),
+    читается заранее. Запросы, выполненные во время вывода, не попадают в заголовки X-SQL-*.
+    """
+    app = current_app._get_current_object()
+    get_flashed_messages() # Снимает сообщения из сессии сейчас; шаблон получит их из контекста запроса
+    g.streaming = True
+    app.update_template_context(context)
+    template = app.jinja_env.get_or_select_template(template_name)
+    response = app.response_class(stream_with_context(chunks(template.generate(context))), mimetype='text/html')
+    response.headers['X-Accel-Buffering'] = 'no' # nginx перед gunicorn не копит поток целиком
+    return response
+
+
+def init_app(app):
+    app.add_template_global(stream_flush)
@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import re
+import secrets
+import tempfile
+import time
+from flask import current_app
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from app.images import is_image, schedule_derivatives, remove_derivatives
+from app.jobs import task
+from app.storage import storage, tmp_folder
+
+try:
+    import fcntl
+except ImportError: # Windows: параллельные записи в одну загрузку не блокируются
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+STORED_UPLOADS = 'stored_uploads' # Ключ в session.info: новые файлы, которым нужны уменьшенные копии
+
+# Путь файла в хранилище по содержимому: ab/cd/<sha256>.<расширение>
+BLOB_PATH = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.[a-z0-9]+$')
+
+
+def is_blob_path(path):
+    """True, если файл лежит в хранилище по содержимому (а не под исходным именем, как раньше)"""
+    return bool(path and BLOB_PATH.match(path))
+
+
+def blob_path(digest, filename):
+    ext = os.path.splitext(secure_filename(filename or ''))[1].lower().lstrip('.') or 'bin'
+    return f'{digest[:2]}/{digest[2:4]}/{digest}.{ext}'
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def save_upload(file):
+    """Сохраняет загруженный файл по хешу содержимого и возвращает его путь в хранилище.
+
+    Файл пишется во временный файл с подсчетом SHA-256 на лету, затем переносится
+    в ab/cd/<sha256>.<ext>. Одинаковые фото хранятся один раз, а разные фото с одинаковым
+    именем больше не затирают друг друга. Счетчик ссылок ведут события моделей (app/models.py).
+    """
+    digest = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=tmp_folder(), delete=False) as tmp:
+        while True:
+            chunk = file.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            tmp.write(chunk)
+
+    path = blob_path(digest.hexdigest(), file.filename)
+    return store_file(tmp.name, path)
+
+
+def lock_blob(path):
+    """Блокирует строку счетчика ссылок на path до конца транзакции сессии и возвращает счетчик.
+
+    Строки еще нет - создается с нулем. Загрузка и удаление одного и того же файла
+    проходят через эту блокировку по очереди: иначе удаление могло бы стереть файл,
+    который новая загрузка сочла уже существующим, до коммита ее ссылки на него.
+    """
+    from app import db
+    from app.models import UploadBlob
+    table = UploadBlob.__table__
+    locked = select(table.c.refcount).where(table.c.path == path).with_for_update()
+    refcount = db.session.execute(locked).scalar()
+    if refcount is not None:
+        return refcount
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(table).values(path=path, refcount=0))
+        return 0
+    except IntegrityError: # Строку успела создать параллельная транзакция
+        return db.session.execute(locked).scalar()
+
+
+def store_file(tmp_path, path):
+    """Переносит готовый временный файл в хранилище (app/storage.py) под путем path.
+
+    Строка счетчика ссылок остается заблокированной до коммита записи, которая сошлется
+    на файл, поэтому проверке exists() можно верить. Уменьшенные копии нового файла
+    ставятся в очередь после коммита (app/models.py).
+    """
+    from app import db
+    lock_blob(path)
+    if storage().exists(path):
+        os.remove(tmp_path) # Такое содержимое уже есть
+    else:
+        storage().put_file(tmp_path, path)
+        db.session.info.setdefault(STORED_UPLOADS, set()).add(path)
+    return path
+
+
+def remove_file(path):
+    """Удаляет файл и его уменьшенные копии из хранилища"""
+    storage().delete(path)
+    remove_derivatives(path)
+
+
+@task(name='uploads.remove_unreferenced')
+def remove_unreferenced(paths):
+    """Фоновое задание: удаляет файлы, на которые так и не появилось новых ссылок"""
+    from app import db
+    from app.models import UploadBlob
+    table = UploadBlob.__table__
+    for path in sorted(set(paths)):
+        # Пока задание ждало в очереди, то же фото могли загрузить снова. Счетчик проверяется
+        # под блокировкой строки, и до конца удаления новая загрузка этого файла ждет
+        try:
+            if lock_blob(path) <= 0:
+                remove_file(path)
+                db.session.execute(delete(table).where(table.c.path == path, table.c.refcount <= 0))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+# --- Загрузка по частям ---
+#
+# Большие файлы и целые фотосессии грузятся из браузера частями: start_upload заводит
+# загрузку (UPLOAD_TMP_FOLDER/chunks: <id>.part с принятыми байтами и <id>.json с описанием),
+# append_chunk дописывает очередную часть прямо из потока запроса, finish_uploads
+# проверяет файлы и переносит их в хранилище. Принятая часть файла сохраняется и при
+# обрыве соединения: клиент спрашивает upload_status и продолжает с offset.
+
+UPLOADS_DIR = 'chunks'
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png'}
+
+
+class UploadError(Exception):
+    """Ошибка загрузки по частям: текст для клиента, код ответа и принятый объем"""
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def _uploads_dir():
+    return os.path.join(tmp_folder(), UPLOADS_DIR)
+
+
+def _upload_paths(upload_id):
+    if not UPLOAD_ID.match(upload_id or ''):
+        raise UploadError('Загрузка не найдена', 404)
+    base = os.path.join(_uploads_dir(), upload_id)
+    return base + '.json', base + '.part'
+
+
+def _load_upload(upload_id, user_id):
+    meta_path, part_path = _upload_paths(upload_id)
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        raise UploadError('Загрузка не найдена', 404)
+    if meta['user_id'] != user_id:
+        raise UploadError('Загрузка не найдена', 404)
+    meta['id'] = upload_id
+    # Файл, уже перенесенный в хранилище (meta['path']), принят целиком
+    meta['offset'] = meta['size'] if 'path' in meta else os.path.getsize(part_path)
+    return meta
+
+
+def _write_meta(meta_path, meta):
+    """Записывает описание загрузки целиком или никак: читатели не видят половину JSON"""
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def _upload_info(meta):
+    return {'id': meta['id'], 'filename': meta['filename'], 'size': meta['size'], 'offset': meta['offset']}
+
+
+def purge_stale_uploads(max_age):
+    """Удаляет загрузки, которые не завершили за max_age секунд"""
+    folder = _uploads_dir()
+    border = time.time() - max_age
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < border:
+                os.remove(path)
+        except FileNotFoundError: # Удалил параллельный запрос
+            pass
+
+
+def start_upload(user_id, filename, size):
+    """Заводит загрузку файла размером size байт"""
+    ext = os.path.splitext(secure_filename(filename or ''))[1].lower().lstrip('.')
+    if ext not in ALLOWED_IMAGE_EXTENSIONS:
+        raise UploadError(f'{filename}: только изображения JPG и PNG')
+    if not isinstance(size, int) or size <= 0:
+        raise UploadError(f'{filename}: пустой файл')
+    if size > current_app.config['UPLOAD_MAX_FILE_SIZE']:
+        raise UploadError(f'{filename}: файл больше {current_app.config["UPLOAD_MAX_FILE_SIZE"] // 2 ** 20} МБ', 413)
+
+    os.makedirs(_uploads_dir(), exist_ok=True)
+    purge_stale_uploads(current_app.config['UPLOAD_SESSION_HOURS'] * 3600)
+    upload_id = secrets.token_hex(16)
+    meta_path, part_path = _upload_paths(upload_id)
+    open(part_path, 'wb').close()
+    _write_meta(meta_path, {'user_id': user_id, 'filename': filename, 'size': size})
+    return {'id': upload_id, 'filename': filename, 'size': size, 'offset': 0}
+
+
+def upload_status(upload_id, user_id):
+    """Сколько байт загрузки уже принято"""
+    return _upload_info(_load_upload(upload_id, user_id))
+
+
+def append_chunk(upload_id, user_id, offset, stream, length=None):
+    """Дописывает часть файла, начинающуюся с offset, из потока stream.
+
+    Часть не буферизуется в памяти, а пишется на диск кусками по CHUNK_SIZE. Если offset
+    не совпадает с уже принятым объемом (часть отправлена повторно или пропущена),
+    UploadError с кодом 409 сообщает клиенту, откуда продолжать.
+    """
+    meta = _load_upload(upload_id, user_id)
+    if offset != meta['offset'] or 'path' in meta:
+        raise UploadError('Часть не с того места', 409, meta['offset'])
+    remaining = meta['size'] - offset
+    if length is not None and length > remaining:
+        raise UploadError('Часть выходит за размер файла', 413, offset)
+
+    meta_path, part_path = _upload_paths(upload_id)
+    # Срок загрузки (purge_stale_uploads) считается от последней части для обоих файлов:
+    # иначе описание долгой загрузки удалилось бы раньше ее данных
+    os.utime(meta_path)
+    with open(part_path, 'r+b') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadError('Часть уже загружается', 409, offset)
+        # Пока ждали блокировку, другой запрос мог дописать файл
+        if os.fstat(f.fileno()).st_size != offset:
+            raise UploadError('Часть не с того места', 409, os.fstat(f.fileno()).st_size)
+        f.seek(offset)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if len(chunk) > remaining:
+                f.truncate(offset)
+                raise UploadError('Часть выходит за размер файла', 413, offset)
+            f.write(chunk)
+            offset += len(chunk)
+            remaining -= len(chunk)
+    return {'id': upload_id, 'size': meta['size'], 'offset': offset}
+
+
+def cancel_upload(upload_id, user_id):
+    _load_upload(upload_id, user_id)
+    for path in _upload_paths(upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def finish_uploads(upload_ids, user_id):
+    """Проверяет загруженные файлы и переносит их в хранилище.
+
+    Возвращает [(имя файла, путь в хранилище), ...] в порядке upload_ids. Сначала
+    проверяются все файлы (полностью приняты, открываются как изображения): если хоть один
+    не годится, в хранилище не попадает ни один и загрузки можно исправить и повторить.
+    Путь перенесенного файла записывается в описание загрузки, а описания удаляются только
+    после переноса всех файлов: после ошибки хранилища на середине пачку можно повторить.
+    """
+    from app import db
+    uploads = [_load_upload(upload_id, user_id) for upload_id in dict.fromkeys(upload_ids)]
+    for meta in uploads:
+        if 'path' in meta:
+            continue
+        _, part_path = _upload_paths(meta['id'])
+        if meta['offset'] != meta['size']:
+            raise UploadError(f'{meta["filename"]}: файл загружен не полностью', 409, meta['offset'])
+        if not is_image(part_path):
+            raise UploadError(f'{meta["filename"]}: файл не является изображением')
+
+    stored = []
+    for meta in uploads:
+        meta_path, part_path = _upload_paths(meta['id'])
+        if 'path' in meta:
+            # Перенесен прошлой попыткой: ссылки на него так и не закоммитили
+            path = meta['path']
+            lock_blob(path)
+            if not storage().exists(path):
+                os.remove(meta_path)
+                raise UploadError(f'{meta["filename"]}: файл нужно загрузить заново', 409)
+            db.session.info.setdefault(STORED_UPLOADS, set()).add(path)
+        else:
+            path = store_file(part_path, blob_path(_hash_file(part_path), meta['filename']))
+            _write_meta(meta_path, {'user_id': user_id, 'filename': meta['filename'], 'size': meta['size'], 'path': path})
+        stored.append((meta['filename'], path))
+    for meta in uploads:
+        os.remove(_upload_paths(meta['id'])[0])
+    return stored
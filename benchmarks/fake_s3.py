@@ -0,0 +1,153 @@
+"""Локальная замена S3-совместимого хранилища для проверки STORAGE_BACKEND=s3 без MinIO.
+
+Запуск из корня проекта:
+
+    python benchmarks/fake_s3.py --port 9000 --data /tmp/fake-s3
+
+и в окружении приложения и воркера (flask worker):
+
+    STORAGE_BACKEND=s3 STORAGE_S3_ENDPOINT=http://127.0.0.1:9000
+    STORAGE_S3_ACCESS_KEY=test STORAGE_S3_SECRET_KEY=testsecret
+
+Поддерживаются вызовы, которые делает app/storage.py: PUT, GET, HEAD и DELETE объекта
+в бакете (путь /<бакет>/<ключ>). Подпись AWS Signature V4 проверяется и в заголовке
+Authorization, и в подписанных ссылках (со сроком действия), так что неправильно
+подписанный запрос получит 403, как от настоящего S3. Бакеты создаются при первой записи.
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote
+from flask import Flask, Response, request
+
+ERROR = """<?xml version="1.0" encoding="UTF-8"?>
+<Error><Code>{code}</Code><Message>{message}</Message></Error>"""
+
+
+def error(code, message, status):
+    return Response(ERROR.format(code=code, message=message), status=status, mimetype='application/xml')
+
+
+def sign(secret, amz_date, region, canonical_request):
+    scope = f'{amz_date[:8]}/{region}/s3/aws4_request'
+    string_to_sign = '\n'.join(('AWS4-HMAC-SHA256', amz_date, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()))
+    key = ('AWS4' + secret).encode()
+    for part in (amz_date[:8], region, 's3', 'aws4_request'):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+
+def canonical_request(signed_headers, query, payload_hash):
+    uri = quote(request.path, safe='/~')
+    canonical_query = '&'.join(f'{quote(k, safe="-_.~")}={quote(v, safe="-_.~")}' for k, v in sorted(query))
+    headers = ''.join(f'{name}:{request.headers.get(name, "").strip()}\n' for name in signed_headers)
+    return '\n'.join((request.method, uri, canonical_query, headers, ';'.join(signed_headers), payload_hash))
+
+
+def create_app(data_dir, access_key='test', secret_key='testsecret'):
+    app = Flask(__name__)
+    lock = threading.Lock()
+    app.config['data_dir'] = data_dir
+
+    def check_signature():
+        """None, если запрос подписан ключом access_key, иначе ответ с ошибкой"""
+        if 'X-Amz-Signature' in request.args:
+            credential = request.args.get('X-Amz-Credential', '').split('/')
+            amz_date = request.args.get('X-Amz-Date', '')
+            signature = request.args['X-Amz-Signature']
+            signed_headers = request.args.get('X-Amz-SignedHeaders', '').split(';')
+            query = [(k, v) for k, v in request.args.items(multi=True) if k != 'X-Amz-Signature']
+            payload_hash = 'UNSIGNED-PAYLOAD'
+            try:
+                issued = datetime.strptime(amz_date, '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+                expires = int(request.args.get('X-Amz-Expires', 0))
+            except ValueError:
+                return error('AuthorizationQueryParametersError', 'Неверные параметры подписи', 400)
+            if expires > 7 * 24 * 3600:
+                return error('AuthorizationQueryParametersError', 'X-Amz-Expires больше 7 дней', 400)
+            if datetime.now(timezone.utc) > issued + timedelta(seconds=expires):
+                return error('AccessDenied', 'Request has expired', 403)
+        elif request.headers.get('Authorization', '').startswith('AWS4-HMAC-SHA256 '):
+            fields = dict(part.strip().split('=', 1) for part in request.headers['Authorization'][17:].split(','))
+            credential = fields.get('Credential', '').split('/')
+            amz_date = request.headers.get('X-Amz-Date', '')
+            signature = fields.get('Signature')
+            signed_headers = fields.get('SignedHeaders', '').split(';')
+            query = list(request.args.items(multi=True))
+            payload_hash = request.headers.get('X-Amz-Content-Sha256', '')
+        else:
+            return error('AccessDenied', 'Нет подписи', 403)
+        if len(credential) != 5 or credential[0] != access_key or 'host' not in signed_headers:
+            return error('InvalidAccessKeyId', 'Неизвестный ключ', 403)
+        expected = sign(secret_key, amz_date, credential[2], canonical_request(signed_headers, query, payload_hash))
+        if not hmac.compare_digest(expected, signature or ''):
+            return error('SignatureDoesNotMatch', 'Подпись не совпадает', 403)
+        return None
+
+    def object_path(bucket, key):
+        path = os.path.normpath(os.path.join(data_dir, bucket, key))
+        if not path.startswith(os.path.join(data_dir, bucket) + os.sep):
+            return None
+        return path
+
+    @app.route('/<bucket>/<path:key>', methods=['GET', 'HEAD', 'PUT', 'DELETE'])
+    def object_(bucket, key):
+        denied = check_signature()
+        if denied is not None:
+            return denied
+        path = object_path(bucket, key)
+        if path is None:
+            return error('InvalidArgument', 'Неверный ключ', 400)
+
+        if request.method == 'PUT':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f'{path}.{threading.get_ident()}.upload'
+            with open(tmp, 'wb') as f:
+                for chunk in iter(lambda: request.stream.read(64 * 1024), b''):
+                    f.write(chunk)
+            with lock:
+                os.replace(tmp, path)
+                with open(path + '.meta', 'w') as f:
+                    f.write(f"{request.headers.get('Content-Type', 'binary/octet-stream')}\n"
+                            f"{request.headers.get('Cache-Control', '')}\n")
+            return Response(status=200, headers={'ETag': '"' + hashlib.md5(open(path, 'rb').read()).hexdigest() + '"'})
+
+        if request.method == 'DELETE':
+            with lock:
+                for name in (path, path + '.meta'):
+                    if os.path.exists(name):
+                        os.remove(name)
+            return Response(status=204)
+
+        if not os.path.isfile(path):
+            return error('NoSuchKey', 'The specified key does not exist.', 404)
+        with open(path + '.meta') as f:
+            mimetype, cache_control = (f.read().split('\n') + [''])[:2]
+        response = Response(open(path, 'rb'), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = os.path.getsize(path)
+        if cache_control:
+            response.headers['Cache-Control'] = cache_control
+        return response
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--data', default='/tmp/fake-s3', help='Папка для объектов')
+    parser.add_argument('--access-key', default='test')
+    parser.add_argument('--secret-key', default='testsecret')
+    args = parser.parse_args()
+    os.makedirs(args.data, exist_ok=True)
+    app = create_app(os.path.abspath(args.data), args.access_key, args.secret_key)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
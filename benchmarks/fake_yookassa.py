@@ -0,0 +1,171 @@
+"""Локальная замена API ЮKassa для проверки оплаты без настоящего магазина.
+
+Запуск из корня проекта:
+
+    python benchmarks/fake_yookassa.py --port 8010 --webhook http://127.0.0.1:5000/payments/webhook
+
+и в окружении приложения и воркера (flask payments worker):
+
+    YOOKASSA_API_URL=http://127.0.0.1:8010/v3 YOOKASSA_SHOP_ID=test YOOKASSA_SECRET_KEY=test
+
+Поддерживаются вызовы, которые делает app/payments.py: создание платежа с ключом
+идемпотентности, получение платежа и список с фильтром created_at.gte и курсором.
+Ссылка на оплату ведет на страницу /checkout/<id> с кнопками "Оплатить" и "Отменить";
+после выбора отправляется уведомление на --webhook. Для проверки устойчивости есть
+--latency (задержка ответов API), --fail-rate (доля ответов 500) и --webhook-loss
+(доля потерянных уведомлений - такие платежи найдет сверка).
+"""
+import argparse
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+import requests
+from flask import Flask, abort, jsonify, redirect, render_template_string, request
+
+CHECKOUT_PAGE = """<!doctype html>
+<title>Тестовая оплата</title>
+<h1>Платеж {{ payment.id }}</h1>
+<p>{{ payment.description }}: {{ payment.amount.value }} {{ payment.amount.currency }}, статус {{ payment.status }}</p>
+{% if payment.status == 'pending' %}
+<form method="post">
+  <button name="action" value="succeeded">Оплатить</button>
+  <button name="action" value="canceled">Отменить</button>
+</form>
+{% endif %}
+"""
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+def parse_iso(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def error(code, description, status):
+    return jsonify(type='error', id=str(uuid.uuid4()), code=code, description=description), status
+
+
+def create_app(webhook_url=None, latency=0.0, fail_rate=0.0, webhook_loss=0.0):
+    app = Flask(__name__)
+    payments = {} # id -> платеж
+    by_key = {} # Idempotence-Key -> id
+    lock = threading.Lock()
+    app.config['payments'] = payments
+
+    def notify(payment):
+        if not webhook_url or random.random() < webhook_loss:
+            return
+        body = {'type': 'notification', 'event': 'payment.' + payment['status'], 'object': dict(payment)}
+        threading.Thread(target=lambda: requests.post(webhook_url, json=body, timeout=10), daemon=True).start()
+
+    def finish(payment_id, status):
+        """Завершает платеж так, как это сделала бы ЮKassa после действия покупателя"""
+        with lock:
+            payment = payments[payment_id]
+            if payment['status'] != 'pending':
+                return payment
+            payment['status'] = status
+            payment['paid'] = status == 'succeeded'
+            if status == 'canceled':
+                payment['cancellation_details'] = {'party': 'yoo_money', 'reason': 'canceled_by_merchant'}
+        notify(payment)
+        return payment
+
+    app.config['finish'] = finish
+
+    @app.before_request
+    def api_checks():
+        if not request.path.startswith('/v3/'):
+            return None
+        if latency:
+            time.sleep(latency)
+        if not request.authorization:
+            return error('invalid_credentials', 'Нет Basic-авторизации', 401)
+        if random.random() < fail_rate:
+            return error('internal_server_error', 'Тестовая ошибка', 500)
+        return None
+
+    @app.post('/v3/payments')
+    def create_payment():
+        key = request.headers.get('Idempotence-Key')
+        if not key:
+            return error('invalid_request', 'Нужен заголовок Idempotence-Key', 400)
+        data = request.get_json(silent=True) or {}
+        amount = data.get('amount') or {}
+        return_url = (data.get('confirmation') or {}).get('return_url')
+        if not amount.get('value') or amount.get('currency') != 'RUB' or not return_url:
+            return error('invalid_request', 'Нужны amount и confirmation.return_url', 400)
+        with lock:
+            if key in by_key:
+                return jsonify(payments[by_key[key]])
+            payment_id = str(uuid.uuid4())
+            payments[payment_id] = {
+                'id': payment_id,
+                'status': 'pending',
+                'paid': False,
+                'amount': amount,
+                'description': data.get('description', ''),
+                'metadata': data.get('metadata', {}),
+                'created_at': now_iso(),
+                'confirmation': {'type': 'redirect', 'return_url': return_url,
+                                 'confirmation_url': request.host_url + 'checkout/' + payment_id},
+                'test': True,
+            }
+            by_key[key] = payment_id
+            return jsonify(payments[payment_id])
+
+    @app.get('/v3/payments/<payment_id>')
+    def get_payment(payment_id):
+        if payment_id not in payments:
+            return error('not_found', 'Платеж не найден', 404)
+        return jsonify(payments[payment_id])
+
+    @app.get('/v3/payments')
+    def list_payments():
+        limit = min(int(request.args.get('limit', 10)), 100)
+        offset = int(request.args.get('cursor', 0))
+        items = sorted(payments.values(), key=lambda p: p['created_at'], reverse=True)
+        if request.args.get('created_at.gte'):
+            since = parse_iso(request.args['created_at.gte'])
+            items = [p for p in items if parse_iso(p['created_at']) >= since]
+        if request.args.get('status'):
+            items = [p for p in items if p['status'] == request.args['status']]
+        page = {'type': 'list', 'items': items[offset:offset + limit]}
+        if offset + limit < len(items):
+            page['next_cursor'] = str(offset + limit)
+        return jsonify(page)
+
+    @app.route('/checkout/<payment_id>', methods=['GET', 'POST'])
+    def checkout(payment_id):
+        if payment_id not in payments:
+            abort(404)
+        if request.method == 'POST':
+            action = request.form.get('action')
+            if action not in ('succeeded', 'canceled'):
+                abort(400)
+            payment = finish(payment_id, action)
+            return redirect(payment['confirmation']['return_url'])
+        return render_template_string(CHECKOUT_PAGE, payment=payments[payment_id])
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8010)
+    parser.add_argument('--webhook', help='URL уведомлений приложения, например http://127.0.0.1:5000/payments/webhook')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка каждого ответа API, с')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Доля ответов API с ошибкой 500')
+    parser.add_argument('--webhook-loss', type=float, default=0.0, help='Доля уведомлений, которые не отправляются')
+    args = parser.parse_args()
+    app = create_app(args.webhook, args.latency, args.fail_rate, args.webhook_loss)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,9 +11,14 @@ echo "MySQL started"
 echo "Applying DB migrations..."
 flask db upgrade
 
-# (Опционально) Можно автоматически заполнять базу при первом старте
-# python seed.py 
+# (Опционально) Заполняем базу демо-данными: SEED_DEMO=1 в окружении контейнера.
+# Для объемов уровня продакшена: flask seed generate --users 100000 --orders 2000000 ...
+if [ "$SEED_DEMO" = "1" ]; then
+  echo "Seeding demo data..."
+  flask seed generate --admin-email "${SEED_ADMIN_EMAIL:-admin@example.com}"
+fi
 
 # Запускаем Gunicorn
 echo "Starting Gunicorn..."
-exec gunicorn --bind 0.0.0.0:5000 run:app
\ No newline at end of file
+# Воркеры, потоки и с ними размер пула соединений - gunicorn.conf.py
+exec gunicorn --config gunicorn.conf.py run:app
\ No newline at end of file
@@ -0,0 +1,12 @@
+import os
+
+# Настройки gunicorn (entrypoint.sh). Число потоков передается приложению через окружение:
+# по нему config.py выбирает размер пула соединений с базой (по соединению на поток).
+# Приложение создается в каждом воркере после fork (без preload_app), так что пулы не общие
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 1)) # Больше 1 - воркеры gthread
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+
+os.environ['GUNICORN_THREADS'] = str(threads)
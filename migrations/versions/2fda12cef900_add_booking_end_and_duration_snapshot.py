@@ -0,0 +1,62 @@
+"""Add booking_end to orders and duration snapshot to order_items
+
+Revision ID: 2fda12cef900
+Revises: ad428333899d
+Create Date: 2026-10-17 10:12:41.518204
+
+"""
+from datetime import timedelta
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2fda12cef900'
+down_revision = 'ad428333899d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('booking_end', sa.DateTime(), nullable=True))
+
+    with op.batch_alter_table('order_items', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('duration', sa.Integer(), nullable=True))
+
+    # Заполняем снимок длительности и время окончания для уже существующих заказов
+    # (по текущей длительности услуги, как это делала старая проверка пересечений)
+    orders = sa.table('orders', sa.column('id'), sa.column('booking_datetime'), sa.column('booking_end'))
+    order_items = sa.table('order_items', sa.column('id'), sa.column('order_id'), sa.column('service_id'), sa.column('duration'))
+    services = sa.table('services', sa.column('id'), sa.column('duration'))
+
+    conn = op.get_bind()
+    rows = conn.execute(
+        sa.select(order_items.c.id, order_items.c.order_id, services.c.duration)
+        .select_from(order_items.outerjoin(services, services.c.id == order_items.c.service_id))
+        .order_by(order_items.c.id)
+    ).fetchall()
+
+    durations = {}
+    for item_id, order_id, duration in rows:
+        duration = duration or 60
+        conn.execute(order_items.update().where(order_items.c.id == item_id).values(duration=duration))
+        durations.setdefault(order_id, duration)
+
+    for order_id, start in conn.execute(sa.select(orders.c.id, orders.c.booking_datetime)).fetchall():
+        if start is None:
+            continue
+        end = start + timedelta(minutes=durations.get(order_id, 60))
+        conn.execute(orders.update().where(orders.c.id == order_id).values(booking_end=end))
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.create_index('ix_orders_status_booking', ['status', 'booking_datetime', 'booking_end'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.drop_index('ix_orders_status_booking')
+        batch_op.drop_column('booking_end')
+
+    with op.batch_alter_table('order_items', schema=None) as batch_op:
+        batch_op.drop_column('duration')
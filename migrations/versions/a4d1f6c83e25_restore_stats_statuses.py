@@ -0,0 +1,38 @@
+"""Restore stats_statuses, updated after commit
+
+Revision ID: a4d1f6c83e25
+Revises: e2c5a7f1b094
+Create Date: 2026-10-17 22:14:36.802517
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d1f6c83e25'
+down_revision = 'e2c5a7f1b094'
+branch_labels = None
+depends_on = None
+
+ORDER_STATUS = "COALESCE(status, 'pending')"
+
+
+def upgrade():
+    # Сумма stats_days по статусам читала всю историю; строки статусов теперь меняются
+    # отдельной транзакцией после коммита брони (app/stats.py)
+    op.create_table('stats_statuses',
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('status')
+    )
+    op.execute(f"""
+        INSERT INTO stats_statuses (status, orders, revenue)
+        SELECT {ORDER_STATUS}, COUNT(*), COALESCE(SUM(total_price), 0)
+        FROM orders GROUP BY {ORDER_STATUS}
+    """)
+
+
+def downgrade():
+    op.drop_table('stats_statuses')
@@ -0,0 +1,38 @@
+"""Drop stats_statuses: status totals are summed from stats_days
+
+Revision ID: e2c5a7f1b094
+Revises: c4a8e2d6f913
+Create Date: 2026-10-17 20:41:12.318406
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2c5a7f1b094'
+down_revision = 'c4a8e2d6f913'
+branch_labels = None
+depends_on = None
+
+ORDER_STATUS = "COALESCE(status, 'pending')"
+
+
+def upgrade():
+    # Одна строка на статус блокировалась каждой бронью до коммита и выстраивала
+    # в очередь брони разных дней (app/stats.py)
+    op.drop_table('stats_statuses')
+
+
+def downgrade():
+    op.create_table('stats_statuses',
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('status')
+    )
+    op.execute(f"""
+        INSERT INTO stats_statuses (status, orders, revenue)
+        SELECT {ORDER_STATUS}, COUNT(*), COALESCE(SUM(total_price), 0)
+        FROM orders GROUP BY {ORDER_STATUS}
+    """)
@@ -0,0 +1,38 @@
+#!/bin/bash
+# Первый запуск реплики (сервис db-replica в docker-compose.yml): копирует данные основной
+# базы и включает репликацию по GTID. Скрипт выполняется из /docker-entrypoint-initdb.d
+# только при пустом томе реплики; дальше реплика сама продолжает с того же места.
+set -e
+
+source_mysql=(mysql -h"$SOURCE_HOST" -uroot -p"$SOURCE_ROOT_PASSWORD")
+local_mysql=(mysql -uroot -p"$MYSQL_ROOT_PASSWORD")
+
+echo "Waiting for source $SOURCE_HOST..."
+until mysqladmin ping -h"$SOURCE_HOST" -uroot -p"$SOURCE_ROOT_PASSWORD" --silent; do
+  sleep 1
+done
+
+# Пользователь репликации; пользователю приложения - право смотреть отставание (app/replicas.py)
+"${source_mysql[@]}" <<SQL
+CREATE USER IF NOT EXISTS '$REPLICATION_USER'@'%' IDENTIFIED BY '$REPLICATION_PASSWORD';
+GRANT REPLICATION SLAVE ON *.* TO '$REPLICATION_USER'@'%';
+GRANT REPLICATION CLIENT ON *.* TO '$APP_USER'@'%';
+SQL
+
+# Снимок основной базы вместе с позицией GTID, с которой продолжит репликация
+"${local_mysql[@]}" -e "RESET MASTER;"
+mysqldump -h"$SOURCE_HOST" -uroot -p"$SOURCE_ROOT_PASSWORD" --all-databases --single-transaction \
+  --routines --events --triggers --set-gtid-purged=ON --flush-privileges | "${local_mysql[@]}"
+
+"${local_mysql[@]}" <<SQL
+CHANGE REPLICATION SOURCE TO
+  SOURCE_HOST='$SOURCE_HOST',
+  SOURCE_USER='$REPLICATION_USER',
+  SOURCE_PASSWORD='$REPLICATION_PASSWORD',
+  SOURCE_AUTO_POSITION=1,
+  GET_SOURCE_PUBLIC_KEY=1;
+START REPLICA;
+SET PERSIST read_only = ON;
+SET PERSIST super_read_only = ON;
+SQL
+echo "Replication from $SOURCE_HOST started"